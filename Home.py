@@ -1,15 +1,20 @@
 import streamlit as st
 import sys
 from pathlib import Path
-from config import APP_CONFIG, load_config
+from config import APP_CONFIG, load_config, render_warmup_status, start_warmup, timed_page
 
 # 设置页面配置
 st.set_page_config(**APP_CONFIG)
 
-# 添加项目根目录到系统路径
+# 添加项目根目录到系统路径（页面每次重跑都会执行，避免重复添加）
 project_root = Path(__file__).parent.parent
-sys.path.append(str(project_root))
+if str(project_root) not in sys.path:
+    sys.path.append(str(project_root))
 
+# 服务启动后首次打开首页时开始后台预热（每个进程只启动一次）
+warmup = start_warmup()
+
+@timed_page("首页")
 def main():
     # 检查配置
     config = load_config()
@@ -19,6 +24,9 @@ def main():
         
     st.title("📊 数据分析平台")
     
+    # 预热进度：完成后各页面首次打开即命中缓存
+    render_warmup_status(warmup)
+    
     st.markdown("""
     ### 👋 欢迎使用数据分析平台
     
@@ -35,6 +43,10 @@ def main():
     3. 🤝 **邀请关系分析**
        - 查看用户邀请关系
        - 分析邀请效果
+       
+    4. 🔎 **代理商详情**
+       - 查看单个代理的用户明细
+       - 查看每日充值和邀请情况
     
     ### 使用说明
     
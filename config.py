@@ -4,7 +4,13 @@ import json
 import streamlit as st
 from datetime import datetime
 import sys
-from contextlib import contextmanager
+import gc
+import functools
+import time
+import threading
+import importlib.util
+from collections import deque
+from contextlib import contextmanager, nullcontext
 from io import StringIO
 
 # 获取项目根目录
@@ -49,6 +55,349 @@ def capture_output(container):
         sys.stdout = old_stdout
         sys.stderr = old_stderr
 
+@st.cache_resource(show_spinner=False)
+def _load_script_module(name, mtime):
+    """执行 scripts 目录下的模块；按 (模块名, 修改时间) 缓存，进程内只执行一次"""
+    module_path = LOCAL_ROOT / "scripts" / f"{name}.py"
+    # 已被其他分析脚本导入的同一模块直接复用，保证带状态的模块（如结果缓存）进程内只有一份
+    module = sys.modules.get(name)
+    if (module is not None and Path(getattr(module, "__file__", "")) == module_path
+            and getattr(module, "_loaded_mtime", mtime) == mtime):
+        return module
+    spec = importlib.util.spec_from_file_location(name, module_path)
+    module = importlib.util.module_from_spec(spec)
+    module._loaded_mtime = mtime
+    sys.modules[name] = module
+    spec.loader.exec_module(module)
+    return module
+
+def load_script_module(name):
+    """
+    加载 scripts 目录下的分析模块
+    页面每次重跑都会调用，但模块只在首次加载或文件被修改后才会重新执行
+    """
+    module_path = LOCAL_ROOT / "scripts" / f"{name}.py"
+    return _load_script_module(name, module_path.stat().st_mtime)
+
+class _ThreadOutput:
+    """按线程分发的标准输出：刷新任务线程的输出写入任务日志，其他线程照常输出"""
+
+    def __init__(self, default):
+        self.default = default
+        self.targets = {}
+
+    def write(self, text):
+        return self.targets.get(threading.get_ident(), self.default).write(text)
+
+    def flush(self):
+        self.default.flush()
+
+_output_lock = threading.Lock()
+
+def _thread_output():
+    with _output_lock:
+        if not isinstance(sys.stdout, _ThreadOutput):
+            sys.stdout = _ThreadOutput(sys.stdout)
+        return sys.stdout
+
+class RefreshJob:
+    """
+    在后台线程中执行的刷新任务
+    页面重跑（筛选、翻页）不会打断任务；任务持有取消令牌，取消后正在等待的查询和未开始的数据库立即放弃。
+    页面超过 abandon_after_seconds 没有查看进度（已离开页面）时自动取消。
+    """
+
+    def __init__(self, steps):
+        cancellation = load_script_module("cancellation")
+        self.refresh_config = cancellation.get_refresh_config(load_config())
+        self.token = cancellation.CancelToken(self.refresh_config["timeout_seconds"])
+        self.steps = steps
+        self.step = None
+        self.steps_done = 0
+        self.log = deque(maxlen=200)
+        self.status = "running"
+        self.error = None
+        self.started = time.time()
+        self.last_seen = time.time()
+        self.finished = threading.Event()
+        threading.Thread(target=self._run, daemon=True).start()
+        threading.Thread(target=self._watch, daemon=True).start()
+
+    @property
+    def running(self):
+        return not self.finished.is_set()
+
+    def write(self, text):
+        if text.strip():
+            self.log.append(f"[{datetime.now().strftime('%H:%M:%S')}] {text.strip()}")
+
+    def flush(self):
+        pass
+
+    def _run(self):
+        cancellation = load_script_module("cancellation")
+        output = _thread_output()
+        output.targets[threading.get_ident()] = self
+        try:
+            for description, step in self.steps:
+                self.token.check()
+                self.step = description
+                step(self.token)
+                self.steps_done += 1
+            self.status = "done"
+        except cancellation.Cancelled as e:
+            self.status = "cancelled"
+            self.error = str(e)
+        except Exception as e:
+            self.status = "failed"
+            self.error = str(e)
+        finally:
+            output.targets.pop(threading.get_ident(), None)
+            # 释放本次刷新持有的数据
+            self.steps = None
+            gc.collect()
+            self.finished.set()
+
+    def _watch(self):
+        abandon_after = self.refresh_config["abandon_after_seconds"]
+        while not self.finished.wait(1):
+            if abandon_after and time.time() - self.last_seen > abandon_after:
+                self.token.cancel("页面已关闭，刷新已取消")
+            # 读取 cancelled 时检查是否超时，超时的令牌在这里触发取消回调（如中断库内查询）
+            self.token.cancelled
+
+@st.fragment(run_every=1)
+def _render_refresh_job(key):
+    """刷新进度（每秒更新），任务结束或完成一步后重跑整个页面以加载新结果"""
+    job = st.session_state.get(key)
+    if job is None:
+        return
+    job.last_seen = time.time()
+    if not job.running or job.steps_done != st.session_state.get(f"{key}-steps"):
+        st.session_state[f"{key}-steps"] = job.steps_done
+        st.rerun(scope="app")
+
+    col1, col2 = st.columns([4, 1])
+    with col1:
+        if job.token.cancelled:
+            st.warning("正在取消...")
+        else:
+            st.info(f"{job.step or '正在更新数据'}...（已运行 {time.time() - job.started:.0f} 秒）")
+    with col2:
+        if st.button("⏹ 取消刷新", key=f"{key}-cancel", disabled=job.token.cancelled):
+            job.token.cancel("已手动取消")
+    with st.expander("运行日志"):
+        st.code("\n".join(list(job.log)[-30:]) or "等待输出...")
+
+def render_refresh(key, steps, label="🔄 刷新数据"):
+    """
+    刷新按钮：点击后在后台执行 steps（[(说明, fn(token))]，按顺序执行），
+    执行期间显示进度和取消按钮，结束后显示结果
+    """
+    job = st.session_state.get(key)
+    if job is not None and not job.running:
+        # 结束后的结果只显示一次
+        del st.session_state[key]
+        if job.status == "done":
+            st.success("数据更新成功！")
+        elif job.status == "cancelled":
+            st.warning(f"数据更新已取消：{job.error}（已拉取的数据保留在检查点中，再次刷新时继续）")
+        else:
+            st.error(f"数据更新失败: {job.error}")
+        job = None
+
+    if job is None:
+        if st.button(label, key=f"{key}-start"):
+            st.session_state[key] = RefreshJob(steps)
+            st.session_state[f"{key}-steps"] = 0
+            _render_refresh_job(key)
+    else:
+        _render_refresh_job(key)
+
+# 启动预热时加载的分析模块和第三方库（页面首次访问时不再付出导入耗时）
+WARMUP_MODULES = [
+    "result_cache", "page_data", "table_view", "downsample", "hll", "sampling", "agent_partitions",
+    "render_timing", "cancellation", "export", "agent_analysis", "accumulate_recharge", "invite_tree"
+]
+WARMUP_LIBRARIES = ["plotly.express", "plotly.graph_objects", "networkx"]
+
+class Warmup:
+    """
+    启动预热（后台线程）：加载各页面用到的模块，再依次执行 page_data.WARMUP_TASKS
+    （加载最新结果、构建搜索/排序索引、计算邀请关系图的默认布局），填充进程内共享的缓存
+    """
+
+    def __init__(self, tasks):
+        self.tasks = [("加载模块", self._load_modules)] + list(tasks)
+        self.steps = [{"步骤": description, "状态": "等待", "耗时(秒)": None, "说明": ""} for description, _ in self.tasks]
+        self.started = time.time()
+        self.elapsed = None
+        self.finished = threading.Event()
+        threading.Thread(target=self._run, daemon=True).start()
+
+    @property
+    def running(self):
+        return not self.finished.is_set()
+
+    @property
+    def steps_done(self):
+        return sum(step["状态"] not in ("等待", "进行中") for step in self.steps)
+
+    def _step(self, step, fn):
+        step["状态"] = "进行中"
+        start = time.perf_counter()
+        try:
+            step["说明"] = fn() or ""
+            step["状态"] = "完成"
+        except Exception as e:
+            step["说明"] = str(e)
+            step["状态"] = "失败"
+        step["耗时(秒)"] = round(time.perf_counter() - start, 2)
+
+    def _load_modules(self):
+        for name in WARMUP_MODULES:
+            load_script_module(name)
+        for name in WARMUP_LIBRARIES:
+            importlib.import_module(name)
+        return f"{len(WARMUP_MODULES) + len(WARMUP_LIBRARIES)} 个模块"
+
+    def _run(self):
+        try:
+            for step, (_, task) in zip(self.steps, self.tasks):
+                self._step(step, task)
+        finally:
+            self.elapsed = time.time() - self.started
+            self.finished.set()
+
+@st.cache_resource(show_spinner=False)
+def start_warmup():
+    """启动预热（每个服务进程只执行一次，由首页调用）；配置关闭时返回None"""
+    page_data = load_script_module("page_data")
+    config = load_config()
+    if not page_data.get_warmup_config(config)["enabled"]:
+        return None
+    return Warmup([(description, functools.partial(task, config)) for description, task in page_data.WARMUP_TASKS])
+
+@st.fragment(run_every=1)
+def _render_warmup_progress(warmup):
+    """预热进度（每秒更新），完成后重跑整个页面"""
+    if not warmup.running:
+        st.rerun(scope="app")
+    st.info(f"⏳ 正在预热缓存（{warmup.steps_done}/{len(warmup.steps)}），首次打开各分析页面可能较慢...")
+    st.dataframe(warmup.steps, hide_index=True)
+
+def render_warmup_status(warmup):
+    """首页上的预热状态：进行中显示进度，完成后显示各步骤耗时"""
+    if warmup is None:
+        return
+    if warmup.running:
+        _render_warmup_progress(warmup)
+        return
+    failed = [step for step in warmup.steps if step["状态"] == "失败"]
+    if failed:
+        st.warning(f"缓存预热完成，{len(failed)} 个步骤失败（对应页面首次打开时重新加载），用时 {warmup.elapsed:.1f} 秒")
+    else:
+        st.success(f"✅ 缓存已就绪（预热用时 {warmup.elapsed:.1f} 秒）")
+    with st.expander("预热详情"):
+        st.dataframe(warmup.steps, hide_index=True)
+
+_timer = threading.local()
+
+def timed_page(page):
+    """
+    页面 main() 的装饰器：按区段统计本次重跑的耗时（见 scripts/render_timing.py），
+    侧边栏勾选"显示渲染耗时"后在侧边栏展示
+    """
+    def decorator(main):
+        @functools.wraps(main)
+        def wrapper(*args, **kwargs):
+            render_timing = load_script_module("render_timing")
+            show = st.sidebar.checkbox("⏱ 显示渲染耗时", key="render-timing")
+            timer = render_timing.RenderTimer(page, measure_payload=show, config=load_config())
+            _timer.current = timer
+            try:
+                result = main(*args, **kwargs)
+            finally:
+                _timer.current = None
+            timer.finish()
+            if show:
+                _render_timing_panel(render_timing, timer)
+            return result
+        return wrapper
+    return decorator
+
+def timed(name):
+    """页面区段计时（不在 timed_page 装饰的页面中时不做任何事）"""
+    timer = getattr(_timer, "current", None)
+    return timer.section(name) if timer is not None else nullcontext()
+
+def track_payload(name, obj):
+    """记录发送到浏览器的表格/图表的数据量（只在显示渲染耗时时计算）"""
+    timer = getattr(_timer, "current", None)
+    if timer is not None:
+        timer.payload(name, obj)
+    return obj
+
+def _render_timing_panel(render_timing, timer):
+    with st.sidebar:
+        st.subheader("⏱ 渲染耗时")
+        st.caption("本次重跑")
+        st.dataframe(timer.section_frame(), hide_index=True)
+        cache = timer.cache_frame()
+        if not cache.empty:
+            st.caption("缓存与查询")
+            st.dataframe(cache, hide_index=True)
+        payloads = timer.payload_frame()
+        if not payloads.empty:
+            st.caption(f"发送数据量（共 {payloads['KB'].sum():,.1f} KB）")
+            st.dataframe(payloads, hide_index=True)
+        st.caption("历史分位数（本页，所有会话）")
+        st.dataframe(render_timing.percentiles(timer.page).drop(columns=["页面"]), hide_index=True)
+
+def render_export(build_frame, version, filter_key, file_stem, key):
+    """
+    导出按钮：选择格式后点击生成，生成过的 (结果版本, 筛选条件, 格式) 直接提供下载
+    build_frame() 返回要导出的DataFrame，只在需要生成文件时才调用
+    """
+    export = load_script_module("export")
+    col1, col2 = st.columns([1, 3])
+    with col1:
+        fmt = st.selectbox(
+            "导出格式",
+            list(export.FORMATS),
+            format_func=lambda x: export.FORMATS[x][2],
+            key=f"{key}-format"
+        )
+    extension, mime, _ = export.FORMATS[fmt]
+
+    path = export.cached_export(version, filter_key, fmt)
+    with col2:
+        if path is None and st.button("📦 生成导出文件", key=f"{key}-build"):
+            with st.spinner("正在生成导出文件..."):
+                path = export.build_export(build_frame(), version, filter_key, fmt)
+        if path is not None:
+            with open(path, "rb") as f:
+                st.download_button("📥 下载数据", f, f"{file_stem}{extension}", mime, key=key)
+
+def latest_preview(output_dir, pattern, exact_file):
+    """
+    比完整结果更新的预览结果文件（预览之后还没有完成完整刷新），没有时返回None
+    exact_file 为最新的完整结果文件（可以为None）
+    """
+    result_cache = load_script_module("result_cache")
+    preview_file = result_cache.latest_file(output_dir, pattern)
+    if preview_file is None:
+        return None
+    if exact_file is not None and exact_file.stat().st_mtime >= preview_file.stat().st_mtime:
+        return None
+    return preview_file
+
+def format_estimate(value, error, prefix=""):
+    """预览估计值的显示：≈值 ± 置信区间半宽"""
+    if prefix:
+        return f"≈{prefix}{value:,.2f} ± {prefix}{error:,.2f}"
+    return f"≈{value:,.0f} ± {error:,.0f}"
+
 def load_config():
     """加载配置文件，优先使用本地配置"""
     try:
@@ -2,7 +2,6 @@ import streamlit as st
 import pandas as pd
 import sys
 from pathlib import Path
-import importlib.util
 from datetime import datetime
 
 # 设置页面配置
@@ -12,115 +11,236 @@ st.set_page_config(
     layout="wide"
 )
 
-# 添加项目根目录到系统路径
+# 添加项目根目录到系统路径（页面每次重跑都会执行，避免重复添加）
 project_root = Path(__file__).parent.parent
-sys.path.append(str(project_root))
+if str(project_root) not in sys.path:
+    sys.path.append(str(project_root))
 
 # 导入配置
-from config import capture_output
+from config import format_estimate, latest_preview, load_config, load_script_module, render_export, render_refresh, timed, timed_page, track_payload
 
-# 动态导入agent_analysis模块
-agent_analysis_path = project_root / "scripts" / "agent_analysis.py"
-spec = importlib.util.spec_from_file_location("agent_analysis", agent_analysis_path)
-agent_analysis = importlib.util.module_from_spec(spec)
-spec.loader.exec_module(agent_analysis)
+# 加载agent_analysis模块（按进程缓存，重跑时不再重新执行）
+agent_analysis = load_script_module("agent_analysis")
+result_cache = load_script_module("result_cache")
+page_data = load_script_module("page_data")
+table_view = load_script_module("table_view")
+hll = load_script_module("hll")
+sampling = load_script_module("sampling")
+snapshots = load_script_module("snapshots")
 
 def load_latest_analysis():
     """加载最新的分析结果"""
     try:
-        output_dir = project_root / "data" / "merged_data"
-        output_dir.mkdir(parents=True, exist_ok=True)
-        files = list(output_dir.glob("agent_analysis_*.csv"))
-        if not files:
-            return None
-            
-        latest_file = max(files, key=lambda x: x.stat().st_mtime)
-        df = pd.read_csv(latest_file)
-        return df, latest_file.name
+        # 同一版本的结果文件只解析一次，所有会话共享（启动预热时已加载）
+        return page_data.latest_result("agent_analysis_*.csv")
     except Exception as e:
         st.error(f"加载数据失败: {str(e)}")
-        return None, None
+        return None
 
+def load_latest_preview(filename):
+    """比完整结果更新的抽样预览结果，没有时返回None"""
+    output_dir = project_root / "data" / "merged_data"
+    exact_file = output_dir / filename if filename else None
+    preview_file = latest_preview(output_dir, "preview_agent_analysis_*.csv", exact_file)
+    if preview_file is None:
+        return None
+    df, _ = result_cache.load_result(preview_file)
+    return df
+
+def render_preview(df):
+    """抽样预览：估计值带置信区间，完整结果生成后不再显示"""
+    st.warning("以下为抽样预览的估计值（± 为置信区间半宽，不含最大邀请人数），完整结果生成后自动替换。")
+    col1, col2, col3 = st.columns(3)
+    with col1:
+        st.metric("总代理数", len(df))
+    with col2:
+        st.metric("总用户数", format_estimate(df["总用户数"].sum(), sampling.combine_errors(df["总用户数_误差"])))
+    with col3:
+        st.metric(
+            "总充值金额",
+            format_estimate(df["总充值金额"].sum(), sampling.combine_errors(df["总充值金额_误差"]), prefix="¥")
+        )
+    st.dataframe(
+        track_payload("预览表格", df[[
+            "username", "agent_id", "总用户数", "总用户数_误差", "付费用户数", "付费用户数_误差",
+            "总充值金额", "总充值金额_误差", "付费率", "抽样比例"
+        ]]),
+        column_config={
+            "username": "代理商名称",
+            "总充值金额": st.column_config.NumberColumn(format="¥%.2f"),
+            "总充值金额_误差": st.column_config.NumberColumn(format="±%.2f"),
+            "抽样比例": st.column_config.NumberColumn(format="%.4f")
+        },
+        hide_index=True
+    )
+
+def render_distinct_rollup(filename, df, version):
+    """合并各数据库、各代理的草图，估计一组代理的去重用户数"""
+    sketches = page_data.load_sketches(filename)
+    if sketches is None or sketches.empty:
+        st.info("当前结果没有去重草图，重新刷新数据后可用。")
+        return
+    
+    names = page_data.agent_names(df, version)
+    agent_ids = sorted(sketches["agent_id"].unique(), key=lambda x: names.get(x, x))
+    selected = st.multiselect(
+        "代理商分组（不选则为全部代理）",
+        agent_ids,
+        format_func=lambda x: f"{names.get(x, x)} ({x})"
+    )
+    group = sketches[sketches["agent_id"].isin(selected)] if selected else sketches
+    totals = hll.rollup(group)
+    
+    col1, col2, col3 = st.columns(3)
+    for col, metric in zip((col1, col2, col3), ["总用户数", "付费用户数", "游戏玩家数"]):
+        with col:
+            value = int(totals[metric].iloc[0]) if metric in totals.columns else 0
+            st.metric(f"{metric}（去重）", f"≈{value:,}")
+    p = hll.decode(sketches["sketch"].iloc[0])[0]
+    st.caption(f"由 {group['db_id'].nunique()} 个数据库、{group['agent_id'].nunique()} 个代理的草图合并估计，相对误差约 ±{hll.relative_error(p) * 100:.1f}%")
+
+def format_version(version):
+    """快照版本（20250101_060000）-> 2025-01-01 06:00:00"""
+    return f"{version[:4]}-{version[4:6]}-{version[6:8]} {version[9:11]}:{version[11:13]}:{version[13:15]}"
+
+def render_changes(filename, version):
+    """与前一天最后一次结果相比，指标有变化的代理（由历史快照的块ID比对得到）"""
+    changes = page_data.snapshot_changes(filename, version, load_config())
+    if changes is None:
+        st.info("暂无前一天的历史快照，下次刷新数据后可用（也可执行 python scripts/snapshots.py import 导入已有结果）。")
+        return
+    baseline, current, df = changes
+    
+    col1, col2, col3, col4 = st.columns(4)
+    status_counts = df["状态"].value_counts()
+    with col1:
+        st.metric("有变化的代理", len(df))
+    with col2:
+        st.metric("新增代理", int(status_counts.get(snapshots.ADDED, 0)))
+    with col3:
+        st.metric("移除代理", int(status_counts.get(snapshots.REMOVED, 0)))
+    with col4:
+        st.metric("总充值金额变化", f"¥{df['总充值金额_变化'].sum():,.2f}")
+    st.caption(f"{format_version(baseline)} → {format_version(current)}，按总充值金额变化排序")
+    if df.empty:
+        return
+    
+    st.dataframe(
+        track_payload("变化表格", df.head(table_view.PAGE_SIZES[-1])),
+        column_config={
+            "username": "代理商名称",
+            "总充值金额": st.column_config.NumberColumn(format="¥%.2f"),
+            "总充值金额_变化": st.column_config.NumberColumn(format="%+.2f")
+        },
+        hide_index=True
+    )
+
+@timed_page("代理商分析")
 def main():
     st.title("📈 代理商分析")
     
-    # 创建日志容器
-    log_container = st.empty()
-    
-    # 添加刷新按钮
-    if st.button("🔄 刷新数据"):
-        with st.spinner("正在更新数据..."):
-            try:
-                # 创建进度显示区域
-                progress_container = st.empty()
-                progress_container.info("开始更新数据...")
-                
-                # 捕获并显示日志
-                with capture_output(log_container):
-                    agent_analysis.main()
-                    
-                progress_container.success("数据更新成功！")
-            except Exception as e:
-                progress_container.error(f"数据更新失败: {str(e)}")
-                return
+    # 刷新数据：在后台执行，执行期间显示进度并可取消
+    quick_preview = st.checkbox("先生成快速预览", value=True, help="先抽样估计各代理指标（几秒内完成），再进行完整刷新")
+    steps = []
+    if quick_preview:
+        steps.append(("正在生成快速预览", lambda token: agent_analysis.main(preview=True, token=token)))
+    steps.append(("正在更新数据", lambda token: agent_analysis.main(token=token)))
+    render_refresh("agent_analysis_refresh", steps)
     
     # 加载最新数据
-    result = load_latest_analysis()
+    with timed("加载结果"):
+        result = load_latest_analysis()
+    
+    # 预览之后完整刷新还没有完成时，先显示预览
+    with timed("快速预览"):
+        preview_df = load_latest_preview(result[1] if result is not None else None)
+        if preview_df is not None:
+            st.header("快速预览")
+            render_preview(preview_df)
+    
     if result is None:
-        st.warning("未找到分析数据，请点击刷新按钮更新数据。")
+        if preview_df is None:
+            st.warning("未找到分析数据，请点击刷新按钮更新数据。")
         return
         
-    df, filename = result
+    df, filename, version = result
     
     # 显示最后更新时间
     st.info(f"最后更新时间: {filename.split('_')[2].split('.')[0]}")
     
     # 数据概览
-    st.header("数据概览")
-    col1, col2, col3 = st.columns(3)
-    with col1:
-        st.metric("总代理数", len(df))
-    with col2:
-        st.metric("总用户数", df["总用户数"].sum())
-    with col3:
-        st.metric("总充值金额", f"¥{df['总充值金额'].sum():,.2f}")
+    with timed("数据概览"):
+        st.header("数据概览")
+        col1, col2, col3 = st.columns(3)
+        with col1:
+            st.metric("总代理数", len(df))
+        with col2:
+            st.metric("总用户数", df["总用户数"].sum())
+        with col3:
+            st.metric("总充值金额", f"¥{df['总充值金额'].sum():,.2f}")
+    
+    # 跨数据库去重汇总
+    with timed("去重汇总"):
+        st.header("跨数据库去重汇总")
+        render_distinct_rollup(filename, df, version)
+    
+    # 与前一天相比的变化
+    with timed("与昨日相比"):
+        st.header("与昨日相比的变化")
+        render_changes(filename, version)
     
     # 代理商筛选
     st.header("代理商详情")
     agent_filter = st.text_input("🔍 搜索代理商", "")
+    positions = None
     if agent_filter:
-        df = df[df["username"].str.contains(agent_filter, case=False, na=False)]
-    
+        with timed("搜索"):
+            # 使用按结果版本预先构建的索引，匹配代理商名称或ID
+            index = page_data.search(df, version, page_data.AGENT_SEARCH_COLUMNS)
+            positions = index.search(agent_filter)
+
     # 排序选项
-    sort_col = st.selectbox(
-        "排序依据",
-        ["总用户数", "总充值金额", "付费用户数", "游戏玩家数", "活跃天数"],
-        index=0
-    )
-    df = df.sort_values(sort_col, ascending=False)
-    
+    sort_col = st.selectbox("排序依据", page_data.AGENT_SORT_OPTIONS, index=0)
+
+    # 按结果版本缓存的排序置换，与搜索结果组合得到显示顺序
+    with timed("排序"):
+        sort_index = page_data.sort_index(df, version, page_data.AGENT_SORT_OPTIONS)
+        order = sort_index.order(sort_col, positions)
+
+    # 分页，只渲染当前页
+    col1, col2 = st.columns(2)
+    with col1:
+        page_size = st.selectbox("每页行数", table_view.PAGE_SIZES, index=1)
+    total_pages = table_view.page_count(len(order), page_size)
+    with col2:
+        page = st.number_input(f"页码（共 {total_pages} 页）", min_value=1, max_value=total_pages, value=1)
+    page_rows = table_view.page_rows(order, page, page_size)
+    st.caption(f"共 {len(order)} 条记录，当前第 {page}/{total_pages} 页")
+
     # 显示详细数据
-    st.dataframe(
-        df,
-        column_config={
-            "username": "代理商名称",
-            "总用户数": st.column_config.NumberColumn(format="%d"),
-            "总充值金额": st.column_config.NumberColumn(format="¥%.2f"),
-            "付费率": st.column_config.TextColumn(),
-            "人均充值": st.column_config.NumberColumn(format="¥%.2f"),
-            "活跃天数": st.column_config.NumberColumn(format="%d")
-        },
-        hide_index=True
-    )
+    with timed("详细表格"):
+        st.dataframe(
+            track_payload("详细表格", df.iloc[page_rows]),
+            column_config={
+                "username": "代理商名称",
+                "总用户数": st.column_config.NumberColumn(format="%d"),
+                "总充值金额": st.column_config.NumberColumn(format="¥%.2f"),
+                "付费率": st.column_config.TextColumn(),
+                "人均充值": st.column_config.NumberColumn(format="¥%.2f"),
+                "活跃天数": st.column_config.NumberColumn(format="%d")
+            },
+            hide_index=True
+        )
     
-    # 下载数据
-    st.download_button(
-        "📥 下载数据",
-        df.to_csv(index=False).encode("utf-8"),
-        "agent_analysis.csv",
-        "text/csv",
-        key='download-csv'
-    )
+    # 下载数据（筛选和排序后的全部行，按需生成并缓存）
+    with timed("导出"):
+        render_export(
+            lambda: df.iloc[order],
+            version,
+            f"{agent_filter}\x00{sort_col}",
+            "agent_analysis",
+            key="download"
+        )
 
 if __name__ == "__main__":
     main() 
\ No newline at end of file
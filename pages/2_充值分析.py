@@ -2,9 +2,7 @@ import streamlit as st
 import pandas as pd
 import sys
 from pathlib import Path
-import importlib.util
 from datetime import datetime
-import plotly.express as px
 
 # 设置页面配置
 st.set_page_config(
@@ -13,151 +11,249 @@ st.set_page_config(
     layout="wide"
 )
 
-# 添加项目根目录到系统路径
+# 添加项目根目录到系统路径（页面每次重跑都会执行，避免重复添加）
 project_root = Path(__file__).parent.parent
-sys.path.append(str(project_root))
+if str(project_root) not in sys.path:
+    sys.path.append(str(project_root))
 
 # 导入配置
-from config import capture_output
+from config import format_estimate, latest_preview, load_script_module, render_export, render_refresh, timed, timed_page, track_payload
 
-# 动态导入accumulate_recharge模块
-recharge_analysis_path = project_root / "scripts" / "accumulate_recharge.py"
-spec = importlib.util.spec_from_file_location("accumulate_recharge", recharge_analysis_path)
-accumulate_recharge = importlib.util.module_from_spec(spec)
-spec.loader.exec_module(accumulate_recharge)
+# 加载accumulate_recharge模块（按进程缓存，重跑时不再重新执行）
+accumulate_recharge = load_script_module("accumulate_recharge")
+result_cache = load_script_module("result_cache")
+page_data = load_script_module("page_data")
+table_view = load_script_module("table_view")
+downsample = load_script_module("downsample")
+hll = load_script_module("hll")
+sampling = load_script_module("sampling")
 
 def load_latest_recharge():
     """加载最新的充值分析结果"""
     try:
-        output_dir = project_root / "data" / "merged_data"
-        output_dir.mkdir(parents=True, exist_ok=True)
-        files = list(output_dir.glob("agent_recharge_analysis_*.csv"))
-        if not files:
-            return None
-            
-        latest_file = max(files, key=lambda x: x.stat().st_mtime)
-        df = pd.read_csv(latest_file)
-        return df, latest_file.name
+        # 同一版本的结果文件只解析一次，所有会话共享（启动预热时已加载）
+        return page_data.latest_result("agent_recharge_analysis_*.csv")
     except Exception as e:
         st.error(f"加载数据失败: {str(e)}")
-        return None, None
+        return None
 
-def plot_recharge_trend(df):
-    """绘制充值趋势图"""
-    df['注册日期'] = pd.to_datetime(df['注册日期'])
-    daily_stats = df.groupby('注册日期').agg({
-        '累积充值_3天': 'sum',
-        '累积充值_7天': 'sum',
-        '累积充值_15天': 'sum',
-        '累积充值_30天': 'sum',
-        '注册人数': 'sum'
-    }).reset_index()
+def plot_recharge_trend(daily_stats):
+    """绘制充值趋势图（长时间序列降采样到固定点数）"""
+    # plotly较重，只在绘图时才导入
+    import plotly.express as px
     
-    # 计算人均充值
-    for period in [3, 7, 15, 30]:
-        daily_stats[f'{period}天人均充值'] = daily_stats[f'累积充值_{period}天'] / daily_stats['注册人数']
+    y_columns = [f'{period}天人均充值' for period in accumulate_recharge.TREND_PERIODS]
+    chart_data = downsample.downsample_frame(daily_stats, '注册日期', y_columns)
     
     # 创建趋势图
     fig = px.line(
-        daily_stats,
+        chart_data,
         x='注册日期',
-        y=['3天人均充值', '7天人均充值', '15天人均充值', '30天人均充值'],
+        y=y_columns,
         title='各时间段人均充值趋势',
         labels={'value': '人均充值金额', 'variable': '时间段'}
     )
     return fig
 
+def load_latest_preview(filename):
+    """比完整结果更新的抽样预览结果，没有时返回None"""
+    output_dir = project_root / "data" / "merged_data"
+    exact_file = output_dir / filename if filename else None
+    preview_file = latest_preview(output_dir, "preview_agent_recharge_analysis_*.csv", exact_file)
+    if preview_file is None:
+        return None
+    df, _ = result_cache.load_result(preview_file)
+    return df
+
+def render_preview(df):
+    """抽样预览：估计值带置信区间，完整结果生成后不再显示"""
+    st.warning("以下为抽样预览的估计值（± 为置信区间半宽），完整结果生成后自动替换。")
+    col1, col2, col3 = st.columns(3)
+    with col1:
+        st.metric("总注册人数", format_estimate(df["注册人数"].sum(), sampling.combine_errors(df["注册人数_误差"])))
+    with col2:
+        st.metric(
+            "总充值金额",
+            format_estimate(df["累积充值_total"].sum(), sampling.combine_errors(df["累积充值_total_误差"]), prefix="¥")
+        )
+    with col3:
+        st.metric("充值用户累积", format_estimate(df["充值用户累积"].sum(), sampling.combine_errors(df["充值用户累积_误差"])))
+    st.dataframe(
+        track_payload("预览表格", df[[
+            "agent_username", "注册日期", "注册人数", "注册人数_误差", "充值用户累积", "充值用户累积_误差",
+            "累积充值_total", "累积充值_total_误差", "总充值ARPU"
+        ]]),
+        column_config={
+            "agent_username": "代理商名称",
+            "累积充值_total": st.column_config.NumberColumn(format="¥%.2f"),
+            "累积充值_total_误差": st.column_config.NumberColumn(format="±%.2f"),
+            "总充值ARPU": st.column_config.NumberColumn(format="¥%.2f")
+        },
+        hide_index=True
+    )
+
+def render_cohort_range(df, version, sketches=None):
+    """按注册日期区间汇总每个代理的注册人数、累积充值和人均指标（基于前缀和索引）"""
+    cohort = page_data.cohorts(df, version)
+    if cohort.min_date is None:
+        return
+    
+    date_range = st.date_input(
+        "注册日期区间",
+        value=(cohort.min_date.date(), cohort.max_date.date()),
+        min_value=cohort.min_date.date(),
+        max_value=cohort.max_date.date()
+    )
+    if not isinstance(date_range, (tuple, list)) or len(date_range) != 2:
+        st.info("请选择区间的结束日期")
+        return
+    
+    range_df = cohort.range_totals(*date_range)
+    col1, col2, col3, col4 = st.columns(4)
+    with col1:
+        st.metric("区间注册人数", int(range_df["注册人数"].sum()))
+    with col2:
+        st.metric("区间累积充值", f"¥{range_df['累积充值_total'].sum():,.2f}")
+    with col3:
+        total_users = range_df["注册人数"].sum()
+        st.metric("区间30天ARPU", f"¥{range_df['累积充值_30天'].sum() / total_users:.2f}" if total_users > 0 else "¥0.00")
+    with col4:
+        # 合并区间内各注册批次的草图，得到去重后的充值用户数
+        if sketches is not None and not sketches.empty:
+            start, end = pd.Timestamp(date_range[0]), pd.Timestamp(date_range[1])
+            in_range = sketches[(sketches["注册日期"] >= start) & (sketches["注册日期"] <= end)]
+            totals = hll.rollup(in_range[in_range["metric"] == "充值用户累积"])
+            paying = int(totals["充值用户累积"].iloc[0]) if "充值用户累积" in totals.columns else 0
+            st.metric("区间充值用户（去重）", f"≈{paying:,}")
+    
+    st.dataframe(
+        track_payload("区间汇总表格", range_df.sort_values("注册人数", ascending=False)),
+        column_config={
+            "agent_username": "代理商名称",
+            "注册人数": st.column_config.NumberColumn(format="%d"),
+            "累积充值_total": st.column_config.NumberColumn(format="¥%.2f"),
+            "30天ARPU": st.column_config.NumberColumn(format="¥%.2f"),
+            "30天ARPPU": st.column_config.NumberColumn(format="¥%.2f"),
+            "充值率累积": st.column_config.NumberColumn(format="%.2f%%")
+        },
+        hide_index=True
+    )
+
+@timed_page("充值分析")
 def main():
     st.title("💰 充值分析")
     
-    # 创建日志容器
-    log_container = st.empty()
-    
-    # 添加刷新按钮
-    if st.button("🔄 刷新数据"):
-        with st.spinner("正在更新数据..."):
-            try:
-                # 创建进度显示区域
-                progress_container = st.empty()
-                progress_container.info("开始更新数据...")
-                
-                # 捕获并显示日志
-                with capture_output(log_container):
-                    accumulate_recharge.main()
-                    
-                progress_container.success("数据更新成功！")
-            except Exception as e:
-                progress_container.error(f"数据更新失败: {str(e)}")
-                return
+    # 刷新数据：在后台执行，执行期间显示进度并可取消
+    quick_preview = st.checkbox("先生成快速预览", value=True, help="先抽样估计各注册批次的指标（几秒内完成），再进行完整刷新")
+    steps = []
+    if quick_preview:
+        steps.append(("正在生成快速预览", lambda token: accumulate_recharge.main(preview=True, token=token)))
+    steps.append(("正在更新数据", lambda token: accumulate_recharge.main(token=token)))
+    render_refresh("accumulate_recharge_refresh", steps)
     
     # 加载最新数据
-    result = load_latest_recharge()
+    with timed("加载结果"):
+        result = load_latest_recharge()
+    
+    # 预览之后完整刷新还没有完成时，先显示预览
+    with timed("快速预览"):
+        preview_df = load_latest_preview(result[1] if result is not None else None)
+        if preview_df is not None:
+            st.header("快速预览")
+            render_preview(preview_df)
+    
     if result is None:
-        st.warning("未找到分析数据，请点击刷新按钮更新数据。")
+        if preview_df is None:
+            st.warning("未找到分析数据，请点击刷新按钮更新数据。")
         return
         
-    df, filename = result
+    df, filename, version = result
     
     # 显示最后更新时间
     st.info(f"最后更新时间: {filename.split('_')[3].split('.')[0]}")
     
     # 数据概览
-    st.header("数据概览")
-    col1, col2, col3, col4 = st.columns(4)
-    
-    with col1:
-        st.metric("总注册人数", df["注册人数"].sum())
-    with col2:
-        total_recharge = df["累积充值_total"].sum()
-        st.metric("总充值金额", f"¥{total_recharge:,.2f}")
-    with col3:
-        avg_recharge = total_recharge / df["注册人数"].sum() if df["注册人数"].sum() > 0 else 0
-        st.metric("整体人均充值", f"¥{avg_recharge:.2f}")
-    with col4:
-        paying_users = df[df["付费用户数_30天"] > 0]["付费用户数_30天"].sum()
-        st.metric("30天付费用户数", paying_users)
+    with timed("数据概览"):
+        st.header("数据概览")
+        col1, col2, col3, col4 = st.columns(4)
+        
+        with col1:
+            st.metric("总注册人数", df["注册人数"].sum())
+        with col2:
+            total_recharge = df["累积充值_total"].sum()
+            st.metric("总充值金额", f"¥{total_recharge:,.2f}")
+        with col3:
+            avg_recharge = total_recharge / df["注册人数"].sum() if df["注册人数"].sum() > 0 else 0
+            st.metric("整体人均充值", f"¥{avg_recharge:.2f}")
+        with col4:
+            paying_users = df[df["付费用户数_30天"] > 0]["付费用户数_30天"].sum()
+            st.metric("30天付费用户数", paying_users)
     
     # 充值趋势分析
     st.header("充值趋势分析")
-    trend_fig = plot_recharge_trend(df)
-    st.plotly_chart(trend_fig, use_container_width=True)
+    with timed("趋势数据"):
+        daily_stats = page_data.daily_trend(filename, df, version)
+    with timed("趋势图"):
+        trend_fig = track_payload("趋势图", plot_recharge_trend(daily_stats))
+        st.plotly_chart(trend_fig, use_container_width=True)
+    
+    # 注册日期区间汇总
+    with timed("区间汇总"):
+        st.header("注册日期区间汇总")
+        render_cohort_range(df, version, page_data.load_sketches(filename))
     
     # 代理商筛选
     st.header("代理商详情")
     agent_filter = st.text_input("🔍 搜索代理商", "")
+    positions = None
     if agent_filter:
-        df = df[df["agent_username"].str.contains(agent_filter, case=False, na=False)]
-    
+        with timed("搜索"):
+            # 使用按结果版本预先构建的索引，匹配代理商名称或ID
+            index = page_data.search(df, version, page_data.RECHARGE_SEARCH_COLUMNS)
+            positions = index.search(agent_filter)
+
     # 排序选项
-    sort_col = st.selectbox(
-        "排序依据",
-        ["注册人数", "累积充值_total", "付费用户数_30天", "30天ARPU", "30天ARPPU"],
-        index=0
-    )
-    df = df.sort_values(sort_col, ascending=False)
-    
+    sort_col = st.selectbox("排序依据", page_data.RECHARGE_SORT_OPTIONS, index=0)
+
+    # 按结果版本缓存的排序置换，与搜索结果组合得到显示顺序
+    with timed("排序"):
+        sort_index = page_data.sort_index(df, version, page_data.RECHARGE_SORT_OPTIONS)
+        order = sort_index.order(sort_col, positions)
+
+    # 分页，只渲染当前页
+    col1, col2 = st.columns(2)
+    with col1:
+        page_size = st.selectbox("每页行数", table_view.PAGE_SIZES, index=1)
+    total_pages = table_view.page_count(len(order), page_size)
+    with col2:
+        page = st.number_input(f"页码（共 {total_pages} 页）", min_value=1, max_value=total_pages, value=1)
+    page_rows = table_view.page_rows(order, page, page_size)
+    st.caption(f"共 {len(order)} 条记录，当前第 {page}/{total_pages} 页")
+
     # 显示详细数据
-    st.dataframe(
-        df,
-        column_config={
-            "agent_username": "代理商名称",
-            "注册人数": st.column_config.NumberColumn(format="%d"),
-            "累积充值_total": st.column_config.NumberColumn(format="¥%.2f"),
-            "30天ARPU": st.column_config.NumberColumn(format="¥%.2f"),
-            "30天ARPPU": st.column_config.NumberColumn(format="¥%.2f"),
-            "付费用户数_30天": st.column_config.NumberColumn(format="%d")
-        },
-        hide_index=True
-    )
+    with timed("详细表格"):
+        st.dataframe(
+            track_payload("详细表格", df.iloc[page_rows]),
+            column_config={
+                "agent_username": "代理商名称",
+                "注册人数": st.column_config.NumberColumn(format="%d"),
+                "累积充值_total": st.column_config.NumberColumn(format="¥%.2f"),
+                "30天ARPU": st.column_config.NumberColumn(format="¥%.2f"),
+                "30天ARPPU": st.column_config.NumberColumn(format="¥%.2f"),
+                "付费用户数_30天": st.column_config.NumberColumn(format="%d")
+            },
+            hide_index=True
+        )
     
-    # 下载数据
-    st.download_button(
-        "📥 下载数据",
-        df.to_csv(index=False).encode("utf-8"),
-        "recharge_analysis.csv",
-        "text/csv",
-        key='download-csv'
-    )
+    # 下载数据（筛选和排序后的全部行，按需生成并缓存）
+    with timed("导出"):
+        render_export(
+            lambda: df.iloc[order],
+            version,
+            f"{agent_filter}\x00{sort_col}",
+            "recharge_analysis",
+            key="download"
+        )
 
 if __name__ == "__main__":
     main() 
\ No newline at end of file
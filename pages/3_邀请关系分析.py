@@ -2,10 +2,7 @@ import streamlit as st
 import pandas as pd
 import sys
 from pathlib import Path
-import importlib.util
 from datetime import datetime
-import networkx as nx
-import plotly.graph_objects as go
 
 # 设置页面配置
 st.set_page_config(
@@ -14,58 +11,93 @@ st.set_page_config(
     layout="wide"
 )
 
-# 添加项目根目录到系统路径
+# 添加项目根目录到系统路径（页面每次重跑都会执行，避免重复添加）
 project_root = Path(__file__).parent.parent
-sys.path.append(str(project_root))
+if str(project_root) not in sys.path:
+    sys.path.append(str(project_root))
 
 # 导入配置
-from config import capture_output
+from config import load_config, load_script_module, render_refresh, timed, timed_page, track_payload
 
-# 动态导入invite_tree模块
-invite_tree_path = project_root / "scripts" / "invite_tree.py"
-spec = importlib.util.spec_from_file_location("invite_tree", invite_tree_path)
-invite_tree = importlib.util.module_from_spec(spec)
-spec.loader.exec_module(invite_tree)
+# 加载invite_tree模块（按进程缓存，重跑时不再重新执行）
+invite_tree = load_script_module("invite_tree")
+page_data = load_script_module("page_data")
 
 def load_invite_data():
-    """加载邀请关系数据"""
+    """加载邀请关系数据（同一版本只解析一次，启动预热时已加载）"""
     try:
-        output_dir = project_root / "data" / "merged_data"
-        output_dir.mkdir(parents=True, exist_ok=True)
-        files = list(output_dir.glob("invite_tree_*.csv"))
-        if not files:
-            return None
-            
-        latest_file = max(files, key=lambda x: x.stat().st_mtime)
-        df = pd.read_csv(latest_file)
-        return df, latest_file.name
+        return page_data.latest_result("invite_tree_*.csv")
     except Exception as e:
         st.error(f"加载数据失败: {str(e)}")
-        return None, None
+        return None
 
-def create_invite_network(df, max_depth=3):
-    """创建邀请关系网络图"""
-    G = nx.DiGraph()
-    
-    # 添加节点和边
-    for _, row in df.iterrows():
-        inviter = row['inviter_user_id']
-        invitee = row['user_id']
-        depth = row['depth'] if 'depth' in df.columns else 1
-        
-        if depth <= max_depth:
-            G.add_node(inviter, size=10)
-            G.add_node(invitee, size=5)
-            G.add_edge(inviter, invitee)
-    
-    # 使用spring_layout布局
-    pos = nx.spring_layout(G)
+def load_agent_names():
+    """代理ID -> 代理名称（取自最新的代理商分析结果，没有时为空）"""
+    result = page_data.latest_result("agent_analysis_*.csv")
+    if result is None:
+        return {}
+    agent_df, _, agent_version = result
+    return page_data.agent_names(agent_df, agent_version)
+
+def select_scope(df, version, config):
+    """
+    网络图的查看范围：全部、某个代理的用户或以某个用户为根的下线
+    返回 (范围是否已选定, agent_id, root_user_id)
+    """
+    col1, col2 = st.columns(2)
+    with col1:
+        scope = st.radio("查看范围", ["全部", "按代理", "按根用户"], horizontal=True)
+    with col2:
+        if scope == "按代理":
+            _, agents = page_data.invite_index(df, version, config)
+            if not agents:
+                st.info("代理商分析的用户明细中没有出现在邀请关系中的用户，请先刷新代理商分析数据。")
+                return False, None, None
+            names = load_agent_names()
+            agent_id = st.selectbox(
+                "代理商",
+                list(agents),
+                format_func=lambda x: f"{names.get(x, x)} ({x})，{len(agents[x])} 人"
+            )
+            return True, agent_id, None
+        if scope == "按根用户":
+            text = st.text_input("根用户ID", "").strip()
+            if not text:
+                st.info("输入用户ID后显示该用户的下线")
+                return False, None, None
+            try:
+                return True, None, int(float(text))
+            except ValueError:
+                st.warning("请输入数字用户ID")
+                return False, None, None
+    return True, None, None
+
+def create_invite_network(df, version, max_depth=3, agent_id=None, root_user_id=None, config=None):
+    """创建邀请关系网络图（根用户不在邀请关系中时返回None）"""
+    # plotly较重，只在绘制网络图时才导入
+    import plotly.graph_objects as go
+    
+    # 子图由索引按需提取，图结构和spring_layout布局按结果版本、深度和范围缓存（默认视图在启动预热时已计算）
+    with timed("网络图布局"):
+        layout = page_data.invite_layout(df, version, max_depth, agent_id, root_user_id, config)
+    if layout is None:
+        return None
+    G, pos = layout
+    
+    # 节点和边的坐标先收集成列表再一次性创建跟踪（逐个追加到跟踪中每次都会复制并校验整个数组）
+    nodes = list(G.nodes())
+    edge_x, edge_y = [], []
+    for source, target in G.edges():
+        x0, y0 = pos[source]
+        x1, y1 = pos[target]
+        edge_x += [x0, x1, None]
+        edge_y += [y0, y1, None]
     
     # 创建节点跟踪
     node_trace = go.Scatter(
-        x=[],
-        y=[],
-        text=[],
+        x=[pos[node][0] for node in nodes],
+        y=[pos[node][1] for node in nodes],
+        text=[f'用户ID: {node}<br>邀请数: {G.out_degree(node)}' for node in nodes],
         mode='markers',
         hoverinfo='text',
         marker=dict(
@@ -74,36 +106,21 @@ def create_invite_network(df, max_depth=3):
             size=10,
             colorbar=dict(
                 thickness=15,
-                title='节点连接数',
-                xanchor='left',
-                titleside='right'
+                title=dict(text='节点连接数', side='right'),
+                xanchor='left'
             )
         )
     )
     
-    # 添加节点位置
-    for node in G.nodes():
-        x, y = pos[node]
-        node_trace['x'] += tuple([x])
-        node_trace['y'] += tuple([y])
-        node_trace['text'] += tuple([f'用户ID: {node}<br>邀请数: {len(list(G.neighbors(node)))}'])
-    
     # 创建边跟踪
     edge_trace = go.Scatter(
-        x=[],
-        y=[],
+        x=edge_x,
+        y=edge_y,
         line=dict(width=0.5, color='#888'),
         hoverinfo='none',
         mode='lines'
     )
     
-    # 添加边
-    for edge in G.edges():
-        x0, y0 = pos[edge[0]]
-        x1, y1 = pos[edge[1]]
-        edge_trace['x'] += tuple([x0, x1, None])
-        edge_trace['y'] += tuple([y0, y1, None])
-    
     # 创建图形
     fig = go.Figure(data=[edge_trace, node_trace],
                    layout=go.Layout(
@@ -117,75 +134,80 @@ def create_invite_network(df, max_depth=3):
     
     return fig
 
+@timed_page("邀请关系分析")
 def main():
     st.title("🤝 邀请关系分析")
     
-    # 添加刷新按钮
-    if st.button("🔄 刷新数据"):
-        with st.spinner("正在更新数据..."):
-            try:
-                invite_tree.main()
-                st.success("数据更新成功！")
-            except Exception as e:
-                st.error(f"数据更新失败: {str(e)}")
-                return
+    # 刷新数据：在后台执行，执行期间显示进度并可取消
+    render_refresh("invite_tree_refresh", [("正在更新数据", lambda token: invite_tree.main(token=token))])
     
     # 加载最新数据
-    result = load_invite_data()
+    with timed("加载结果"):
+        result = load_invite_data()
     if result is None:
         st.warning("未找到分析数据，请点击刷新按钮更新数据。")
         return
         
-    df, filename = result
+    df, filename, version = result
     
     # 显示最后更新时间
     st.info(f"最后更新时间: {filename.split('_')[2].split('.')[0]}")
     
     # 数据概览
-    st.header("数据概览")
-    col1, col2, col3 = st.columns(3)
-    
-    with col1:
-        total_inviters = df['inviter_user_id'].nunique()
-        st.metric("总邀请人数", total_inviters)
-    with col2:
-        total_invitees = df['user_id'].nunique()
-        st.metric("总被邀请人数", total_invitees)
-    with col3:
-        avg_invites = len(df) / total_inviters if total_inviters > 0 else 0
-        st.metric("平均邀请人数", f"{avg_invites:.2f}")
+    with timed("数据概览"):
+        st.header("数据概览")
+        col1, col2, col3 = st.columns(3)
+        
+        with col1:
+            total_inviters = df['inviter_user_id'].nunique()
+            st.metric("总邀请人数", total_inviters)
+        with col2:
+            total_invitees = df['user_id'].nunique()
+            st.metric("总被邀请人数", total_invitees)
+        with col3:
+            avg_invites = len(df) / total_inviters if total_inviters > 0 else 0
+            st.metric("平均邀请人数", f"{avg_invites:.2f}")
     
     # 邀请关系网络图
     st.header("邀请关系网络图")
-    depth = st.slider("选择显示深度", 1, 5, 3)
-    network_fig = create_invite_network(df, max_depth=depth)
-    st.plotly_chart(network_fig, use_container_width=True)
-    
-    # 邀请者排行
-    st.header("邀请者排行")
-    top_inviters = df.groupby('inviter_user_id').agg({
-        'user_id': 'count',
-    }).reset_index()
-    top_inviters.columns = ['邀请者ID', '邀请人数']
-    top_inviters = top_inviters.sort_values('邀请人数', ascending=False)
-    
-    st.dataframe(
-        top_inviters.head(20),
-        column_config={
-            "邀请者ID": st.column_config.TextColumn(),
-            "邀请人数": st.column_config.NumberColumn(format="%d")
-        },
-        hide_index=True
-    )
+    config = load_config()
+    selected, agent_id, root_user_id = select_scope(df, version, config)
+    depth = st.slider("选择显示深度", 1, 5, page_data.DEFAULT_INVITE_DEPTH)
+    if selected:
+        with timed("网络图"):
+            network_fig = create_invite_network(df, version, depth, agent_id, root_user_id, config)
+            if network_fig is None:
+                st.warning(f"用户 {root_user_id} 不在邀请关系中")
+            elif not network_fig.data[1].x:
+                st.info("所选范围内没有邀请关系")
+            else:
+                st.plotly_chart(track_payload("网络图", network_fig), use_container_width=True)
+    
+    # 邀请者排行：直接邀请人数和各级下线的人数、付费用户数、充值金额（优先使用刷新时预先计算的结果）
+    with timed("邀请者排行"):
+        st.header("邀请者排行")
+        top_inviters = page_data.inviter_stats(filename, df, version, config)
+        sort_col = st.selectbox("排行依据", list(top_inviters.columns[1:]), index=0)
+        column_config = {"邀请者ID": st.column_config.TextColumn()}
+        for col in top_inviters.columns[1:]:
+            column_config[col] = st.column_config.NumberColumn(format="¥%.2f" if col.endswith("充值金额") else "%d")
+        
+        st.dataframe(
+            track_payload("邀请者排行", top_inviters.sort_values(sort_col, ascending=False, kind="stable").head(20)),
+            column_config=column_config,
+            hide_index=True
+        )
     
     # 下载数据
-    st.download_button(
-        "📥 下载数据",
-        df.to_csv(index=False).encode("utf-8"),
-        "invite_analysis.csv",
-        "text/csv",
-        key='download-csv'
-    )
+    with timed("下载数据"):
+        csv_bytes = track_payload("下载数据", df.to_csv(index=False).encode("utf-8"))
+        st.download_button(
+            "📥 下载数据",
+            csv_bytes,
+            "invite_analysis.csv",
+            "text/csv",
+            key='download-csv'
+        )
 
 if __name__ == "__main__":
     main() 
\ No newline at end of file
@@ -0,0 +1,131 @@
+import streamlit as st
+import pandas as pd
+import sys
+from pathlib import Path
+
+# 设置页面配置
+st.set_page_config(
+    page_title="代理商详情",
+    page_icon="🔎",
+    layout="wide"
+)
+
+# 添加项目根目录到系统路径（页面每次重跑都会执行，避免重复添加）
+project_root = Path(__file__).parent.parent
+if str(project_root) not in sys.path:
+    sys.path.append(str(project_root))
+
+# 导入配置
+from config import load_config, load_script_module, timed, timed_page, track_payload
+
+# 加载模块（按进程缓存，重跑时不再重新执行）
+page_data = load_script_module("page_data")
+agent_partitions = load_script_module("agent_partitions")
+
+def load_latest_analysis():
+    """加载最新的代理商分析结果（用于选择代理）"""
+    try:
+        result = page_data.latest_result("agent_analysis_*.csv")
+        if result is None:
+            return None
+        df, _, version = result
+        return df, version
+    except Exception as e:
+        st.error(f"加载数据失败: {str(e)}")
+        return None
+
+def plot_daily_charges(charges):
+    """绘制单个代理的每日充值"""
+    # plotly较重，只在绘图时才导入
+    import plotly.express as px
+
+    daily = charges.assign(充值日期=charges["created_at"].dt.date).groupby("充值日期").agg(
+        充值金额=("real_amount", "sum"),
+        付费用户数=("user_id", "nunique")
+    ).reset_index()
+    fig = px.bar(daily, x="充值日期", y="充值金额", hover_data=["付费用户数"], title="每日充值金额")
+    return fig, daily
+
+@timed_page("代理商详情")
+def main():
+    st.title("🔎 代理商详情")
+
+    with timed("加载结果"):
+        result = load_latest_analysis()
+    if result is None:
+        st.warning("未找到分析数据，请先在代理商分析页面刷新数据。")
+        return
+    df, version = result
+
+    config = load_config()
+    if agent_partitions.get_version(config) is None:
+        st.warning("未找到代理明细数据，请先在代理商分析页面刷新数据。")
+        return
+
+    # 选择代理
+    options = page_data.agent_options(df, version)
+    agent_id = st.selectbox("选择代理商", list(options), format_func=lambda x: options[x])
+    if agent_id is None:
+        return
+
+    # 只读取该代理的明细（按agent_id谓词下推，跳过其他代理的行组）
+    with timed("读取代理明细"):
+        users = agent_partitions.read_agent("users", agent_id, config)
+        charges = agent_partitions.read_agent("charges", agent_id, config)
+    if users is None or users.empty:
+        st.info("该代理没有用户明细")
+        return
+
+    # 概览
+    with timed("概览"):
+        col1, col2, col3, col4 = st.columns(4)
+        with col1:
+            st.metric("总用户数", users.groupby("db_id")["user_id"].nunique().sum())
+        with col2:
+            total_charge = charges["real_amount"].sum() if charges is not None else 0
+            st.metric("总充值金额", f"¥{total_charge:,.2f}")
+        with col3:
+            paying = 0
+            if charges is not None and not charges.empty:
+                per_user = charges.groupby(["db_id", "user_id"])["real_amount"].sum()
+                paying = int((per_user > 0).sum())
+            st.metric("付费用户数", paying)
+        with col4:
+            st.metric("游戏玩家数", int((users["game_count"] > 5).sum()))
+
+    tab1, tab2, tab3 = st.tabs(["📅 每日充值", "👥 用户明细", "🤝 邀请关系"])
+
+    with tab1, timed("每日充值"):
+        if charges is None or charges.empty:
+            st.info("该代理没有充值记录")
+        else:
+            fig, daily = plot_daily_charges(charges)
+            st.plotly_chart(track_payload("每日充值图", fig), use_container_width=True)
+            st.dataframe(track_payload("每日充值表格", daily), hide_index=True)
+
+    with tab2, timed("用户明细"):
+        st.dataframe(
+            track_payload("用户明细", users.drop(columns=["agent_id"])),
+            column_config={
+                "create_time": "注册日期",
+                "update_time": "更新日期",
+                "game_count": st.column_config.NumberColumn("游戏次数", format="%d")
+            },
+            hide_index=True
+        )
+
+    with tab3, timed("邀请关系"):
+        # 代理下每个邀请者直接邀请的人数
+        invited = users.dropna(subset=["inviter_user_id"])
+        invited = invited[invited["inviter_user_id"] != invited["user_id"]]
+        inviters = invited.groupby(["db_id", "inviter_user_id"])["user_id"].nunique().reset_index(name="邀请人数")
+        inviters = inviters.sort_values("邀请人数", ascending=False)
+        st.metric("有邀请的用户数", len(inviters))
+        st.dataframe(
+            track_payload("邀请者", inviters),
+            column_config={"inviter_user_id": st.column_config.NumberColumn("邀请者ID", format="%d")},
+            hide_index=True
+        )
+
+if __name__ == "__main__":
+    main()
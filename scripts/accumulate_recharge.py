@@ -1,82 +1,109 @@
 import os
-import subprocess
+import sys
+import numpy as np
 import pandas as pd
+from io import StringIO
+from pathlib import Path
 from datetime import datetime, timedelta
 
-def get_user_registration_data():
+# 添加项目根目录到系统路径
+project_root = Path(__file__).parent.parent.parent
+script_dir = project_root / "01_Script"
+sys.path.append(str(project_root))
+sys.path.append(str(script_dir))
+sys.path.append(str(Path(__file__).parent))
+from fetch_metabase import load_config
+import metabase_client
+import dimensions
+import local_store
+import checkpoint
+import hll
+import sampling
+import cancellation
+import engines
+import columnar
+
+# 分析结果的列顺序
+RESULT_COLUMNS = [
+    'agent_id', 'agent_username', '注册日期', '注册人数',
+    '累积充值_3天', '累积充值_7天', '累积充值_15天', '累积充值_30天', '累积充值_total',
+    '付费用户数_3天', '付费用户数_7天', '付费用户数_15天', '付费用户数_30天',
+    '3天ARPU', '7天ARPU', '15天ARPU', '30天ARPU', '总充值ARPU',
+    '3天ARPPU', '7天ARPPU', '15天ARPPU', '30天ARPPU', '总充值ARPPU',
+    '充值用户累积', '充值率累积', '过去天数'
+]
+
+# 趋势图的各时间窗口（天）
+TREND_PERIODS = [3, 7, 15, 30]
+
+def query_user_registration(metabase, db_id, sample=""):
     """
-    获取用户注册信息（2024-11-01 之后注册）
+    查询用户注册信息（2024-11-01 之后注册），返回CSV文本
     - tg_user表：user_id, agent_id, create_time
-    - admin_user表：admin_user_id, username（代理名称）
+    代理名称不在库端关联，由 get_user_registration_data 通过代理维度表在本地映射
+    sample 为预览模式的抽样条件（作用于 tg_user t）
     """
     # SQL 查询：获取 2024-11-01 之后注册的用户
-    sql = """SELECT 
+    sql = f"""SELECT 
         t.user_id, 
         CASE 
             WHEN t.agent_id IS NULL THEN '官方'
             ELSE t.agent_id 
         END as agent_id,
-        IFNULL(a.username, '未知代理') AS agent_username,
         DATE(t.create_time) AS registration_date
     FROM tg_user t
-    LEFT JOIN admin_user a 
-        ON t.agent_id = a.admin_user_id
-    WHERE t.create_time >= '2024-11-01'
+    WHERE t.create_time >= '2024-11-01' {sample}
     ORDER BY t.agent_id, t.create_time, t.user_id;
     """
 
-    temp_sql_file = '02_Query/temp_user_registration.sql'
-    os.makedirs('02_Query', exist_ok=True)
-    with open(temp_sql_file, 'w', encoding='utf-8') as f:
-        f.write(sql)
+    return metabase_client.query_csv(metabase, db_id, sql)
 
-    try:
-        # 运行 fetch_metabase.py
-        subprocess.run(['python', '01_Script/fetch_metabase.py', temp_sql_file, '1'], check=True)
-
-        # 获取 CSV
-        output_dir = '03_Data/merged_data'
-        files = [f for f in os.listdir(output_dir) if f.startswith('tg_user_') or f.startswith('user_')]
-        if not files:
-            raise Exception("未找到用户注册数据文件。")
-
-        latest_file = max(files, key=lambda x: os.path.getctime(os.path.join(output_dir, x)))
-        df_user = pd.read_csv(
-            os.path.join(output_dir, latest_file),
-            dtype={'agent_id': str, 'user_id': str},
-            encoding='utf-8'
-        )
+def agent_usernames(agent_ids, agents):
+    """代理ID -> 代理名称（等价于 LEFT JOIN admin_user 后 IFNULL(username, '未知代理')）"""
+    names = dimensions.attach_agents(agent_ids.to_frame('agent_id'), agents, columns=("username",))['username']
+    return names.astype(object).fillna('未知代理')
+
+def get_user_registration_data(metabase, db_id, query=query_user_registration, config=None):
+    """
+    获取用户注册信息并整理列
+    query 为数据来源（默认直接查询Metabase），批量任务用它传入共享拉取的数据
+    config 决定代理维度缓存的目录和探测间隔
+    """
+    csv_data = query(metabase, db_id)
+    if not csv_data:
+        raise Exception(f"数据库 {db_id} 未找到用户注册数据。")
 
-        # 删除临时 SQL
-        os.remove(temp_sql_file)
+    df_user = pd.read_csv(
+        StringIO(csv_data),
+        dtype={'agent_id': str, 'user_id': str}
+    )
 
-        # 基本检查
-        expected_cols = ['user_id', 'agent_id', 'agent_username', 'registration_date']
-        for col in expected_cols:
-            if col not in df_user.columns:
-                raise Exception(f"缺少必要列: {col}")
+    # 基本检查
+    expected_cols = ['user_id', 'agent_id', 'registration_date']
+    for col in expected_cols:
+        if col not in df_user.columns:
+            raise Exception(f"缺少必要列: {col}")
 
-        # 去除多余空格
-        df_user['user_id'] = df_user['user_id'].astype(str).str.strip()
-        df_user['agent_id'] = df_user['agent_id'].astype(str).str.strip()
+    # 去除多余空格
+    df_user['user_id'] = df_user['user_id'].astype(str).str.strip()
+    df_user['agent_id'] = df_user['agent_id'].astype(str).str.strip()
 
-        # 重命名列
-        df_user = df_user.rename(columns={'registration_date': '注册日期'})
+    # 代理名称：按代理ID从维度表映射（官方用户和找不到的代理为"未知代理"）
+    df_user['agent_username'] = agent_usernames(df_user['agent_id'], dimensions.get_admin_users(metabase, db_id, config))
+    df_user = df_user[['user_id', 'agent_id', 'agent_username', 'registration_date']]
 
-        # 打印部分用户注册数据以验证
-        print("\n示例用户注册数据:")
-        print(df_user.head())
+    # 重命名列
+    df_user = df_user.rename(columns={'registration_date': '注册日期'})
 
-        return df_user
+    # 打印部分用户注册数据以验证
+    print("\n示例用户注册数据:")
+    print(df_user.head())
 
-    except Exception as e:
-        if os.path.exists(temp_sql_file):
-            os.remove(temp_sql_file)
-        raise
+    return df_user
 
-def get_recharge_data():
+def query_recharge(metabase, db_id, sample=""):
     """
-    获取充值数据（2024-11-01 之后的订单），并计算 adjusted_amount
+    查询充值数据（2024-11-01 之后的订单），返回CSV文本，并计算 adjusted_amount
     规则：
     - status=1 才算成功
     - pay_type 为空时视为 0
@@ -84,9 +111,10 @@ def get_recharge_data():
     - pay_type=1 => amount / 50
     - pay_type 其他值按 0 处理
     - 只保留 status=1 的记录
-    - 添加 agent_username 列
+    - 带上用户的 agent_id，代理名称由 get_recharge_data 在本地映射
+    sample 为预览模式的抽样条件（作用于 tg_user t）
     """
-    sql = """SELECT 
+    sql = f"""SELECT 
         r.user_id AS user_id,
         DATE(r.create_time) AS recharge_date,
         COALESCE(r.pay_type, 0) AS pay_type,
@@ -97,78 +125,84 @@ def get_recharge_data():
             ELSE 0 
         END AS adjusted_amount,
         r.status,
-        IFNULL(a.username, '未知代理') AS agent_username
+        t.agent_id
     FROM game_charges r
     LEFT JOIN tg_user t ON r.user_id = t.user_id
-    LEFT JOIN admin_user a ON t.agent_id = a.admin_user_id
-    WHERE r.create_time >= '2024-11-01' AND r.status = 1
+    WHERE r.create_time >= '2024-11-01' AND r.status = 1 {sample}
     ORDER BY r.user_id, r.create_time;
     """
 
-    temp_sql_file = '02_Query/temp_agent_recharge.sql'
-    os.makedirs('02_Query', exist_ok=True)
-    with open(temp_sql_file, 'w', encoding='utf-8') as f:
-        f.write(sql)
-
-    try:
-        subprocess.run(['python', '01_Script/fetch_metabase.py', temp_sql_file, '1'], check=True)
-
-        output_dir = '03_Data/merged_data'
-        files = [f for f in os.listdir(output_dir) if f.startswith('game_charges_')]
-        if not files:
-            raise Exception("未找到充值数据文件。")
-
-        latest_file = max(files, key=lambda x: os.path.getctime(os.path.join(output_dir, x)))
-        df_recharge = pd.read_csv(
-            os.path.join(output_dir, latest_file),
-            dtype={'user_id': str},
-            encoding='utf-8'
-        )
-
-        # 删除临时 SQL
-        os.remove(temp_sql_file)
-
-        # 去除多余空格
-        df_recharge['user_id'] = df_recharge['user_id'].astype(str).str.strip()
-
-        # 重命名列
-        df_recharge = df_recharge.rename(columns={
-            'recharge_date': '充值日期',
-            'adjusted_amount': '调整后金额'
-        })
-
-        # 确保 'status' 是整数，1 表示成功
-        if df_recharge['status'].dtype == object:
-            # 处理不同形式的 TRUE/FALSE
-            df_recharge['status'] = df_recharge['status'].str.upper().map({'TRUE': 1, 'FALSE': 0})
-            df_recharge['status'] = pd.to_numeric(df_recharge['status'], errors='coerce').fillna(0).astype(int)
-        else:
-            df_recharge['status'] = df_recharge['status'].astype(int)
-
-        # 处理 pay_type 非 0/1 的情况，按 0 处理
-        df_recharge['pay_type'] = df_recharge['pay_type'].apply(lambda x: x if x in [0,1] else 0)
-
-        # 打印部分充值数据以验证
-        print("\n示例充值数据:")
-        print(df_recharge.head())
-
-        # 打印唯一的 pay_type 值以确认
-        print("\n充值数据中 pay_type 的唯一值:")
-        print(df_recharge['pay_type'].unique())
-
-        # 打印唯一的 status 值以确认
-        print("\n充值数据中 status 的唯一值:")
-        print(df_recharge['status'].unique())
-
-        return df_recharge
-
-    except Exception as e:
-        if os.path.exists(temp_sql_file):
-            os.remove(temp_sql_file)
-        raise
+    return metabase_client.query_csv(metabase, db_id, sql)
 
-def calculate_rolling_recharge(df_user, df_recharge):
+def get_recharge_data(metabase, db_id, query=query_recharge, config=None):
     """
+    获取充值数据并整理列
+    query 为数据来源（默认直接查询Metabase），批量任务用它传入共享拉取的数据
+    config 决定代理维度缓存的目录和探测间隔
+    """
+    csv_data = query(metabase, db_id)
+    if not csv_data:
+        raise Exception(f"数据库 {db_id} 未找到充值数据。")
+
+    df_recharge = pd.read_csv(
+        StringIO(csv_data),
+        dtype={'user_id': str}
+    )
+
+    # 去除多余空格
+    df_recharge['user_id'] = df_recharge['user_id'].astype(str).str.strip()
+
+    # 代理名称：按用户的代理ID从维度表映射
+    df_recharge['agent_username'] = agent_usernames(df_recharge['agent_id'], dimensions.get_admin_users(metabase, db_id, config))
+    df_recharge = df_recharge.drop(columns=['agent_id'])
+
+    # 重命名列
+    df_recharge = df_recharge.rename(columns={
+        'recharge_date': '充值日期',
+        'adjusted_amount': '调整后金额'
+    })
+
+    # 确保 'status' 是整数，1 表示成功
+    if df_recharge['status'].dtype == object:
+        # 处理不同形式的 TRUE/FALSE
+        df_recharge['status'] = df_recharge['status'].str.upper().map({'TRUE': 1, 'FALSE': 0})
+        df_recharge['status'] = pd.to_numeric(df_recharge['status'], errors='coerce').fillna(0).astype(int)
+    else:
+        df_recharge['status'] = df_recharge['status'].astype(int)
+
+    # 处理 pay_type 非 0/1 的情况，按 0 处理
+    df_recharge['pay_type'] = df_recharge['pay_type'].apply(lambda x: x if x in [0,1] else 0)
+
+    # 打印部分充值数据以验证
+    print("\n示例充值数据:")
+    print(df_recharge.head())
+
+    # 打印唯一的 pay_type 值以确认
+    print("\n充值数据中 pay_type 的唯一值:")
+    print(df_recharge['pay_type'].unique())
+
+    # 打印唯一的 status 值以确认
+    print("\n充值数据中 status 的唯一值:")
+    print(df_recharge['status'].unique())
+
+    return df_recharge
+
+def calculate_rolling_recharge(df_user, df_recharge, engine=engines.REFERENCE):
+    """
+    按（代理, 注册日期）聚合后计算人均等派生指标，口径见 aggregate_rolling
+    engine 为聚合使用的计算引擎（见 engines），默认为 pandas 参考实现；其他引擎出错时回退到参考实现
+    """
+    calculator = engines.get_engine(engine)
+    if calculator is not None:
+        try:
+            return finalize_rolling(calculator.rolling_recharge(df_user, df_recharge))
+        except Exception as e:
+            print(f"{engine} 引擎计算失败，改用 pandas 计算: {str(e)}")
+    return finalize_rolling(aggregate_rolling(df_user, df_recharge))
+
+def aggregate_rolling(df_user, df_recharge):
+    """
+    按（代理, 注册日期）聚合注册人数、累积充值、付费用户数、充值用户累积（派生指标由 finalize_rolling 计算）
     计算需求：
     1) 不要 total_orders, attempt_users, success_orders, success_user_rate 这类当天指标
     2) success = status=1
@@ -203,10 +237,12 @@ def calculate_rolling_recharge(df_user, df_recharge):
         # ---------------------------
         # 第三步：合并充值 & 注册信息，使用内连接
         # ---------------------------
+        # 多个数据库的用户ID可能重复，存在db_id时一并作为关联键
+        join_keys = ['db_id', 'user_id'] if 'db_id' in df_user.columns and 'db_id' in df_recharge.columns else ['user_id']
         merged = pd.merge(
             df_recharge,
-            df_user[['user_id', 'agent_id', 'agent_username', '注册日期']],
-            on=['user_id'],
+            df_user[join_keys + ['agent_id', 'agent_username', '注册日期']],
+            on=join_keys,
             how='inner',
             suffixes=('_charge', '')  # 保留df_user中的agent_username
         )
@@ -252,68 +288,311 @@ def calculate_rolling_recharge(df_user, df_recharge):
             how='left'
         ).fillna(0)
 
-        # ---------------------------
-        # 第七步：计算人均充值 / 付费人均充值
-        # ---------------------------
-        # 3/7/15/30 天人均充值 = 累积充值 / 注册人数
-        df_final['3天ARPU'] = (df_final['累积充值_3天'] / df_final['注册人数']).round(3).fillna(0)
-        df_final['7天ARPU'] = (df_final['累积充值_7天'] / df_final['注册人数']).round(3).fillna(0)
-        df_final['15天ARPU'] = (df_final['累积充值_15天'] / df_final['注册人数']).round(3).fillna(0)
-        df_final['30天ARPU'] = (df_final['累积充值_30天'] / df_final['注册人数']).round(3).fillna(0)
-        df_final['总充值ARPU'] = (df_final['累积充值_total'] / df_final['注册人数']).round(3).fillna(0)
-
-        # 3/7/15/30 天付费人均充值 = 累积充值 / 付费用户数
-        df_final['3天ARPPU'] = (df_final['累积充值_3天'] / df_final['付费用户数_3天']).round(3).fillna(0)
-        df_final['7天ARPPU'] = (df_final['累积充值_7天'] / df_final['付费用户数_7天']).round(3).fillna(0)
-        df_final['15天ARPPU'] = (df_final['累积充值_15天'] / df_final['付费用户数_15天']).round(3).fillna(0)
-        df_final['30天ARPPU'] = (df_final['累积充值_30天'] / df_final['付费用户数_30天']).round(3).fillna(0)
-        df_final['总充值ARPPU'] = (df_final['累积充值_total'] / df_final['付费用户数_30天']).round(3).fillna(0)
-
-        # ---------------------------
-        # 第八步：充值用户累积、充值率累积
-        # 这里指"累积到查询时刻"
-        # ---------------------------
-        # 充值用户累积 = 累积成功用户数
+        # 充值用户累积 = 累积成功用户数（累积到查询时刻）
         df_success = merged.groupby(['agent_id', 'agent_username', '注册日期'])['user_id'].nunique().reset_index(name='充值用户累积')
         df_final = pd.merge(df_final, df_success, on=['agent_id', 'agent_username', '注册日期'], how='left').fillna(0)
-        df_final['充值率累积'] = df_final.apply(
-            lambda row: f"{round(row['充值用户累积'] / row['注册人数'] * 100, 2)}%" if row['注册人数'] > 0 else '0%',
-            axis=1
-        )
-
-        # ---------------------------
-        # 第九步：计算过去天数
-        # ---------------------------
-        query_date = pd.to_datetime(datetime.now().date())
-        df_final['过去天数'] = (query_date - df_final['注册日期']).dt.days
-
-        # ---------------------------
-        # 第十步：排序、重命名列等操作
-        # ---------------------------
-        df_final = df_final.sort_values(['注册日期', 'agent_id'], ascending=[True, True]).reset_index(drop=True)
-
-        # 打印最终数据示例
-        print("\n示例最终合并后的数据:")
-        print(df_final.head())
 
         return df_final
     except Exception as e:
         print(f"计算滚动充值时发生错误: {str(e)}")
         raise
 
-def main():
-    try:
-        print("获取用户注册数据...")
-        df_user = get_user_registration_data()
+def finalize_rolling(df_final):
+    """
+    在按（代理, 注册日期）聚合好的注册人数、累积充值、付费用户数、充值用户累积上
+    计算人均充值 / 付费人均充值 / 充值率累积 / 过去天数，并统一列顺序和排序
+    """
+    # ---------------------------
+    # 第七步：计算人均充值 / 付费人均充值
+    # ---------------------------
+    # 3/7/15/30 天人均充值 = 累积充值 / 注册人数
+    df_final['3天ARPU'] = (df_final['累积充值_3天'] / df_final['注册人数']).round(3).fillna(0)
+    df_final['7天ARPU'] = (df_final['累积充值_7天'] / df_final['注册人数']).round(3).fillna(0)
+    df_final['15天ARPU'] = (df_final['累积充值_15天'] / df_final['注册人数']).round(3).fillna(0)
+    df_final['30天ARPU'] = (df_final['累积充值_30天'] / df_final['注册人数']).round(3).fillna(0)
+    df_final['总充值ARPU'] = (df_final['累积充值_total'] / df_final['注册人数']).round(3).fillna(0)
+
+    # 3/7/15/30 天付费人均充值 = 累积充值 / 付费用户数
+    df_final['3天ARPPU'] = (df_final['累积充值_3天'] / df_final['付费用户数_3天']).round(3).fillna(0)
+    df_final['7天ARPPU'] = (df_final['累积充值_7天'] / df_final['付费用户数_7天']).round(3).fillna(0)
+    df_final['15天ARPPU'] = (df_final['累积充值_15天'] / df_final['付费用户数_15天']).round(3).fillna(0)
+    df_final['30天ARPPU'] = (df_final['累积充值_30天'] / df_final['付费用户数_30天']).round(3).fillna(0)
+    df_final['总充值ARPPU'] = (df_final['累积充值_total'] / df_final['付费用户数_30天']).round(3).fillna(0)
+
+    # ---------------------------
+    # 第八步：充值率累积
+    # 这里指"累积到查询时刻"
+    # ---------------------------
+    df_final['充值率累积'] = df_final.apply(
+        lambda row: f"{round(row['充值用户累积'] / row['注册人数'] * 100, 2)}%" if row['注册人数'] > 0 else '0%',
+        axis=1
+    )
+
+    # ---------------------------
+    # 第九步：计算过去天数
+    # ---------------------------
+    query_date = pd.to_datetime(datetime.now().date())
+    df_final['过去天数'] = (query_date - df_final['注册日期']).dt.days
+
+    # ---------------------------
+    # 第十步：排序、重命名列等操作
+    # ---------------------------
+    df_final = df_final.sort_values(['注册日期', 'agent_id'], ascending=[True, True]).reset_index(drop=True)
+    df_final = df_final[RESULT_COLUMNS]
+
+    # 打印最终数据示例
+    print("\n示例最终合并后的数据:")
+    print(df_final.head())
+
+    return df_final
+
+def build_daily_trend(df_result):
+    """
+    按注册日期汇总的每日趋势：各窗口累积充值、注册人数之和，以及各窗口人均充值
+    与主结果一起保存，页面直接读取，不再每次重跑时对全表分组
+    """
+    sum_columns = ['注册人数'] + [f'累积充值_{period}天' for period in TREND_PERIODS]
+    daily_stats = df_result.groupby('注册日期', as_index=False)[sum_columns].sum()
+    daily_stats['注册日期'] = pd.to_datetime(daily_stats['注册日期'])
+    daily_stats = daily_stats.sort_values('注册日期').reset_index(drop=True)
 
-        print("获取充值数据...")
-        df_recharge = get_recharge_data()
+    # 计算人均充值
+    for period in TREND_PERIODS:
+        daily_stats[f'{period}天人均充值'] = daily_stats[f'累积充值_{period}天'] / daily_stats['注册人数']
+    return daily_stats
 
+def build_cohort_sketches(db_id, df_user, df_recharge, p, config=None):
+    """
+    单个数据库每个注册批次（代理, 注册日期）的 注册人数 / 充值用户累积 去重草图
+    返回 db_id, agent_id, agent_username, 注册日期, metric, sketch
+    """
+    users = df_user[pd.to_numeric(df_user['user_id'], errors='coerce').notna()]
+    users = users[['agent_id', 'agent_username', '注册日期', 'user_id']].assign(
+        注册日期=pd.to_datetime(users['注册日期'])
+    )
+    # 与充值用户累积口径一致：注册用户中有充值记录的用户
+    paying = users[users['user_id'].isin(df_recharge['user_id'])]
+    rows = pd.concat([users.assign(metric='注册人数'), paying.assign(metric='充值用户累积')], ignore_index=True)
+
+    keys = ['agent_id', 'agent_username', '注册日期', 'metric']
+    sketches = hll.group_sketches(rows[keys], hll.hash_users(db_id, rows['user_id'], config), p)
+    return sketches.assign(db_id=db_id)[['db_id'] + keys + ['sketch']]
+
+def calculate_rolling_recharge_in_store(con, db_ids):
+    """
+    在本地分析库中计算滚动充值（与 calculate_rolling_recharge 口径一致）
+    注册表与充值表的关联、窗口金额和分组聚合由 DuckDB 执行，超出内存上限时溢写到磁盘
+    """
+    df_final = local_store.query_df(con, """
+    WITH users AS (
+        SELECT db_id, user_id, agent_id, agent_username, 注册日期
+        FROM raw_user_registration
+        WHERE list_contains($db_ids, db_id)
+    ),
+    daily_users AS (
+        SELECT agent_id, agent_username, 注册日期, COUNT(DISTINCT user_id) AS 注册人数
+        FROM users
+        GROUP BY agent_id, agent_username, 注册日期
+    ),
+    merged AS (
+        SELECT
+            u.agent_id, u.agent_username, u.注册日期, r.user_id, r.调整后金额 AS amount,
+            DATE_DIFF('day', u.注册日期, r.充值日期) AS 自注册起天数
+        FROM raw_recharge r
+        JOIN users u ON r.db_id = u.db_id AND r.user_id = u.user_id
+        WHERE list_contains($db_ids, r.db_id)
+    ),
+    rolling AS (
+        SELECT
+            agent_id, agent_username, 注册日期,
+            SUM(CASE WHEN 自注册起天数 <= 3 THEN amount ELSE 0 END) AS 累积充值_3天,
+            SUM(CASE WHEN 自注册起天数 <= 7 THEN amount ELSE 0 END) AS 累积充值_7天,
+            SUM(CASE WHEN 自注册起天数 <= 15 THEN amount ELSE 0 END) AS 累积充值_15天,
+            SUM(CASE WHEN 自注册起天数 <= 30 THEN amount ELSE 0 END) AS 累积充值_30天,
+            SUM(amount) AS 累积充值_total,
+            COUNT(DISTINCT user_id) AS 充值用户累积
+        FROM merged
+        GROUP BY agent_id, agent_username, 注册日期
+    )
+    SELECT
+        d.agent_id, d.agent_username, d.注册日期, d.注册人数,
+        COALESCE(r.累积充值_3天, 0) AS 累积充值_3天,
+        COALESCE(r.累积充值_7天, 0) AS 累积充值_7天,
+        COALESCE(r.累积充值_15天, 0) AS 累积充值_15天,
+        COALESCE(r.累积充值_30天, 0) AS 累积充值_30天,
+        COALESCE(r.累积充值_total, 0) AS 累积充值_total,
+        COALESCE(r.充值用户累积, 0) AS 付费用户数_3天,
+        COALESCE(r.充值用户累积, 0) AS 付费用户数_7天,
+        COALESCE(r.充值用户累积, 0) AS 付费用户数_15天,
+        COALESCE(r.充值用户累积, 0) AS 付费用户数_30天,
+        COALESCE(r.充值用户累积, 0) AS 充值用户累积
+    FROM daily_users d
+    LEFT JOIN rolling r USING (agent_id, agent_username, 注册日期)
+    """, {"db_ids": list(db_ids)})
+
+    df_final['注册日期'] = pd.to_datetime(df_final['注册日期'])
+    return finalize_rolling(df_final)
+
+# 预览模式按抽样比例放大的计数列和金额列
+PREVIEW_COUNT_COLUMNS = ['注册人数', '付费用户数_3天', '付费用户数_7天', '付费用户数_15天', '付费用户数_30天', '充值用户累积']
+PREVIEW_SUM_COLUMNS = ['累积充值_3天', '累积充值_7天', '累积充值_15天', '累积充值_30天', '累积充值_total']
+# 预览结果附带置信区间半宽的列
+PREVIEW_ERROR_COLUMNS = ['注册人数_误差', '充值用户累积_误差', '累积充值_total_误差']
+
+def scale_preview_cohorts(df_cohort, df_user, df_recharge, plan, z):
+    """
+    单个数据库样本上的注册批次聚合结果按抽样比例放大
+    累积充值_total 的置信区间按每个样本用户总充值的平方和计算
+    """
+    keys = ['agent_id', 'agent_username', '注册日期']
+    rates = sampling.rates_for(df_cohort['agent_id'], plan)
+    scaled = sampling.scale_counts(df_cohort, PREVIEW_COUNT_COLUMNS, rates, z)
+    for col in PREVIEW_SUM_COLUMNS[:-1]:
+        scaled[col] = scaled[col] / rates
+
+    per_user = df_recharge.groupby('user_id')['调整后金额'].sum()
+    users = df_user[['user_id'] + keys].assign(注册日期=pd.to_datetime(df_user['注册日期']))
+    users['金额平方'] = users['user_id'].map(per_user).fillna(0) ** 2
+    square_sums = scaled[keys].merge(
+        users.groupby(keys, as_index=False)['金额平方'].sum(), on=keys, how='left'
+    )['金额平方'].fillna(0)
+    return sampling.scale_sums(scaled, PREVIEW_SUM_COLUMNS[-1], square_sums.to_numpy(), rates, z)
+
+def run_preview(config, output_dir):
+    """
+    预览模式：按代理分层抽样用户，只拉取样本用户的注册和充值数据，
+    各数据库的批次指标按抽样比例放大后合并，并给出置信区间；不写检查点、本地库和草图
+    返回预览文件路径（没有数据时为None）
+    """
+    metabase = config["metabase"]
+    z = sampling.z_value(sampling.get_preview_config(config)["confidence"])
+    keys = ['agent_id', 'agent_username', '注册日期']
+
+    frames = []
+    for db_id in config["target_databases"]:
+        cancellation.check()
+        print(f"\n预览数据库 {db_id}...")
+        try:
+            plan = sampling.sampling_plan(metabase, db_id, config)
+            sample = sampling.sample_condition(plan)
+            df_user = get_user_registration_data(
+                metabase, db_id, lambda metabase, db_id: query_user_registration(metabase, db_id, sample), config
+            )
+            df_recharge = get_recharge_data(
+                metabase, db_id, lambda metabase, db_id: query_recharge(metabase, db_id, sample), config
+            )
+            df_cohort = aggregate_rolling(df_user, df_recharge)
+            frames.append(scale_preview_cohorts(df_cohort, df_user, df_recharge, plan, z))
+        except Exception as e:
+            print(f"数据库 {db_id} 预览失败: {str(e)}")
+
+    if not frames:
+        print("预览未获取到任何有效数据")
+        return None
+
+    # 不同数据库的估计相互独立：计数和金额相加，置信区间半宽按平方和开方合并
+    combined = pd.concat(frames, ignore_index=True)
+    for col in PREVIEW_ERROR_COLUMNS:
+        combined[col] = combined[col] ** 2
+    combined = combined.groupby(keys, as_index=False)[PREVIEW_COUNT_COLUMNS + PREVIEW_SUM_COLUMNS + PREVIEW_ERROR_COLUMNS].sum()
+    for col in PREVIEW_ERROR_COLUMNS:
+        combined[col] = np.sqrt(combined[col]).round(2)
+
+    df_result = finalize_rolling(combined.drop(columns=PREVIEW_ERROR_COLUMNS))
+    df_result = df_result.merge(combined[keys + PREVIEW_ERROR_COLUMNS], on=keys, how='left')
+
+    timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
+    output_path = os.path.join(output_dir, f'preview_agent_recharge_analysis_{timestamp}.csv')
+    df_result.to_csv(output_path + '.tmp', index=False, encoding='utf-8')
+    os.replace(output_path + '.tmp', output_path)
+    print(f"预览结果已保存：{output_path}")
+    return output_path
+
+def main(resume=True, fetchers=None, output_dir=None, preview=False, token=None):
+    """
+    执行充值分析
+    resume=True 时续用上次未完成的运行，已拉取成功的 (数据库, 查询) 不再重复拉取
+    fetchers 可替换各查询的数据来源（{"user"|"recharge": fn(metabase, db_id) -> CSV文本}），
+    批量任务用它传入共享拉取的数据；output_dir 可替换结果输出目录
+    preview=True 时只做抽样预览（见 run_preview），结果写到 preview_agent_recharge_analysis_*.csv
+    token 为取消令牌（cancellation.CancelToken），取消后抛出 cancellation.Cancelled，
+    已拉取的数据保留在检查点中，下次运行继续
+    """
+    with cancellation.activate(token):
+        return run_analysis(resume, fetchers, output_dir, preview)
+
+def run_analysis(resume, fetchers, output_dir, preview):
+    """执行充值分析（参数见 main）"""
+    store = None
+    release_interrupt = None
+    try:
+        config = load_config()
+        metabase = config["metabase"]
+
+        if preview:
+            output_dir = str(output_dir) if output_dir else '03_Data/merged_data'
+            os.makedirs(output_dir, exist_ok=True)
+            run_preview(config, output_dir)
+            print(metabase_client.summary())
+            return
+
+        # 各查询的数据来源
+        fetch = {"user": query_user_registration, "recharge": query_recharge}
+        fetch.update(fetchers or {})
+
+        # 检查点：每个 (数据库, 查询) 的拉取结果
+        run = checkpoint.start_run("accumulate_recharge", config, resume=resume)
+
+        # 打开本地分析库（未安装duckdb或配置关闭时按配置的引擎在内存中计算）
+        store = local_store.connect(config) if local_store.is_enabled(config) else None
+        engine = engines.resolve_engine(config) if store is None else None
+        # 取消时中断本地分析库中正在执行的查询
+        token = cancellation.current()
+        release_interrupt = token.on_cancel(store.interrupt) if token is not None and store is not None else None
+
+        user_frames = []
+        recharge_frames = []
+        # 各数据库每个注册批次的去重草图，与结果文件一起保存
+        sketch_precision = hll.precision_for_error(hll.get_sketch_config(config)["relative_error"])
+        sketch_frames = []
+        for db_id in config["target_databases"]:
+            cancellation.check()
+            print(f"\n处理数据库 {db_id}...")
+
+            print("获取用户注册数据...")
+            df_user = run.fetch_frame(f"{db_id}/user", lambda: get_user_registration_data(metabase, db_id, fetch["user"], config))
+
+            print("获取充值数据...")
+            df_recharge = run.fetch_frame(f"{db_id}/recharge", lambda: get_recharge_data(metabase, db_id, fetch["recharge"], config))
+
+            sketch_frames.append(build_cohort_sketches(db_id, df_user, df_recharge, sketch_precision, config))
+
+            if store is not None:
+                local_store.land_table(store, "raw_user_registration", df_user, db_id)
+                local_store.land_table(store, "raw_recharge", df_recharge, db_id)
+            else:
+                user_frames.append(df_user.assign(db_id=db_id))
+                recharge_frames.append(df_recharge.assign(db_id=db_id))
+
+        cancellation.check()
         print("开始计算滚动充值与相关指标...")
-        df_result = calculate_rolling_recharge(df_user, df_recharge)
+        if store is not None:
+            try:
+                df_result = calculate_rolling_recharge_in_store(store, config["target_databases"])
+            except Exception:
+                # 库内计算被取消中断时以取消结束
+                cancellation.check()
+                raise
+        else:
+            df_result = calculate_rolling_recharge(
+                pd.concat(user_frames, ignore_index=True),
+                pd.concat(recharge_frames, ignore_index=True),
+                engine
+            )
 
         # 保存结果
-        output_dir = '03_Data/merged_data'
+        cancellation.check()
+        output_dir = str(output_dir) if output_dir else '03_Data/merged_data'
         if not os.path.exists(output_dir):
             os.makedirs(output_dir)
 
@@ -322,12 +601,33 @@ def main():
         # 保存综合分析结果
         output_file_result = f'agent_recharge_analysis_{timestamp}.csv'
         output_path_result = os.path.join(output_dir, output_file_result)
-        df_result.to_csv(output_path_result, index=False, encoding='utf-8')
+        # 草图文件先于结果文件写出，页面读到结果时草图已就绪
+        hll.write_sketches(hll.sketch_path(output_path_result), pd.concat(sketch_frames, ignore_index=True))
+        # 每日趋势（与综合分析结果使用同一时间戳）同样先于结果文件写出
+        output_path_trend = os.path.join(output_dir, f'agent_recharge_trend_{timestamp}.csv')
+        build_daily_trend(df_result).to_csv(output_path_trend + '.tmp', index=False, encoding='utf-8')
+        os.replace(output_path_trend + '.tmp', output_path_trend)
+        print(f"每日趋势已保存：{output_path_trend}")
+        # 列式副本同样先于结果文件写出
+        df_result.to_csv(output_path_result + '.tmp', index=False, encoding='utf-8')
+        columnar.write_mapped(output_path_result + '.tmp', columnar.mapped_path(output_path_result))
+        os.replace(output_path_result + '.tmp', output_path_result)
         print(f"综合分析结果已保存：{output_path_result}")
+        print(metabase_client.summary())
+        run.complete(output_path_result)
 
+    except cancellation.Cancelled:
+        print("\n充值分析已取消，已拉取的数据保留在检查点中")
+        raise
     except Exception as e:
         print(f"执行出错：{str(e)}")
         raise
+    finally:
+        # 无论成功、取消还是拉取出错，都释放取消回调并关闭本地分析库（释放库文件锁）
+        if release_interrupt is not None:
+            release_interrupt()
+        if store is not None:
+            store.close()
 
 if __name__ == "__main__":
     main()
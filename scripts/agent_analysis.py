@@ -4,8 +4,12 @@
 import pandas as pd
 import numpy as np
 from pathlib import Path
+import os
 import sys
 import time
+import functools
+import multiprocessing
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
 from io import StringIO
 from datetime import datetime
 
@@ -14,34 +18,62 @@ project_root = Path(__file__).parent.parent.parent
 script_dir = project_root / "01_Script"
 sys.path.append(str(project_root))
 sys.path.append(str(script_dir))
-from fetch_metabase import load_config, get_data_as_csv
+sys.path.append(str(Path(__file__).parent))
+from fetch_metabase import load_config
+import metabase_client
+import dimensions
+import local_store
+import columnar
+import checkpoint
+import agent_partitions
+import agent_state
+import hll
+import sampling
+import cancellation
+import engines
+import snapshots
 
-def get_base_user_data(metabase, db_id):
-    """获取基础用户数据"""
-    query = """
+# 分析结果的列顺序
+RESULT_COLUMNS = [
+    'agent_id', 'game_user_id', 'username', '总用户数', '直属用户数', '最大邀请人数',
+    '总充值金额', '付费用户数', '游戏玩家数', '直属用户占比', '游戏玩家占比', '付费率',
+    '付费用户平均充值', '人均充值', '首次活跃日期', '最后活跃日期', '活跃天数', '人均日充值'
+]
+
+def get_base_user_data(metabase, db_id, sample="", config=None):
+    """
+    获取基础用户数据（代理信息由 admin_user 维度缓存在本地关联）
+    sample 为预览模式的抽样条件（作用于 tg_user t），config 决定维度缓存的目录和探测间隔
+    """
+    query = f"""
     SELECT DISTINCT
         t.agent_id,
-        au.game_user_id,
-        au.username,
         t.user_id,
         t.inviter_user_id,
         DATE(t.create_time) as create_time,
         DATE(t.update_time) as update_time
     FROM tg_user t
-    LEFT JOIN admin_user au ON t.agent_id = au.admin_user_id
-    WHERE t.enable_flag = 1
+    WHERE t.enable_flag = 1 {sample}
     """
-    return get_data_as_csv(
-        metabase["base_url"],
-        metabase["session_id"],
-        metabase["device_id"],
-        db_id,
-        query
-    )
+    csv_data = metabase_client.query_csv(metabase, db_id, query)
+    if not csv_data:
+        return csv_data
+    return attach_agent_columns(csv_data, dimensions.get_admin_users(metabase, db_id, config))
 
-def get_charge_data(metabase, db_id):
-    """获取充值数据"""
-    query = """
+def attach_agent_columns(csv_data, agents):
+    """
+    为基础用户数据补上代理的 game_user_id 和 username，列顺序与原先的 LEFT JOIN 查询一致
+    按文本读取，保持ID等列原样输出
+    """
+    base_df = pd.read_csv(StringIO(csv_data), dtype=str, keep_default_na=False)
+    base_df = dimensions.attach_agents(base_df, agents)
+    return base_df[[
+        'agent_id', 'game_user_id', 'username', 'user_id', 'inviter_user_id', 'create_time', 'update_time'
+    ]].to_csv(index=False)
+
+def get_charge_data(metabase, db_id, sample=""):
+    """获取充值数据（sample 为预览模式的抽样条件）"""
+    query = f"""
     SELECT 
         t.user_id,
         t.agent_id,
@@ -55,18 +87,13 @@ def get_charge_data(metabase, db_id):
         t.enable_flag = 1
         AND g.created_at >= '2024-11-01'
         AND g.status = true
+        {sample}
     """
-    return get_data_as_csv(
-        metabase["base_url"],
-        metabase["session_id"],
-        metabase["device_id"],
-        db_id,
-        query
-    )
+    return metabase_client.query_csv(metabase, db_id, query)
 
-def get_game_data(metabase, db_id):
-    """获取游戏数据"""
-    query = """
+def get_game_data(metabase, db_id, sample=""):
+    """获取游戏数据（sample 为预览模式的抽样条件）"""
+    query = f"""
     SELECT 
         t.user_id,
         COUNT(*) as game_count
@@ -77,26 +104,20 @@ def get_game_data(metabase, db_id):
         AND t.invitation_code != ''
         AND t.enable_flag = 1
         AND tr.business_type = 6
+        {sample}
     GROUP BY t.user_id
     """
-    return get_data_as_csv(
-        metabase["base_url"],
-        metabase["session_id"],
-        metabase["device_id"],
-        db_id,
-        query
-    )
+    return metabase_client.query_csv(metabase, db_id, query)
 
-def get_invite_data(metabase, db_id):
-    """获取邀请记录数据"""
-    query = """
-    WITH agent_users AS (
-        -- 找出所有代理的game_user_id
-        SELECT DISTINCT game_user_id
-        FROM admin_user
-        WHERE game_user_id IS NOT NULL
-    ),
-    inviter_stats AS (
+def get_invite_data(metabase, db_id, config=None):
+    """获取邀请记录数据（代理本人的 game_user_id 由 admin_user 维度缓存提供）"""
+    agent_user_ids = dimensions.agent_game_user_ids(dimensions.get_admin_users(metabase, db_id, config))
+    # 排除代理用户
+    exclude_agents = (
+        f"AND t1.user_id NOT IN ({', '.join(str(x) for x in agent_user_ids)})" if agent_user_ids else ""
+    )
+    query = f"""
+    WITH inviter_stats AS (
         -- 统计每个非代理用户邀请的人数
         SELECT 
             t1.agent_id,
@@ -104,12 +125,11 @@ def get_invite_data(metabase, db_id):
             COUNT(DISTINCT t2.user_id) as invite_count
         FROM tg_user t1
         LEFT JOIN tg_user t2 ON t1.user_id = t2.inviter_user_id
-        LEFT JOIN agent_users au ON t1.user_id = au.game_user_id
         WHERE 
             t1.enable_flag = 1
             AND t2.enable_flag = 1
             AND t2.user_id != t2.inviter_user_id  -- 排除自己邀请自己
-            AND au.game_user_id IS NULL  -- 排除代理用户
+            {exclude_agents}
         GROUP BY t1.agent_id, t1.user_id
         HAVING COUNT(DISTINCT t2.user_id) > 0  -- 只保留有邀请的记录
     )
@@ -125,16 +145,29 @@ def get_invite_data(metabase, db_id):
         WHERE i2.agent_id = i1.agent_id
     )
     """
-    return get_data_as_csv(
-        metabase["base_url"],
-        metabase["session_id"],
-        metabase["device_id"],
-        db_id,
-        query
-    )
+    return metabase_client.query_csv(metabase, db_id, query)
 
-def process_data(base_df, charge_df, game_df, invite_df):
-    """处理数据并计算统计指标"""
+# 各查询的默认数据来源（直接查询Metabase）
+FETCHERS = {
+    "base": get_base_user_data,
+    "charge": get_charge_data,
+    "game": get_game_data,
+    "invite": get_invite_data
+}
+
+def process_data(base_df, charge_df, game_df, invite_df, engine=engines.REFERENCE):
+    """
+    处理数据并计算统计指标
+    engine 为聚合使用的计算引擎（见 engines），默认即下面的 pandas 参考实现；其他引擎出错时回退到参考实现
+    """
+    calculator = engines.get_engine(engine)
+    if calculator is not None:
+        try:
+            result = calculator.agent_metrics(base_df, charge_df, game_df, invite_df)
+            return finalize_result(result) if not result.empty else pd.DataFrame()
+        except Exception as e:
+            print(f"{engine} 引擎计算失败，改用 pandas 计算: {str(e)}")
+    
     try:
         # 检查数据是否为空
         if base_df.empty:
@@ -223,9 +256,10 @@ def process_data(base_df, charge_df, game_df, invite_df):
             invite_df['agent_id'] = invite_df['agent_id'].fillna('NULL')
             invite_df['agent_id'] = invite_df['agent_id'].astype(str)
             
-            # 直接使用SQL查询返回的最大邀请数
+            # 直接使用SQL查询返回的最大邀请数（多个邀请者并列时只保留一条，避免代理行被重复）
+            max_invites = invite_df.groupby('agent_id')['invite_count'].max().reset_index()
             result = result.merge(
-                invite_df[['agent_id', 'invite_count']].rename(columns={'invite_count': '最大邀请人数'}),
+                max_invites.rename(columns={'invite_count': '最大邀请人数'}),
                 on='agent_id',
                 how='left'
             )
@@ -295,43 +329,6 @@ def process_data(base_df, charge_df, game_df, invite_df):
             # 如果没有游戏数据，添加空列
             result['游戏玩家数'] = 0
         
-        # 填充空值
-        result = result.fillna({
-            '总用户数': 0,
-            '直属用户数': 0,
-            '最大邀请人数': 0,
-            '总充值金额': 0,
-            '付费用户数': 0,
-            '游戏玩家数': 0
-        })
-        
-        # 计算比率和平均值（避免除以零）
-        result['直属用户占比'] = result.apply(
-            lambda row: f"{(row['直属用户数'] / row['总用户数'] * 100):.2f}%" if row['总用户数'] > 0 else "0%",
-            axis=1
-        )
-        
-        result['游戏玩家占比'] = result.apply(
-            lambda row: f"{(row['游戏玩家数'] / row['总用户数'] * 100):.2f}%" if row['总用户数'] > 0 else "0%",
-            axis=1
-        )
-        
-        result['付费率'] = result.apply(
-            lambda row: f"{(row['付费用户数'] / row['总用户数'] * 100):.2f}%" if row['总用户数'] > 0 else "0%",
-            axis=1
-        )
-        
-        # 计算ARPPU和人均指标（避免除以零）
-        result['付费用户平均充值'] = result.apply(
-            lambda row: round(row['总充值金额'] / row['付费用户数'], 4) if row['付费用户数'] > 0 else 0,
-            axis=1
-        )
-        
-        result['人均充值'] = result.apply(
-            lambda row: round(row['总充值金额'] / row['总用户数'], 4) if row['总用户数'] > 0 else 0,
-            axis=1
-        )
-        
         # 计算活跃时间相关指标
         def get_date_range(group):
             try:
@@ -377,29 +374,7 @@ def process_data(base_df, charge_df, game_df, invite_df):
         # 合并日期统计
         result = result.merge(date_stats, on='agent_id', how='left')
         
-        # 计算人均日充值（避免除以零）
-        result['人均日充值'] = result.apply(
-            lambda row: round(row['总充值金额'] / row['总用户数'] / row['活跃天数'], 4) 
-            if row['总用户数'] > 0 and row['活跃天数'] > 0 else 0,
-            axis=1
-        )
-        
-        # 确保数值列为整数类型
-        int_columns = ['总用户数', '直属用户数', '最大邀请人数', '付费用户数', '游戏玩家数', '活跃天数']
-        for col in int_columns:
-            if col in result.columns:
-                result[col] = result[col].fillna(0).astype(int)
-        
-        # 确保金额列为浮点数类型，保留4位小数
-        float_columns = ['总充值金额', '付费用户平均充值', '人均充值', '人均日充值']
-        for col in float_columns:
-            if col in result.columns:
-                result[col] = result[col].fillna(0).round(4)
-        
-        # 按总用户数排序
-        result = result.sort_values('总用户数', ascending=False)
-        
-        return result
+        return finalize_result(result)
         
     except Exception as e:
         print(f"数据处理错误: {str(e)}")
@@ -408,7 +383,386 @@ def process_data(base_df, charge_df, game_df, invite_df):
         print(traceback.format_exc())
         return pd.DataFrame()  # 返回空DataFrame
 
-def main():
+def finalize_result(result):
+    """
+    在基础聚合结果上计算比率、人均等派生指标，并统一列类型、列顺序和排序
+    result 需包含 RESULT_COLUMNS 中除派生指标外的所有列
+    """
+    # 填充空值
+    result = result.fillna({
+        '总用户数': 0,
+        '直属用户数': 0,
+        '最大邀请人数': 0,
+        '总充值金额': 0,
+        '付费用户数': 0,
+        '游戏玩家数': 0
+    })
+    
+    # 计算比率和平均值（避免除以零）
+    result['直属用户占比'] = result.apply(
+        lambda row: f"{(row['直属用户数'] / row['总用户数'] * 100):.2f}%" if row['总用户数'] > 0 else "0%",
+        axis=1
+    )
+    
+    result['游戏玩家占比'] = result.apply(
+        lambda row: f"{(row['游戏玩家数'] / row['总用户数'] * 100):.2f}%" if row['总用户数'] > 0 else "0%",
+        axis=1
+    )
+    
+    result['付费率'] = result.apply(
+        lambda row: f"{(row['付费用户数'] / row['总用户数'] * 100):.2f}%" if row['总用户数'] > 0 else "0%",
+        axis=1
+    )
+    
+    # 计算ARPPU和人均指标（避免除以零）
+    result['付费用户平均充值'] = result.apply(
+        lambda row: round(row['总充值金额'] / row['付费用户数'], 4) if row['付费用户数'] > 0 else 0,
+        axis=1
+    )
+    
+    result['人均充值'] = result.apply(
+        lambda row: round(row['总充值金额'] / row['总用户数'], 4) if row['总用户数'] > 0 else 0,
+        axis=1
+    )
+    
+    # 计算人均日充值（避免除以零）
+    result['人均日充值'] = result.apply(
+        lambda row: round(row['总充值金额'] / row['总用户数'] / row['活跃天数'], 4) 
+        if row['总用户数'] > 0 and row['活跃天数'] > 0 else 0,
+        axis=1
+    )
+    
+    # 确保数值列为整数类型
+    int_columns = ['总用户数', '直属用户数', '最大邀请人数', '付费用户数', '游戏玩家数', '活跃天数']
+    for col in int_columns:
+        if col in result.columns:
+            result[col] = result[col].fillna(0).astype(int)
+    
+    # 确保金额列为浮点数类型，保留4位小数
+    float_columns = ['总充值金额', '付费用户平均充值', '人均充值', '人均日充值']
+    for col in float_columns:
+        if col in result.columns:
+            result[col] = result[col].fillna(0).round(4)
+    
+    # 按总用户数排序（先按分组键排序，总用户数相同时顺序固定，与增量合并后的顺序一致）
+    result = agent_state.order_like_full(result)
+    
+    # 统一列顺序
+    result = result[[col for col in RESULT_COLUMNS if col in result.columns]]
+    
+    return result
+
+def process_data_in_store(con, db_id, agent_ids=None):
+    """
+    在本地分析库中计算统计指标（与 process_data 口径一致）
+    关联和分组聚合全部由 DuckDB 执行，数据量超过内存上限时会溢写到磁盘
+    agent_ids 不为空时只计算这些代理（增量计算）
+    """
+    agent_filter = ""
+    if agent_ids is not None:
+        con.register("_agent_filter", pd.DataFrame({"agent_id": pd.Series(list(agent_ids), dtype=object)}))
+        agent_filter = "AND COALESCE(agent_id, 'NULL') IN (SELECT agent_id FROM _agent_filter)"
+    try:
+        result = _query_agent_metrics(con, db_id, agent_filter)
+    finally:
+        if agent_ids is not None:
+            con.unregister("_agent_filter")
+
+    if result.empty:
+        print("警告: 基础数据为空")
+        return pd.DataFrame()
+
+    # 与pandas路径保持一致：日期列为 datetime.date
+    for col in ['首次活跃日期', '最后活跃日期']:
+        result[col] = pd.to_datetime(result[col]).dt.date
+
+    return finalize_result(result)
+
+def _query_agent_metrics(con, db_id, agent_filter):
+    """process_data_in_store 的查询，agent_filter 为附加在各原始表上的代理筛选条件"""
+    return local_store.query_df(con, f"""
+    WITH base AS (
+        SELECT
+            COALESCE(agent_id, 'NULL') AS agent_id,
+            CAST(COALESCE(game_user_id, 0) AS DOUBLE) AS game_user_id,
+            COALESCE(username, '官方') AS username,
+            user_id,
+            inviter_user_id,
+            create_time,
+            update_time
+        FROM raw_tg_user
+        WHERE db_id = $db_id {agent_filter}
+    ),
+    agents AS (
+        SELECT agent_id, game_user_id, username, COUNT(DISTINCT user_id) AS 总用户数
+        FROM base
+        GROUP BY agent_id, game_user_id, username
+    ),
+    direct_users AS (
+        SELECT agent_id, COUNT(DISTINCT user_id) AS 直属用户数
+        FROM base
+        WHERE inviter_user_id = game_user_id OR inviter_user_id IS NULL
+        GROUP BY agent_id
+    ),
+    invites AS (
+        SELECT COALESCE(agent_id, 'NULL') AS agent_id, MAX(invite_count) AS 最大邀请人数
+        FROM raw_invite_stats
+        WHERE db_id = $db_id {agent_filter}
+        GROUP BY 1
+    ),
+    user_charges AS (
+        -- pay_type = 0 时金额乘以5，pay_type = 1 时金额除以50
+        SELECT
+            COALESCE(agent_id, 'NULL') AS agent_id,
+            user_id,
+            SUM(CASE pay_type WHEN 0 THEN amount * 5 WHEN 1 THEN amount / 50 ELSE 0 END) AS real_amount
+        FROM raw_game_charges
+        WHERE db_id = $db_id {agent_filter}
+        GROUP BY 1, 2
+    ),
+    charges AS (
+        SELECT agent_id, SUM(real_amount) AS 总充值金额, COUNT(DISTINCT user_id) AS 付费用户数
+        FROM user_charges
+        WHERE real_amount > 0
+        GROUP BY agent_id
+    ),
+    game_players AS (
+        SELECT b.agent_id, COUNT(DISTINCT b.user_id) AS 游戏玩家数
+        FROM base b
+        JOIN (
+            SELECT DISTINCT user_id FROM raw_game_count
+            WHERE db_id = $db_id AND game_count > 5
+        ) g ON b.user_id = g.user_id
+        GROUP BY b.agent_id
+    ),
+    active_dates AS (
+        SELECT agent_id, MIN(d) AS 首次活跃日期, MAX(d) AS 最后活跃日期, COUNT(DISTINCT d) AS 活跃天数
+        FROM (
+            SELECT agent_id, create_time AS d FROM base
+            UNION ALL
+            SELECT agent_id, update_time AS d FROM base
+        )
+        WHERE d IS NOT NULL
+        GROUP BY agent_id
+    )
+    SELECT
+        a.agent_id, a.game_user_id, a.username, a.总用户数,
+        d.直属用户数, i.最大邀请人数, c.总充值金额, c.付费用户数, g.游戏玩家数,
+        ad.首次活跃日期, ad.最后活跃日期, ad.活跃天数
+    FROM agents a
+    LEFT JOIN direct_users d USING (agent_id)
+    LEFT JOIN invites i USING (agent_id)
+    LEFT JOIN charges c USING (agent_id)
+    LEFT JOIN game_players g USING (agent_id)
+    LEFT JOIN active_dates ad USING (agent_id)
+    """, {"db_id": db_id})
+
+def write_database_details(staging_dir, db_id, base_data, charge_data, game_data, sketch_precision, config=None):
+    """
+    写出单个数据库的代理明细并生成去重草图（进程池模式下在子进程中执行）
+    返回 (各数据集行数, 去重草图)；明细写出失败时均为None，草图生成失败时草图为None
+    """
+    try:
+        users, charges, rows = agent_partitions.write_database(
+            staging_dir, db_id, base_data, charge_data, game_data, config
+        )
+    except Exception as e:
+        print(f"数据库 {db_id} 明细写出失败: {str(e)}")
+        return None, None
+    try:
+        sketches = build_agent_sketches(db_id, users, charges, sketch_precision, config)
+    except Exception as e:
+        print(f"数据库 {db_id} 去重草图生成失败: {str(e)}")
+        sketches = None
+    return rows, sketches
+
+def process_database_csv(base_data, charge_data, game_data, invite_data, db_id=None, config=None, save_state=False,
+                         staging_dir=None, sketch_precision=None):
+    """
+    解析单个数据库的CSV并计算统计指标（在进程池的子进程中执行，只用于 pandas 引擎）
+    输入为Metabase返回的CSV文本，结果以Arrow IPC字节流返回，避免pickle DataFrame
+    给出 db_id 时按增量方式计算（只重算有变化的代理），save_state 控制是否保存增量状态
+    给出 staging_dir 时同时在子进程中写出代理明细、生成去重草图（主进程不再解析一遍CSV），
+    返回 (结果, 各数据集行数, 去重草图)，草图同样为Arrow IPC字节流
+    """
+    base_df = pd.read_csv(StringIO(base_data))
+    charge_df = pd.read_csv(StringIO(charge_data)) if charge_data else pd.DataFrame()
+    game_df = pd.read_csv(StringIO(game_data)) if game_data else pd.DataFrame()
+    invite_df = pd.read_csv(StringIO(invite_data)) if invite_data else pd.DataFrame()
+    
+    if db_id is None:
+        result = process_data(base_df, charge_df, game_df, invite_df)
+    else:
+        result = agent_state.process_incremental(
+            db_id,
+            (base_df, charge_df, game_df, invite_df),
+            lambda frames, _: process_data(*frames),
+            config,
+            save=save_state
+        )
+    result_bytes = columnar.to_ipc_bytes(result)
+    if staging_dir is None:
+        return result_bytes
+    rows, sketches = write_database_details(staging_dir, db_id, base_data, charge_data, game_data, sketch_precision, config)
+    return result_bytes, rows, columnar.to_ipc_bytes(sketches) if sketches is not None else None
+
+def build_agent_sketches(db_id, users, charges, p, config=None):
+    """
+    单个数据库每个代理的 总用户数 / 付费用户数 / 游戏玩家数 去重草图
+    输入为代理明细的 Arrow 表（agent_id 已统一为字符串），返回 db_id, agent_id, metric, sketch
+    """
+    parts = []
+    if users is not None:
+        users = users.select(['agent_id', 'user_id', 'game_count']).to_pandas().dropna(subset=['user_id'])
+        parts.append(users[['agent_id', 'user_id']].assign(metric='总用户数'))
+        parts.append(users.loc[users['game_count'] > 5, ['agent_id', 'user_id']].assign(metric='游戏玩家数'))
+    if charges is not None:
+        charges = charges.select(['agent_id', 'user_id', 'real_amount']).to_pandas().dropna(subset=['user_id'])
+        # 与付费用户数口径一致：按用户汇总后实际充值大于0
+        per_user = charges.groupby(['agent_id', 'user_id'], as_index=False)['real_amount'].sum()
+        parts.append(per_user.loc[per_user['real_amount'] > 0, ['agent_id', 'user_id']].assign(metric='付费用户数'))
+    if not parts:
+        return pd.DataFrame(columns=['db_id', 'agent_id', 'metric', 'sketch'])
+
+    rows = pd.concat(parts, ignore_index=True)
+    sketches = hll.group_sketches(rows[['agent_id', 'metric']], hll.hash_users(db_id, rows['user_id'], config), p)
+    return sketches.assign(db_id=db_id)[['db_id', 'agent_id', 'metric', 'sketch']]
+
+def get_process_workers(config):
+    """进程池大小：配置项 process_workers，默认取CPU核数与数据库数的较小值"""
+    workers = config.get("process_workers")
+    if not workers:
+        workers = min(os.cpu_count() or 1, len(config["target_databases"]))
+    return max(1, int(workers))
+
+def append_result(result, output_file, write_header):
+    """将单个数据库的结果追加写入输出文件（流式合并，不在内存中拼接全部结果）"""
+    # 填充空值
+    result = result.fillna({
+        '总用户数': 0,
+        '直属用户数': 0,
+        '最大邀请人数': 0,
+        '总充值金额': 0,
+        '付费用户数': 0,
+        '游戏玩家数': 0,
+        '付费用户平均充值': 0,
+        '人均充值': 0,
+        '活跃天数': 0,
+        '人均日充值': 0,
+        '直属用户占比': '0%',
+        '游戏玩家占比': '0%',
+        '付费率': '0%'
+    })
+    result[RESULT_COLUMNS].to_csv(
+        output_file,
+        mode='w' if write_header else 'a',
+        header=write_header,
+        index=False,
+        encoding='utf-8'
+    )
+
+def charge_square_sums(charge_df):
+    """每个代理付费用户实际充值金额的平方和（用于预览模式的充值金额置信区间）"""
+    if charge_df.empty:
+        return pd.Series(dtype=float)
+    amount = pd.to_numeric(charge_df['amount'], errors='coerce')
+    pay_type = pd.to_numeric(charge_df['pay_type'], errors='coerce')
+    per_user = pd.DataFrame({
+        'agent_id': sampling.agent_keys(charge_df['agent_id']).to_numpy(),
+        'user_id': charge_df['user_id'].to_numpy(),
+        'real_amount': np.where(pay_type == 0, amount * 5, np.where(pay_type == 1, amount / 50, 0))
+    }).groupby(['agent_id', 'user_id'])['real_amount'].sum()
+    per_user = per_user[per_user > 0]
+    return (per_user ** 2).groupby(level='agent_id').sum()
+
+def scale_preview_result(result, plan, square_sums, z):
+    """
+    把样本上算出的代理指标按抽样比例放大，重新计算比率和人均指标
+    附加各估计值的置信区间半宽（<列名>_误差）和抽样比例
+    """
+    rates = sampling.rates_for(result['agent_id'], plan)
+    count_columns = ['总用户数', '直属用户数', '付费用户数', '游戏玩家数']
+    scaled = sampling.scale_counts(result, count_columns, rates, z)
+    scaled = sampling.scale_sums(
+        scaled, '总充值金额', sampling.agent_keys(result['agent_id']).map(square_sums).fillna(0), rates, z
+    )
+    extra = scaled[agent_state.GROUP_KEYS + [f'{col}_误差' for col in count_columns + ['总充值金额']]]
+    extra = extra.assign(抽样比例=rates)
+    return finalize_result(scaled).merge(extra, on=agent_state.GROUP_KEYS, how='left')
+
+def run_preview(config, output_dir):
+    """
+    预览模式：按代理分层抽样用户，只拉取样本用户的基础、充值和游戏数据，
+    指标按抽样比例放大并给出置信区间；不计算最大邀请人数，不写检查点、明细和草图
+    返回预览文件路径（没有数据时为None）
+    """
+    metabase = config["metabase"]
+    preview_config = sampling.get_preview_config(config)
+    z = sampling.z_value(preview_config["confidence"])
+    timestamp = time.strftime("%Y%m%d_%H%M%S")
+    
+    frames = []
+    for db_id in config["target_databases"]:
+        cancellation.check()
+        try:
+            plan = sampling.sampling_plan(metabase, db_id, config)
+            sample = sampling.sample_condition(plan)
+            base_data = get_base_user_data(metabase, db_id, sample, config)
+            if not base_data:
+                print(f"数据库 {db_id} 基础数据获取失败")
+                continue
+            charge_data = get_charge_data(metabase, db_id, sample)
+            game_data = get_game_data(metabase, db_id, sample)
+            
+            base_df = pd.read_csv(StringIO(base_data))
+            charge_df = pd.read_csv(StringIO(charge_data)) if charge_data else pd.DataFrame()
+            game_df = pd.read_csv(StringIO(game_data)) if game_data else pd.DataFrame()
+            square_sums = charge_square_sums(charge_df)
+            
+            result = process_data(base_df, charge_df, game_df, pd.DataFrame())
+            if result.empty:
+                continue
+            frames.append(scale_preview_result(result, plan, square_sums, z))
+            print(f"数据库 {db_id} 预览完成，抽样用户 {len(base_df)} / {int(plan['user_count'].sum())}")
+        except Exception as e:
+            print(f"数据库 {db_id} 预览失败: {str(e)}")
+    
+    if not frames:
+        print("\n预览未获取到任何有效数据")
+        return None
+    output_file = output_dir / f"preview_agent_analysis_{timestamp}.csv"
+    temp_file = output_dir / f"preview_agent_analysis_{timestamp}.csv.tmp"
+    pd.concat(frames, ignore_index=True).to_csv(temp_file, index=False, encoding='utf-8')
+    temp_file.replace(output_file)
+    print(f"\n预览完成，结果已保存到: {output_file}")
+    return output_file
+
+def main(resume=True, fetchers=None, output_dir=None, preview=False, token=None, deferred_publish=None):
+    """
+    执行代理商分析
+    resume=True 时续用上次未完成的运行，只重新拉取/处理失败或缺失的数据库
+    fetchers 可替换各查询的数据来源（{"base"|"charge"|"game"|"invite": fn(metabase, db_id) -> CSV文本}），
+    批量任务用它传入共享拉取的数据；output_dir 可替换结果输出目录
+    preview=True 时只做抽样预览（见 run_preview），结果写到 preview_agent_analysis_*.csv
+    token 为取消令牌（cancellation.CancelToken），取消后抛出 cancellation.Cancelled，
+    已拉取的数据保留在检查点中，下次运行继续
+    deferred_publish 不为None（列表）时，代理明细和历史快照不在运行结束时发布，而是把发布函数
+    fn(输出目录) 加入该列表，由调用方把结果文件移动到输出目录后执行（批量任务与其他结果一起发布）
+    """
+    with cancellation.activate(token):
+        return run_analysis(resume, fetchers, output_dir, preview, deferred_publish)
+
+def publish_details(partitions, output_file, config):
+    """发布代理明细，并按代理去重保存结果文件的历史快照（快照保存失败不影响本次结果）"""
+    partitions.publish()
+    if snapshots.is_enabled(config):
+        try:
+            snapshots.write_snapshot(output_file, config)
+        except Exception as e:
+            print(f"历史快照保存失败: {str(e)}")
+
+def run_analysis(resume, fetchers, output_dir, preview, deferred_publish=None):
+    """执行代理商分析（参数见 main）"""
     try:
         # 记录开始时间
         start_time = time.time()
@@ -423,71 +777,222 @@ def main():
         # 准备输出目录
         timestamp = time.strftime("%Y%m%d_%H%M%S")
         project_root = Path(__file__).parent.parent
-        output_dir = project_root / config["output_dir"]
+        output_dir = Path(output_dir) if output_dir else project_root / config["output_dir"]
         output_dir.mkdir(parents=True, exist_ok=True)
+        
+        if preview:
+            run_preview(config, output_dir)
+            print(f"\n总耗时: {time.time() - start_time:.2f} 秒")
+            print(metabase_client.summary())
+            return
+        
         output_file = output_dir / f"agent_analysis_{timestamp}.csv"
+        # 写入过程中使用临时文件，全部完成后再替换，页面不会读到半成品
+        temp_file = output_dir / f"agent_analysis_{timestamp}.csv.tmp"
         
-        all_results = []
-        for db_id in config["target_databases"]:
-            print(f"\n处理数据库 {db_id}...")
-            
-            try:
-                # 获取各类数据
-                base_data = get_base_user_data(metabase, db_id)
-                if not base_data:
-                    print(f"数据库 {db_id} 基础数据获取失败")
-                    continue
-                    
-                charge_data = get_charge_data(metabase, db_id)
-                game_data = get_game_data(metabase, db_id)
-                invite_data = get_invite_data(metabase, db_id)
-                
-                # 转换为DataFrame
-                base_df = pd.read_csv(StringIO(base_data))
-                charge_df = pd.read_csv(StringIO(charge_data)) if charge_data else pd.DataFrame()
-                game_df = pd.read_csv(StringIO(game_data)) if game_data else pd.DataFrame()
-                invite_df = pd.read_csv(StringIO(invite_data)) if invite_data else pd.DataFrame()
-                
-                # 处理数据
-                result = process_data(base_df, charge_df, game_df, invite_df)
-                if not result.empty:
-                    all_results.append(result)
-                    print(f"数据库 {db_id} 处理完成，获取到 {len(result)} 条记录")
+        # 各查询的数据来源
+        fetch = dict(FETCHERS)
+        # 用到代理维度表的查询按配置中的维度缓存目录和探测间隔读取
+        fetch["base"] = functools.partial(get_base_user_data, config=config)
+        fetch["invite"] = functools.partial(get_invite_data, config=config)
+        fetch.update(fetchers or {})
+        
+        # 检查点：每个 (数据库, 查询) 的拉取结果和每个数据库的处理结果
+        run = checkpoint.start_run("agent_analysis", config, resume=resume)
+        
+        # 打开本地分析库（未安装duckdb或配置关闭时按配置的引擎在内存中计算）
+        store = local_store.connect(config) if local_store.is_enabled(config) else None
+        engine = engines.resolve_engine(config) if store is None else None
+        
+        # pandas计算时按数据库分发到进程池（DuckDB、polars 本身已多线程执行，无需进程池）
+        executor = None
+        workers = get_process_workers(config)
+        if engine is not None and engine != engines.REFERENCE:
+            print(f"使用 {engine} 引擎计算")
+        elif store is None and workers > 1:
+            executor = ProcessPoolExecutor(
+                max_workers=workers,
+                mp_context=multiprocessing.get_context("spawn")
+            )
+            print(f"使用进程池处理数据，进程数: {workers}")
+        
+        # 取消时中断本地分析库中正在执行的查询
+        token = cancellation.current()
+        release_interrupt = token.on_cancel(store.interrupt) if token is not None and store is not None else None
+        
+        # 按代理排序的明细（供单代理详情页按需读取），全部完成后整体替换
+        partitions = agent_partitions.AgentStoreWriter(config)
+        
+        # 各数据库每个代理的去重草图，与结果文件一起保存，供跨数据库/代理分组去重汇总
+        sketch_precision = hll.precision_for_error(hll.get_sketch_config(config)["relative_error"])
+        sketch_frames = []
+        
+        def record_details(db_id, rows, sketches):
+            if rows is not None:
+                partitions.record(db_id, rows)
+            if sketches is not None:
+                sketch_frames.append(sketches)
+        
+        def write_partitions(db_id, base_data, charge_data, game_data):
+            record_details(db_id, *write_database_details(
+                partitions.staging_dir, db_id, base_data, charge_data, game_data, sketch_precision, config
+            ))
+        
+        futures = {}
+        total_records = 0
+        # 存在拉取失败的数据库：结果照常写入，但不保存处理结果检查点，下次运行重新拉取
+        incomplete_dbs = set()
+        
+        def write_result(db_id, result):
+            nonlocal total_records
+            if result.empty:
+                return
+            append_result(result, temp_file, write_header=(total_records == 0))
+            total_records += len(result)
+            print(f"数据库 {db_id} 处理完成，获取到 {len(result)} 条记录")
+        
+        try:
+            for db_id in config["target_databases"]:
+                cancellation.check()
+                print(f"\n处理数据库 {db_id}...")
                 
-            except Exception as e:
-                print(f"处理数据库 {db_id} 时发生错误: {str(e)}")
-                import traceback
-                print(traceback.format_exc())
-                continue
+                try:
+                    # 已完成处理的数据库直接复用结果
+                    if run.has(f"{db_id}/result"):
+                        print(f"数据库 {db_id} 复用检查点中的处理结果")
+                        write_result(db_id, run.load_frame(f"{db_id}/result"))
+                        if run.has(f"{db_id}/base"):
+                            write_partitions(
+                                db_id,
+                                run.load_text(f"{db_id}/base"),
+                                run.load_text(f"{db_id}/charge") if run.has(f"{db_id}/charge") else None,
+                                run.load_text(f"{db_id}/game") if run.has(f"{db_id}/game") else None
+                            )
+                        continue
+                    
+                    # 获取各类数据（已拉取成功的查询直接复用检查点）
+                    base_data = run.fetch_text(f"{db_id}/base", lambda: fetch["base"](metabase, db_id) or None)
+                    if not base_data:
+                        print(f"数据库 {db_id} 基础数据获取失败")
+                        continue
+                        
+                    charge_data = run.fetch_text(f"{db_id}/charge", lambda: fetch["charge"](metabase, db_id))
+                    game_data = run.fetch_text(f"{db_id}/game", lambda: fetch["game"](metabase, db_id))
+                    invite_data = run.fetch_text(f"{db_id}/invite", lambda: fetch["invite"](metabase, db_id))
+                    if charge_data is None or game_data is None or invite_data is None:
+                        incomplete_dbs.add(db_id)
+                    
+                    if executor is not None:
+                        # 提交到进程池后立即拉取下一个数据库，拉取与计算重叠进行
+                        # 明细和去重草图也在子进程中生成，主进程不再解析CSV
+                        future = executor.submit(
+                            process_database_csv, base_data, charge_data, game_data, invite_data,
+                            db_id, config, db_id not in incomplete_dbs,
+                            str(partitions.staging_dir), sketch_precision
+                        )
+                        futures[future] = db_id
+                        continue
+                    write_partitions(db_id, base_data, charge_data, game_data)
+                    
+                    # 转换为DataFrame
+                    cancellation.check()
+                    base_df = pd.read_csv(StringIO(base_data))
+                    charge_df = pd.read_csv(StringIO(charge_data)) if charge_data else pd.DataFrame()
+                    game_df = pd.read_csv(StringIO(game_data)) if game_data else pd.DataFrame()
+                    invite_df = pd.read_csv(StringIO(invite_data)) if invite_data else pd.DataFrame()
+                    
+                    # 处理数据：优先落地到本地分析库并在库内计算；只重算有变化的代理
+                    if store is not None:
+                        local_store.land_table(store, "raw_tg_user", base_df, db_id)
+                        local_store.land_table(store, "raw_game_charges", charge_df, db_id)
+                        local_store.land_table(store, "raw_game_count", game_df, db_id)
+                        local_store.land_table(store, "raw_invite_stats", invite_df, db_id)
+                        compute = lambda frames, agent_ids: process_data_in_store(store, db_id, agent_ids)
+                    else:
+                        compute = lambda frames, _: process_data(*frames, engine=engine)
+                    result = agent_state.process_incremental(
+                        db_id,
+                        (base_df, charge_df, game_df, invite_df),
+                        compute,
+                        config,
+                        save=db_id not in incomplete_dbs
+                    )
+                    if db_id not in incomplete_dbs and not result.empty:
+                        run.save_frame(f"{db_id}/result", result)
+                    write_result(db_id, result)
+                    
+                except Exception as e:
+                    print(f"处理数据库 {db_id} 时发生错误: {str(e)}")
+                    import traceback
+                    print(traceback.format_exc())
+                    continue
+            
+            # 按完成顺序接收进程池结果并流式写入（定时检查是否已取消）
+            pending = set(futures)
+            while pending:
+                done, pending = wait(pending, timeout=0.5, return_when=FIRST_COMPLETED)
+                cancellation.check()
+                for future in done:
+                    db_id = futures[future]
+                    try:
+                        result_bytes, rows, sketch_bytes = future.result()
+                        record_details(db_id, rows, columnar.from_ipc_bytes(sketch_bytes) if sketch_bytes else None)
+                        result = columnar.from_ipc_bytes(result_bytes)
+                        if db_id not in incomplete_dbs and not result.empty:
+                            run.save_bytes(f"{db_id}/result", result_bytes)
+                        write_result(db_id, result)
+                    except Exception as e:
+                        print(f"处理数据库 {db_id} 时发生错误: {str(e)}")
+                        import traceback
+                        print(traceback.format_exc())
+            # 库内计算被中断时也以取消结束，不发布部分结果
+            cancellation.check()
+        except cancellation.Cancelled:
+            # 取消：丢弃未完成的结果文件和明细，不等待进程池中正在执行的任务
+            partitions.discard()
+            if temp_file.exists():
+                temp_file.unlink()
+            print(f"\n代理商分析已取消，已拉取的数据保留在检查点中 (run_id: {run.run_id})")
+            raise
+        finally:
+            if executor is not None:
+                cancelled = token is not None and token.cancelled
+                executor.shutdown(wait=not cancelled, cancel_futures=cancelled)
+            if release_interrupt is not None:
+                release_interrupt()
+            if store is not None:
+                store.close()
         
-        # 合并所有结果
-        if all_results:
-            final_result = pd.concat(all_results, ignore_index=True)
-            # 填充空值
-            final_result = final_result.fillna({
-                '总用户数': 0,
-                '直属用户数': 0,
-                '最大邀请人数': 0,
-                '总充值金额': 0,
-                '付费用户数': 0,
-                '游戏玩家数': 0,
-                '付费用户平均充值': 0,
-                '人均充值': 0,
-                '活跃天数': 0,
-                '人均日充值': 0,
-                '直属用户占比': '0%',
-                '游戏玩家占比': '0%',
-                '付费率': '0%'
-            })
-            final_result.to_csv(output_file, index=False, encoding='utf-8')
+        # 所有结果写入完成后再发布
+        if total_records > 0:
+            if sketch_frames:
+                hll.write_sketches(hll.sketch_path(output_file), pd.concat(sketch_frames, ignore_index=True))
+            # 列式副本先于结果文件写出，页面读到结果时即可内存映射读取
+            columnar.write_mapped(temp_file, columnar.mapped_path(output_file))
+            temp_file.replace(output_file)
+            if deferred_publish is None:
+                publish_details(partitions, output_file, config)
+            else:
+                deferred_publish.append(
+                    lambda target_dir: publish_details(partitions, Path(target_dir) / output_file.name, config)
+                )
             print(f"\n分析完成，结果已保存到: {output_file}")
-            print(f"总记录数: {len(final_result)}")
+            print(f"总记录数: {total_records}")
         else:
+            partitions.discard()
             print("\n未能获取任何有效数据")
         
+        # 全部数据库都有处理结果时结束本次运行，否则保留检查点供下次续跑
+        missing_dbs = [db_id for db_id in config["target_databases"] if not run.has(f"{db_id}/result")]
+        if missing_dbs:
+            print(f"\n以下数据库未完成: {missing_dbs}，再次运行将只重新执行失败或缺失的部分 (run_id: {run.run_id})")
+        else:
+            run.complete(output_file)
+        
         # 计算总耗时
         total_time = time.time() - start_time
         print(f"\n总耗时: {total_time:.2f} 秒")
+        print(metabase_client.summary())
         
     except Exception as e:
         print(f"发生错误: {str(e)}")
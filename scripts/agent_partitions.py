@@ -0,0 +1,293 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+按代理分组存储的明细数据
+
+agent_analysis 每次运行时把各数据库的用户明细和充值明细写成 Parquet 文件：
+每个 (数据集, 数据库) 一个文件，文件内按 agent_id 排序并切分行组，
+行组自带 agent_id 的最小/最大值统计。查看单个代理时用谓词下推
+（pq.read_table(filters=...)）只读取包含该代理的行组，不需要加载全部明细。
+
+每次运行写到自己的临时目录（staging_*，同时运行的手动刷新和定时批处理互不干扰），
+全部完成后改名为新的版本目录，再原子替换指针文件 CURRENT 指向它：
+读取方总是按指针找到一个完整的版本目录，替换过程中不会出现目录缺失。
+保留上一个版本供正在读取的会话读完，更早的版本在发布时删除。
+
+目录结构：
+    data/agent_store/CURRENT                              当前版本目录名
+    data/agent_store/v_<时间戳>/manifest.json
+    data/agent_store/v_<时间戳>/<数据集>/db_<数据库ID>.parquet
+    data/agent_store/staging_*/                           运行中的临时目录
+"""
+
+import json
+import os
+import shutil
+import tempfile
+import time
+from datetime import datetime
+from io import BytesIO
+from pathlib import Path
+
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.csv as pv
+import pyarrow.parquet as pq
+
+# 项目根目录
+project_root = Path(__file__).parent.parent
+
+# 默认配置，可在 database_config.json 的 "agent_store" 中覆盖
+DEFAULT_AGENT_STORE_CONFIG = {
+    "dir": "data/agent_store",
+    "row_group_rows": 100000  # 每个行组的行数，越小单代理读取越少，但文件元数据越多
+}
+
+# 数据集 -> 列类型
+DATASETS = {
+    "users": {
+        "db_id": pa.int64(),
+        "agent_id": pa.string(),
+        "user_id": pa.int64(),
+        "inviter_user_id": pa.int64(),
+        "create_time": pa.date32(),
+        "update_time": pa.date32(),
+        "game_count": pa.int64()
+    },
+    "charges": {
+        "db_id": pa.int64(),
+        "agent_id": pa.string(),
+        "user_id": pa.int64(),
+        "pay_type": pa.int64(),
+        "real_amount": pa.float64(),
+        "created_at": pa.timestamp("s")
+    }
+}
+
+def get_agent_store_config(config=None):
+    """合并默认配置与 database_config.json 中的 agent_store 配置"""
+    store_config = dict(DEFAULT_AGENT_STORE_CONFIG)
+    if config and isinstance(config.get("agent_store"), dict):
+        store_config.update(config["agent_store"])
+    return store_config
+
+def get_store_dir(config=None):
+    store_dir = Path(get_agent_store_config(config)["dir"])
+    if not store_dir.is_absolute():
+        store_dir = project_root / store_dir
+    return store_dir
+
+# 超过该时长仍未发布的临时目录视为中断运行的残留，新运行开始时删除
+STALE_STAGING_SECONDS = 24 * 3600
+
+def current_dir(config=None):
+    """当前版本的明细目录（按指针文件 CURRENT 查找；没有指针时为旧版本的 current 目录）"""
+    store_dir = get_store_dir(config)
+    try:
+        name = (store_dir / "CURRENT").read_text(encoding="utf-8").strip()
+    except FileNotFoundError:
+        return store_dir / "current"
+    return store_dir / name
+
+def normalize_agent_id(agent_id):
+    """代理ID统一为字符串（与结果表一致，空值为 'NULL'，整数值的浮点ID去掉 .0）"""
+    if agent_id is None:
+        return "NULL"
+    if isinstance(agent_id, float):
+        if agent_id != agent_id:
+            return "NULL"
+        if agent_id.is_integer():
+            return str(int(agent_id))
+    return str(agent_id)
+
+def _read_csv(text, columns):
+    """
+    CSV文本 -> Arrow表，只保留需要的列并按指定类型读取
+    整数ID按浮点读取（导出的CSV中可能带 .0），写出时再转换为整数
+    """
+    if not text:
+        return None
+    table = pv.read_csv(
+        BytesIO(text.encode("utf-8")),
+        convert_options=pv.ConvertOptions(
+            column_types={name: columns[name] for name in columns},
+            include_columns=[name for name in columns],
+            include_missing_columns=True,
+            strings_can_be_null=True
+        )
+    )
+    return table
+
+def _agent_ids(array):
+    """代理ID列：空值填充为 'NULL'，整数ID去掉 .0"""
+    array = pc.replace_substring_regex(array, pattern=r"\.0$", replacement="")
+    return pc.fill_null(array, "NULL")
+
+def _build_users(db_id, base_text, game_text):
+    base = _read_csv(base_text, {
+        "agent_id": pa.string(),
+        "user_id": pa.float64(),
+        "inviter_user_id": pa.float64(),
+        "create_time": pa.date32(),
+        "update_time": pa.date32()
+    })
+    if base is None or base.num_rows == 0:
+        return None
+    # 基础数据按 (代理, 用户) 去重前可能有重复行
+    base = base.group_by(base.column_names, use_threads=False).aggregate([])
+    base = base.set_column(0, "agent_id", _agent_ids(base.column("agent_id")))
+
+    games = _read_csv(game_text, {"user_id": pa.float64(), "game_count": pa.float64()})
+    if games is not None and games.num_rows > 0:
+        base = base.join(games, "user_id", join_type="left outer")
+    else:
+        base = base.append_column("game_count", pa.nulls(base.num_rows, pa.float64()))
+
+    base = base.append_column("db_id", pa.array([db_id] * base.num_rows, pa.int64()))
+    return base.select(list(DATASETS["users"]))
+
+def _build_charges(db_id, charge_text):
+    charges = _read_csv(charge_text, {
+        "user_id": pa.float64(),
+        "agent_id": pa.string(),
+        "amount": pa.float64(),
+        "pay_type": pa.float64(),
+        "created_at": pa.timestamp("s")
+    })
+    if charges is None or charges.num_rows == 0:
+        return None
+    charges = charges.set_column(
+        charges.column_names.index("agent_id"), "agent_id", _agent_ids(charges.column("agent_id"))
+    )
+    # 实际充值金额：pay_type=0 时金额乘以5，pay_type=1 时金额除以50，
+    # 其他值和空值为0（与 process_data 一致）
+    amount = charges.column("amount")
+    pay_type = pc.fill_null(charges.column("pay_type"), -1.0)
+    real_amount = pc.if_else(
+        pc.equal(pay_type, 0),
+        pc.multiply(amount, 5),
+        pc.if_else(pc.equal(pay_type, 1), pc.divide(amount, 50.0), 0.0)
+    )
+    charges = charges.append_column("real_amount", real_amount)
+    charges = charges.append_column("db_id", pa.array([db_id] * charges.num_rows, pa.int64()))
+    return charges.select(list(DATASETS["charges"]))
+
+def _write_sorted(table, path, row_group_rows):
+    """按 agent_id 排序后写出，行组带最小/最大值统计"""
+    table = table.cast(pa.schema([(name, dtype) for name, dtype in DATASETS[path.parent.name].items()]))
+    table = table.sort_by([("agent_id", "ascending"), ("user_id", "ascending")])
+    path.parent.mkdir(parents=True, exist_ok=True)
+    pq.write_table(table, path, row_group_size=row_group_rows, write_statistics=True)
+
+def write_database(staging_dir, db_id, base_text, charge_text, game_text, config=None):
+    """
+    把一个数据库的用户明细和充值明细写到临时目录（可在进程池的子进程中执行）
+    返回 (用户明细, 充值明细, 各数据集行数)，没有数据的明细为None
+    """
+    row_group_rows = get_agent_store_config(config)["row_group_rows"]
+    tables = {
+        "users": _build_users(db_id, base_text, game_text),
+        "charges": _build_charges(db_id, charge_text)
+    }
+    rows = {}
+    for name, table in tables.items():
+        if table is None:
+            continue
+        _write_sorted(table, Path(staging_dir) / name / f"db_{db_id}.parquet", row_group_rows)
+        rows[name] = table.num_rows
+    return tables["users"], tables["charges"], rows
+
+class AgentStoreWriter:
+    """一次运行的明细写出：先写到本次运行独有的临时目录，全部完成后切换为当前版本"""
+
+    def __init__(self, config=None):
+        self.config = config
+        self.store_dir = get_store_dir(config)
+        self.store_dir.mkdir(parents=True, exist_ok=True)
+        self._remove_stale_staging()
+        self.staging_dir = Path(tempfile.mkdtemp(prefix="staging_", dir=self.store_dir))
+        self.rows = {name: 0 for name in DATASETS}
+        self.db_ids = []
+
+    def _remove_stale_staging(self):
+        cutoff = time.time() - STALE_STAGING_SECONDS
+        for path in self.store_dir.glob("staging_*"):
+            try:
+                if path.stat().st_mtime < cutoff:
+                    shutil.rmtree(path, ignore_errors=True)
+            except FileNotFoundError:
+                continue
+
+    def add_database(self, db_id, base_text, charge_text, game_text):
+        """写出一个数据库的用户明细和充值明细，返回 (用户明细, 充值明细) Arrow 表（没有数据时为None）"""
+        users, charges, rows = write_database(self.staging_dir, db_id, base_text, charge_text, game_text, self.config)
+        self.record(db_id, rows)
+        return users, charges
+
+    def record(self, db_id, rows):
+        """登记已写到临时目录的数据库（子进程中由 write_database 写出时在主进程调用）"""
+        for name, count in rows.items():
+            self.rows[name] += count
+        self.db_ids.append(db_id)
+
+    def publish(self):
+        """写入清单，临时目录改名为新版本目录，再原子替换指针文件"""
+        manifest = {
+            "created_at": datetime.now().isoformat(timespec="seconds"),
+            "db_ids": self.db_ids,
+            "rows": self.rows
+        }
+        (self.staging_dir / "manifest.json").write_text(
+            json.dumps(manifest, ensure_ascii=False, indent=2), encoding="utf-8"
+        )
+        previous_dir = current_dir(self.config)
+        version_dir = self.store_dir / f"v_{datetime.now().strftime('%Y%m%d_%H%M%S_%f')}"
+        self.staging_dir.rename(version_dir)
+
+        pointer_tmp = self.store_dir / f"CURRENT.{version_dir.name}.tmp"
+        pointer_tmp.write_text(version_dir.name, encoding="utf-8")
+        os.replace(pointer_tmp, self.store_dir / "CURRENT")
+
+        # 保留上一个版本（可能仍有会话在读取）和此刻指针指向的版本（可能由同时运行的另一次发布写入）
+        keep = {version_dir.name, previous_dir.name, current_dir(self.config).name}
+        for path in list(self.store_dir.glob("v_*")) + [self.store_dir / "current", self.store_dir / "old"]:
+            if path.name not in keep and path.is_dir():
+                shutil.rmtree(path, ignore_errors=True)
+        print(f"代理明细已更新: {self.rows}")
+
+    def discard(self):
+        shutil.rmtree(self.staging_dir, ignore_errors=True)
+
+def get_version(config=None):
+    """当前明细的版本号（清单的修改时间），没有明细时返回None"""
+    manifest_file = current_dir(config) / "manifest.json"
+    if not manifest_file.exists():
+        return None
+    return f"agent_store:{manifest_file.parent.name}:{manifest_file.stat().st_mtime_ns}"
+
+def read_agent(dataset, agent_id, config=None):
+    """
+    读取单个代理的明细（DataFrame）
+    按 agent_id 谓词下推，只读取统计范围包含该代理的行组
+    """
+    dataset_dir = current_dir(config) / dataset
+    if not dataset_dir.exists() or not any(dataset_dir.glob("*.parquet")):
+        return None
+    table = pq.read_table(
+        dataset_dir,
+        schema=pa.schema([(name, dtype) for name, dtype in DATASETS[dataset].items()]),
+        filters=[("agent_id", "=", normalize_agent_id(agent_id))]
+    )
+    return table.to_pandas()
+
+def read_columns(dataset, columns, config=None):
+    """读取全部代理明细中的部分列（DataFrame），没有明细时返回None"""
+    dataset_dir = current_dir(config) / dataset
+    if not dataset_dir.exists() or not any(dataset_dir.glob("*.parquet")):
+        return None
+    table = pq.read_table(
+        dataset_dir,
+        schema=pa.schema([(name, dtype) for name, dtype in DATASETS[dataset].items()]),
+        columns=columns
+    )
+    return table.to_pandas()
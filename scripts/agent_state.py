@@ -0,0 +1,212 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+代理商指标的增量计算
+
+代理商分析的每个指标（总用户数、直属用户数、充值合计、付费/游戏人数、活跃日期范围和天数）
+都只依赖该代理自己的用户、充值和邀请记录。每次运行后按数据库保存：
+- 每个代理的汇总行（计数、合计、首次/最后活跃日期、活跃天数）
+- 每个代理输入行的指纹（该代理所有输入行哈希之和）
+
+下次运行时先计算新数据的指纹，只有指纹变化（新增用户/充值、记录修改、代理改名等）、
+新出现或消失的代理才重新计算，其余代理直接沿用上次的汇总行，
+合并后按全量计算相同的顺序排列，结果与全量重算一致。
+
+每隔 full_every_runs 次运行做一次全量重算；verify=true 时每次都同时全量计算并比对。
+
+目录结构：
+    data/agent_state/db_<数据库ID>.arrow        代理汇总行
+    data/agent_state/db_<数据库ID>.fp.arrow     代理指纹
+    data/agent_state/db_<数据库ID>.json         元信息
+"""
+
+import json
+import os
+from datetime import datetime
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+import columnar
+
+# 项目根目录
+project_root = Path(__file__).parent.parent
+
+# 默认配置，可在 database_config.json 的 "incremental" 中覆盖
+DEFAULT_INCREMENTAL_CONFIG = {
+    "enabled": True,
+    "dir": "data/agent_state",
+    "full_every_runs": 30,  # 连续增量运行该次数后做一次全量重算
+    "verify": False  # 每次同时全量计算并比对（用于核对增量结果）
+}
+
+# 全量计算时结果行的分组键（process_data 按这些列分组，增量合并后按同样的顺序排列）
+GROUP_KEYS = ['agent_id', 'game_user_id', 'username']
+
+def get_incremental_config(config=None):
+    """合并默认配置与 database_config.json 中的 incremental 配置"""
+    incremental_config = dict(DEFAULT_INCREMENTAL_CONFIG)
+    if config and isinstance(config.get("incremental"), dict):
+        incremental_config.update(config["incremental"])
+    return incremental_config
+
+def get_state_dir(config=None):
+    state_dir = Path(get_incremental_config(config)["dir"])
+    if not state_dir.is_absolute():
+        state_dir = project_root / state_dir
+    return state_dir
+
+def _agent_key(series):
+    """与 process_data 相同的代理ID口径：空值为 'NULL'，再转为字符串"""
+    return series.fillna('NULL').astype(str)
+
+def _row_hashes(frame):
+    return pd.util.hash_pandas_object(frame, index=False).to_numpy()
+
+def agent_fingerprints(base_df, charge_df, game_df, invite_df):
+    """
+    每个代理的输入指纹：该代理所有输入行哈希之和（uint64，溢出回绕）
+    用户行附带"是否游戏玩家"标记，游戏次数的变化也会反映到对应代理上
+    """
+    base_df = base_df.dropna(how='all')
+    if not game_df.empty:
+        game_count = pd.to_numeric(game_df['game_count'], errors='coerce')
+        players = pd.to_numeric(game_df['user_id'], errors='coerce')[game_count > 5].unique()
+    else:
+        players = []
+    is_player = pd.to_numeric(base_df['user_id'], errors='coerce').isin(players).to_numpy()
+
+    keys = [_agent_key(base_df['agent_id']).to_numpy()]
+    hashes = [_row_hashes(base_df) ^ np.where(is_player, np.uint64(0x9E3779B97F4A7C15), np.uint64(0))]
+    for frame in (charge_df, invite_df):
+        if not frame.empty:
+            keys.append(_agent_key(frame['agent_id']).to_numpy())
+            hashes.append(_row_hashes(frame))
+
+    rows = pd.DataFrame({'agent_id': np.concatenate(keys), 'hash': np.concatenate(hashes)})
+    return rows.groupby('agent_id')['hash'].sum().astype('uint64')
+
+def changed_agents(fingerprints, previous_fingerprints):
+    """
+    需要重新计算的代理：新增的、指纹有变化的和已不存在的代理
+    指纹只在两次都有的代理上按 uint64 比较（对齐时补空值会转为 float64，丢失 2**53 以上的精度）
+    """
+    previous_fingerprints = previous_fingerprints.astype('uint64')
+    common = fingerprints.index.intersection(previous_fingerprints.index)
+    differs = fingerprints[common].to_numpy(dtype='uint64') != previous_fingerprints[common].to_numpy(dtype='uint64')
+    added = fingerprints.index.difference(previous_fingerprints.index)
+    removed = previous_fingerprints.index.difference(fingerprints.index)
+    return set(common[differs]) | set(added) | set(removed)
+
+def select_agents(base_df, charge_df, game_df, invite_df, agent_ids):
+    """只保留指定代理的输入行（游戏次数按用户统计，不含代理，原样保留）"""
+    def select(frame):
+        if frame.empty:
+            return frame.copy()
+        return frame[_agent_key(frame['agent_id']).isin(agent_ids)].copy()
+    return select(base_df), select(charge_df), game_df.copy(), select(invite_df)
+
+def order_like_full(result):
+    """结果行的顺序：先按分组键排序（即 groupby 的顺序），再按总用户数降序"""
+    result = result.sort_values(GROUP_KEYS).reset_index(drop=True)
+    return result.sort_values('总用户数', ascending=False)
+
+def merge_results(previous, fresh, affected):
+    """上次的汇总行去掉受影响的代理，再补上重新计算的行"""
+    kept = previous[~_agent_key(previous['agent_id']).isin(affected)]
+    frames = [frame for frame in (kept, fresh) if not frame.empty]
+    if not frames:
+        return pd.DataFrame()
+    return order_like_full(pd.concat(frames, ignore_index=True))
+
+def diff_results(result, expected):
+    """比对两份结果，返回不一致的代理ID列表（顺序无关）"""
+    if result.empty or expected.empty:
+        return [] if result.empty and expected.empty else ['<全部>']
+    left = result.sort_values(GROUP_KEYS).reset_index(drop=True)
+    right = expected.sort_values(GROUP_KEYS).reset_index(drop=True)
+    if len(left) != len(right) or list(left.columns) != list(right.columns):
+        return sorted(set(_agent_key(left['agent_id'])) ^ set(_agent_key(right['agent_id']))) or ['<结构>']
+    same = (left == right) | (left.isna() & right.isna())
+    return sorted(_agent_key(left.loc[~same.all(axis=1), 'agent_id']).unique())
+
+def _state_files(db_id, config):
+    state_dir = get_state_dir(config)
+    return (
+        state_dir / f"db_{db_id}.arrow",
+        state_dir / f"db_{db_id}.fp.arrow",
+        state_dir / f"db_{db_id}.json"
+    )
+
+def load_state(db_id, config=None):
+    """读取上次保存的汇总行、指纹和元信息，不存在或损坏时返回None"""
+    result_file, fp_file, meta_file = _state_files(db_id, config)
+    if not (result_file.exists() and fp_file.exists() and meta_file.exists()):
+        return None
+    try:
+        result = columnar.from_ipc_bytes(result_file.read_bytes())
+        fingerprints = columnar.from_ipc_bytes(fp_file.read_bytes()).set_index('agent_id')['hash']
+        meta = json.loads(meta_file.read_text(encoding="utf-8"))
+    except Exception as e:
+        print(f"数据库 {db_id} 的增量状态无法读取，改为全量计算: {str(e)}")
+        return None
+    return result, fingerprints, meta
+
+def _write_atomic(path, data):
+    tmp_path = path.with_name(path.name + ".tmp")
+    tmp_path.write_bytes(data)
+    os.replace(tmp_path, path)
+
+def save_state(db_id, result, fingerprints, runs_since_full, config=None):
+    result_file, fp_file, meta_file = _state_files(db_id, config)
+    result_file.parent.mkdir(parents=True, exist_ok=True)
+    _write_atomic(result_file, columnar.to_ipc_bytes(result))
+    _write_atomic(fp_file, columnar.to_ipc_bytes(fingerprints.rename('hash').rename_axis('agent_id').reset_index()))
+    meta = {
+        "updated_at": datetime.now().isoformat(timespec="seconds"),
+        "agents": int(len(fingerprints)),
+        "runs_since_full": runs_since_full
+    }
+    _write_atomic(meta_file, json.dumps(meta, ensure_ascii=False).encode("utf-8"))
+
+def process_incremental(db_id, frames, compute, config=None, save=True):
+    """
+    增量计算单个数据库的代理指标
+    frames: (base_df, charge_df, game_df, invite_df)
+    compute(frames, agent_ids): 计算给定输入的代理指标，agent_ids 为None表示全部代理，
+                                否则为需要重新计算的代理（frames 已只含这些代理的行）
+    save: 是否保存本次的增量状态（输入不完整时不保存）
+    """
+    incremental_config = get_incremental_config(config)
+    if not incremental_config["enabled"]:
+        return compute(frames, None)
+
+    fingerprints = agent_fingerprints(*frames)
+    state = load_state(db_id, config)
+    full = state is None or state[2].get("runs_since_full", 0) + 1 >= incremental_config["full_every_runs"]
+
+    if full:
+        result = compute(frames, None)
+        runs_since_full = 0
+    else:
+        previous, previous_fingerprints, meta = state
+        affected = changed_agents(fingerprints, previous_fingerprints)
+        print(f"数据库 {db_id} 增量计算：{len(affected)}/{len(fingerprints)} 个代理有变化")
+
+        subset = select_agents(*frames, agent_ids=affected)
+        fresh = compute(subset, sorted(affected)) if affected and not subset[0].empty else pd.DataFrame()
+        result = merge_results(previous, fresh, affected)
+        runs_since_full = meta.get("runs_since_full", 0) + 1
+
+        if incremental_config["verify"]:
+            expected = compute(frames, None)
+            mismatched = diff_results(result, expected)
+            if mismatched:
+                print(f"数据库 {db_id} 增量结果与全量不一致，使用全量结果: {mismatched[:20]}")
+                result = expected
+                runs_since_full = 0
+
+    if save and not result.empty:
+        save_state(db_id, result, fingerprints, runs_since_full, config)
+    return result
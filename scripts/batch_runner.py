@@ -0,0 +1,516 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+每日批量任务
+
+把代理商分析、充值分析、邀请关系三个任务组织成一个有向无环图（DAG）执行：
+- 共享拉取节点：每个数据库的 tg_user / game_charges 每次运行只拉取一次，
+  代理商分析和充值分析的输入都由它们在本地关联得到，不再各自重复查询
+- admin_user 来自维度表缓存（dimensions），只在探测到变化时才重新拉取
+- 各任务特有的查询（游戏次数、邀请统计）作为单独的拉取节点
+- 没有依赖关系的节点并行执行，依赖失败的节点跳过
+- 分析结果先写到临时目录，全部任务结束后统一移动到输出目录，页面不会读到半成品；
+  代理商分析的代理明细和历史快照也在这时随结果文件一起发布
+
+拉取结果保存在检查点中，运行中断后再次执行只重新拉取失败或缺失的部分。
+
+用法：
+    python scripts/batch_runner.py --once                  # 立即执行一次
+    python scripts/batch_runner.py                         # 按配置中的 cron 表达式定时执行
+    python scripts/batch_runner.py --schedule "0 6 * * *"  # 指定 cron 表达式（分 时 日 月 周）
+    python scripts/batch_runner.py --once --jobs agent_analysis,accumulate_recharge
+    python scripts/batch_runner.py --dry-run               # 只打印任务图
+"""
+
+import argparse
+import os
+import shutil
+import sys
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from datetime import datetime, timedelta
+from io import StringIO
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+# 添加项目根目录到系统路径
+project_root = Path(__file__).parent.parent.parent
+script_dir = project_root / "01_Script"
+sys.path.append(str(project_root))
+sys.path.append(str(script_dir))
+sys.path.append(str(Path(__file__).parent))
+from fetch_metabase import load_config
+import metabase_client
+import dimensions
+import checkpoint
+import agent_analysis
+import accumulate_recharge
+import invite_tree
+
+# 默认配置，可在 database_config.json 的 "batch" 中覆盖
+DEFAULT_BATCH_CONFIG = {
+    "schedule": "0 6 * * *",  # 每天 06:00
+    "workers": 4,  # 并行执行的节点数
+    "jobs": ["agent_analysis", "accumulate_recharge", "invite_tree"]
+}
+
+# 两个分析共用的起始日期
+START_DATE = pd.Timestamp("2024-11-01")
+
+# 共享拉取的原始表（每个数据库每次运行只查询一次）
+SHARED_QUERIES = {
+    "tg_user": """
+    SELECT user_id, agent_id, inviter_user_id, enable_flag, create_time, update_time
+    FROM tg_user
+    """,
+    "game_charges": """
+    SELECT user_id, amount, status, pay_type, create_time, created_at
+    FROM game_charges
+    WHERE status = 1
+        AND (create_time >= '2024-11-01' OR created_at >= '2024-11-01')
+    """
+}
+
+# 由维度表缓存提供的共享表（不经过检查点，缓存自身已落盘）
+DIMENSION_TABLES = {
+    "admin_user": dimensions.get_admin_users
+}
+
+# 用到代理维度表的特有查询，调用时传入 config（维度缓存的目录和探测间隔）
+DIMENSION_QUERIES = {"invite"}
+
+# 各任务依赖的共享表和特有查询
+JOB_INPUTS = {
+    "agent_analysis": {
+        "shared": ["tg_user", "admin_user", "game_charges"],
+        "own": {"game": agent_analysis.get_game_data, "invite": agent_analysis.get_invite_data}
+    },
+    "accumulate_recharge": {
+        "shared": ["tg_user", "admin_user", "game_charges"],
+        "own": {}
+    },
+    "invite_tree": {
+        "shared": [],
+        "own": {}
+    }
+}
+
+def get_batch_config(config=None):
+    """合并默认配置与 database_config.json 中的 batch 配置"""
+    batch_config = dict(DEFAULT_BATCH_CONFIG)
+    if config and isinstance(config.get("batch"), dict):
+        batch_config.update(config["batch"])
+    return batch_config
+
+# ---------------------------
+# 由共享表在本地得到各分析的输入（与原查询结果一致）
+# ---------------------------
+
+def _int_ids(series):
+    """ID列转为可空整数，避免带空值时输出为 12.0"""
+    return pd.to_numeric(series, errors="coerce").round().astype("Int64")
+
+def _dates(series):
+    """等价于 SQL 的 DATE(x)"""
+    return pd.to_datetime(series, errors="coerce").dt.strftime("%Y-%m-%d")
+
+def _users(tg_user):
+    users = tg_user.copy()
+    for col in ["user_id", "agent_id", "inviter_user_id"]:
+        users[col] = _int_ids(users[col])
+    return users
+
+def derive_base(tg_user, agents):
+    """等价于 agent_analysis.get_base_user_data 的结果（agents 为代理维度表）"""
+    users = _users(tg_user)
+    users = users[users["enable_flag"] == 1]
+    df = dimensions.attach_agents(users, agents)
+    base = pd.DataFrame({
+        "agent_id": df["agent_id"],
+        "game_user_id": _int_ids(df["game_user_id"]),
+        "username": df["username"],
+        "user_id": df["user_id"],
+        "inviter_user_id": df["inviter_user_id"],
+        "create_time": _dates(df["create_time"]),
+        "update_time": _dates(df["update_time"])
+    })
+    return base.drop_duplicates().to_csv(index=False)
+
+def derive_charge(tg_user, game_charges):
+    """等价于 agent_analysis.get_charge_data 的查询结果"""
+    users = _users(tg_user)
+    users = users.loc[users["enable_flag"] == 1, ["user_id", "agent_id"]]
+    charges = game_charges[pd.to_datetime(game_charges["created_at"], errors="coerce") >= START_DATE].copy()
+    charges["user_id"] = _int_ids(charges["user_id"])
+    df = users.merge(charges, on="user_id")
+    return df[["user_id", "agent_id", "amount", "status", "pay_type", "created_at"]].to_csv(index=False)
+
+def derive_registration(tg_user):
+    """等价于 accumulate_recharge.query_user_registration 的查询结果"""
+    users = _users(tg_user)
+    users["create_time"] = pd.to_datetime(users["create_time"], errors="coerce")
+    df = users[users["create_time"] >= START_DATE]
+    df = df.sort_values(["agent_id", "create_time", "user_id"], na_position="first")
+    registration = pd.DataFrame({
+        "user_id": df["user_id"],
+        "agent_id": df["agent_id"].astype("string").fillna("官方"),
+        "registration_date": df["create_time"].dt.strftime("%Y-%m-%d")
+    })
+    return registration.to_csv(index=False)
+
+def derive_recharge(tg_user, game_charges):
+    """等价于 accumulate_recharge.query_recharge 的查询结果（共享查询已只保留 status=1）"""
+    charges = game_charges.copy()
+    charges["create_time"] = pd.to_datetime(charges["create_time"], errors="coerce")
+    charges = charges[charges["create_time"] >= START_DATE]
+    charges["user_id"] = _int_ids(charges["user_id"])
+    df = charges.merge(_users(tg_user)[["user_id", "agent_id"]], on="user_id", how="left")
+    df = df.sort_values(["user_id", "create_time"])
+
+    pay_type = pd.to_numeric(df["pay_type"], errors="coerce").fillna(0).astype(int)
+    amount = pd.to_numeric(df["amount"], errors="coerce")
+    recharge = pd.DataFrame({
+        "user_id": df["user_id"],
+        "recharge_date": df["create_time"].dt.strftime("%Y-%m-%d"),
+        "pay_type": pay_type,
+        "amount": amount,
+        "adjusted_amount": np.where(pay_type == 0, amount * 5, np.where(pay_type == 1, amount / 50, 0)),
+        "status": df["status"],
+        "agent_id": df["agent_id"]
+    })
+    return recharge.to_csv(index=False)
+
+# ---------------------------
+# 任务图
+# ---------------------------
+
+class Node:
+    """任务图中的一个节点：func(inputs) 的 inputs 为 {依赖节点名: 依赖节点结果}"""
+
+    def __init__(self, name, func, deps=()):
+        self.name = name
+        self.func = func
+        self.deps = list(deps)
+        self.status = "pending"
+        self.result = None
+        self.error = None
+        self.elapsed = None
+        # 结果文件移动到输出目录后执行的发布函数 fn(输出目录)
+        self.on_publish = []
+
+def _run_node(node, by_name):
+    start_time = time.time()
+    try:
+        return node.func({dep: by_name[dep].result for dep in node.deps})
+    finally:
+        node.elapsed = time.time() - start_time
+
+def run_dag(nodes, workers):
+    """按依赖关系执行节点，没有依赖关系的节点并行执行；依赖失败的节点跳过"""
+    by_name = {node.name: node for node in nodes}
+    pending = list(nodes)
+    running = {}
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        while pending or running:
+            progressed = False
+            for node in list(pending):
+                dep_status = [by_name[dep].status for dep in node.deps]
+                if any(status in ("failed", "skipped") for status in dep_status):
+                    node.status = "skipped"
+                    pending.remove(node)
+                    progressed = True
+                    print(f"[跳过] {node.name}（依赖未完成）")
+                elif all(status == "done" for status in dep_status):
+                    node.status = "running"
+                    pending.remove(node)
+                    progressed = True
+                    running[executor.submit(_run_node, node, by_name)] = node
+            if not running:
+                if pending and not progressed:
+                    raise ValueError(f"任务图存在循环依赖: {[node.name for node in pending]}")
+                continue
+
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                node = running.pop(future)
+                try:
+                    node.result = future.result()
+                    node.status = "done"
+                    print(f"[完成] {node.name}（{node.elapsed:.1f} 秒）")
+                except Exception as e:
+                    node.status = "failed"
+                    node.error = e
+                    print(f"[失败] {node.name}: {str(e)}")
+    return nodes
+
+def build_graph(config, jobs, run, staging_dir):
+    """
+    构建任务图
+    - fetch:<表>:<数据库>   共享原始表，多个任务共用
+    - fetch:<查询>:<数据库> 任务特有的查询
+    - job:<任务名>          分析任务，结果写到 staging_dir
+    """
+    metabase = config["metabase"]
+    db_ids = config["target_databases"]
+    nodes = []
+
+    def shared_fetch(db_id, table):
+        if table in DIMENSION_TABLES:
+            return Node(f"fetch:{table}:{db_id}", lambda _: DIMENSION_TABLES[table](metabase, db_id, config))
+
+        def fetch(_):
+            text = run.fetch_text(
+                f"{db_id}/{table}",
+                lambda: metabase_client.query_csv(metabase, db_id, SHARED_QUERIES[table]) or None
+            )
+            if text is None:
+                raise Exception(f"数据库 {db_id} 的 {table} 拉取失败")
+            return pd.read_csv(StringIO(text))
+        return Node(f"fetch:{table}:{db_id}", fetch)
+
+    def own_fetch(db_id, name, query):
+        def fetch(_):
+            kwargs = {"config": config} if name in DIMENSION_QUERIES else {}
+            text = run.fetch_text(f"{db_id}/{name}", lambda: query(metabase, db_id, **kwargs))
+            if text is None:
+                raise Exception(f"数据库 {db_id} 的 {name} 拉取失败")
+            return text
+        return Node(f"fetch:{name}:{db_id}", fetch)
+
+    # 共享拉取节点（多个任务依赖同一张表时只建一个节点）
+    shared_tables = sorted({table for job in jobs for table in JOB_INPUTS[job]["shared"]})
+    for db_id in db_ids:
+        for table in shared_tables:
+            nodes.append(shared_fetch(db_id, table))
+        for job in jobs:
+            for name, query in JOB_INPUTS[job]["own"].items():
+                nodes.append(own_fetch(db_id, name, query))
+
+    def deps_of(job):
+        return [
+            f"fetch:{name}:{db_id}"
+            for db_id in db_ids
+            for name in JOB_INPUTS[job]["shared"] + list(JOB_INPUTS[job]["own"])
+        ]
+
+    if "agent_analysis" in jobs:
+        def run_agent_analysis(inputs):
+            def table(name, db_id):
+                return inputs[f"fetch:{name}:{db_id}"]
+            agent_analysis.main(
+                resume=False,
+                fetchers={
+                    "base": lambda _, db_id: derive_base(table("tg_user", db_id), table("admin_user", db_id)),
+                    "charge": lambda _, db_id: derive_charge(table("tg_user", db_id), table("game_charges", db_id)),
+                    "game": lambda _, db_id: table("game", db_id),
+                    "invite": lambda _, db_id: table("invite", db_id)
+                },
+                output_dir=staging_dir,
+                deferred_publish=agent_node.on_publish
+            )
+            return _collect_outputs(staging_dir, ["agent_analysis_*.hll.arrow", "agent_analysis_*[0-9].arrow", "agent_analysis_*.csv"])
+        agent_node = Node("job:agent_analysis", run_agent_analysis, deps_of("agent_analysis"))
+        nodes.append(agent_node)
+
+    if "accumulate_recharge" in jobs:
+        def run_accumulate_recharge(inputs):
+            def table(name, db_id):
+                return inputs[f"fetch:{name}:{db_id}"]
+            accumulate_recharge.main(
+                resume=False,
+                fetchers={
+                    "user": lambda _, db_id: derive_registration(table("tg_user", db_id)),
+                    "recharge": lambda _, db_id: derive_recharge(table("tg_user", db_id), table("game_charges", db_id))
+                },
+                output_dir=staging_dir
+            )
+            return _collect_outputs(
+                staging_dir,
+                [
+                    "agent_recharge_analysis_*.hll.arrow", "agent_recharge_analysis_*[0-9].arrow",
+                    "agent_recharge_trend_*.csv", "agent_recharge_analysis_*.csv"
+                ]
+            )
+        nodes.append(Node("job:accumulate_recharge", run_accumulate_recharge, deps_of("accumulate_recharge")))
+
+    if "invite_tree" in jobs:
+        # 邀请关系使用独立的查询文件，由 fetch_metabase 直接写入输出目录
+        def run_invite_tree(_):
+            invite_tree.main()
+            return []
+        nodes.append(Node("job:invite_tree", run_invite_tree))
+
+    return nodes
+
+def _collect_outputs(staging_dir, patterns):
+    """任务写到临时目录的结果文件（按 patterns 的顺序发布，草图、列式副本和趋势等附属文件排在结果文件之前）；没有结果时视为失败"""
+    files = [f for pattern in patterns for f in staging_dir.glob(pattern)]
+    if not files:
+        raise Exception("未生成结果文件")
+    return files
+
+def publish(nodes, output_dir):
+    """所有任务结束后，把成功任务的结果文件一起移动到输出目录，再执行各任务的发布函数"""
+    published = []
+    for node in nodes:
+        if node.name.startswith("job:") and node.status == "done":
+            for path in node.result:
+                target = output_dir / path.name
+                os.replace(path, target)
+                published.append(target)
+            for on_publish in node.on_publish:
+                try:
+                    on_publish(output_dir)
+                except Exception as e:
+                    print(f"{node.name} 发布失败: {str(e)}")
+    return published
+
+def run_batch(config, jobs=None, workers=None, resume=True):
+    """执行一次批量任务，返回是否全部成功"""
+    batch_config = get_batch_config(config)
+    jobs = jobs or batch_config["jobs"]
+    workers = workers or batch_config["workers"]
+    start_time = time.time()
+    print(f"\n=== 开始批量任务 {datetime.now().strftime('%Y-%m-%d %H:%M:%S')} ===")
+    print(f"任务: {jobs}，并行数: {workers}")
+
+    # 与页面（config.get_output_dir）和邀请关系分析相同，输出目录相对于本项目根目录
+    output_dir = Path(__file__).parent.parent / config["output_dir"]
+    run = checkpoint.start_run("batch_runner", config, resume=resume)
+    staging_dir = output_dir / f".batch_{run.run_id}"
+    staging_dir.mkdir(parents=True, exist_ok=True)
+
+    try:
+        nodes = run_dag(build_graph(config, jobs, run, staging_dir), workers)
+        published = publish(nodes, output_dir)
+    finally:
+        shutil.rmtree(staging_dir, ignore_errors=True)
+
+    for path in published:
+        print(f"已发布: {path}")
+    failed = [node.name for node in nodes if node.status in ("failed", "skipped")]
+    if failed:
+        print(f"\n以下节点未完成: {failed}，再次运行将复用已拉取的数据 (run_id: {run.run_id})")
+    else:
+        run.complete(output_dir)
+    print(f"\n总耗时: {time.time() - start_time:.2f} 秒")
+    print(metabase_client.summary())
+    return not failed
+
+# ---------------------------
+# 定时执行
+# ---------------------------
+
+class CronSchedule:
+    """五段式 cron 表达式：分 时 日 月 周，支持 * , - / 写法（周日为0或7）"""
+
+    FIELD_RANGES = [(0, 59), (0, 23), (1, 31), (1, 12), (0, 7)]
+
+    def __init__(self, expr):
+        fields = expr.split()
+        if len(fields) != 5:
+            raise ValueError(f"cron 表达式需要5段（分 时 日 月 周）: {expr}")
+        self.expr = expr
+        self.minutes, self.hours, self.days, self.months, weekdays = [
+            self._parse(field, low, high) for field, (low, high) in zip(fields, self.FIELD_RANGES)
+        ]
+        self.weekdays = {day % 7 for day in weekdays}
+        self.any_day = fields[2] == "*"
+        self.any_weekday = fields[4] == "*"
+
+    @staticmethod
+    def _parse(field, low, high):
+        values = set()
+        for part in field.split(","):
+            step = 1
+            if "/" in part:
+                part, step = part.split("/")
+                step = int(step)
+            if part == "*":
+                start, end = low, high
+            elif "-" in part:
+                start, end = map(int, part.split("-"))
+            else:
+                start = int(part)
+                end = high if step > 1 else start
+            if start < low or end > high or start > end or step < 1:
+                raise ValueError(f"cron 字段超出范围: {field}")
+            values.update(range(start, end + 1, step))
+        return values
+
+    def _day_matches(self, t):
+        # 日和周都有限定时，满足其一即可（与 cron 一致）
+        day_ok = t.day in self.days
+        weekday_ok = (t.weekday() + 1) % 7 in self.weekdays
+        if self.any_day and self.any_weekday:
+            return True
+        if self.any_day:
+            return weekday_ok
+        if self.any_weekday:
+            return day_ok
+        return day_ok or weekday_ok
+
+    def next_after(self, dt):
+        """dt 之后的下一次执行时间"""
+        t = dt.replace(second=0, microsecond=0) + timedelta(minutes=1)
+        limit = t + timedelta(days=366 * 5)
+        while t < limit:
+            if t.month not in self.months:
+                t = (t.replace(day=1, hour=0, minute=0) + timedelta(days=32)).replace(day=1)
+                continue
+            if not self._day_matches(t):
+                t = t.replace(hour=0, minute=0) + timedelta(days=1)
+                continue
+            if t.hour not in self.hours:
+                t = t.replace(minute=0) + timedelta(hours=1)
+                continue
+            if t.minute not in self.minutes:
+                t += timedelta(minutes=1)
+                continue
+            return t
+        raise ValueError(f"cron 表达式没有可执行的时间: {self.expr}")
+
+def serve(config, schedule, jobs=None, workers=None):
+    """按 cron 表达式循环执行批量任务"""
+    cron = CronSchedule(schedule)
+    print(f"定时执行: {schedule}")
+    while True:
+        next_run = cron.next_after(datetime.now())
+        print(f"下次执行时间: {next_run.strftime('%Y-%m-%d %H:%M')}")
+        time.sleep(max(0, (next_run - datetime.now()).total_seconds()))
+        try:
+            run_batch(config, jobs, workers)
+        except Exception as e:
+            print(f"批量任务出错：{str(e)}")
+
+def main():
+    parser = argparse.ArgumentParser(description="每日批量任务：代理商分析、充值分析、邀请关系")
+    parser.add_argument("--once", action="store_true", help="立即执行一次后退出")
+    parser.add_argument("--schedule", help="cron 表达式（分 时 日 月 周），默认取配置中的 batch.schedule")
+    parser.add_argument("--jobs", help="逗号分隔的任务名，默认全部：" + ",".join(JOB_INPUTS))
+    parser.add_argument("--workers", type=int, help="并行执行的节点数")
+    parser.add_argument("--no-resume", action="store_true", help="不复用上次未完成运行的拉取结果")
+    parser.add_argument("--dry-run", action="store_true", help="只打印任务图，不执行")
+    args = parser.parse_args()
+
+    config = load_config()
+    jobs = args.jobs.split(",") if args.jobs else None
+    for job in jobs or []:
+        if job not in JOB_INPUTS:
+            parser.error(f"未知任务: {job}")
+
+    if args.dry_run:
+        for node in build_graph(config, jobs or get_batch_config(config)["jobs"], None, None):
+            print(f"{node.name} <- {node.deps}" if node.deps else node.name)
+        return 0
+
+    if args.once:
+        return 0 if run_batch(config, jobs, args.workers, resume=not args.no_resume) else 1
+
+    serve(config, args.schedule or get_batch_config(config)["schedule"], jobs, args.workers)
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,86 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+测量 Home.py 及各分析页面的冷启动耗时和重跑耗时
+
+每个页面在独立的子进程中测量：
+- 冷启动：从进程启动（尚未导入 streamlit/pandas）到页面首次渲染完成
+- 重跑：同一会话内再次执行页面脚本（相当于用户操作一次控件）
+
+用法：
+    python scripts/benchmark_pages.py            # 测量全部页面
+    python scripts/benchmark_pages.py --reruns 20
+"""
+
+import time
+
+# 尽早记录进程启动时间，冷启动耗时包含后续所有导入
+PROCESS_START = time.perf_counter()
+
+import argparse
+import json
+import statistics
+import subprocess
+import sys
+from pathlib import Path
+
+project_root = Path(__file__).parent.parent
+
+def get_page_files():
+    """Home.py 及 pages 目录下的全部页面"""
+    return [project_root / "Home.py"] + sorted((project_root / "pages").glob("*.py"))
+
+def measure_page(page_file, reruns):
+    """在当前进程中测量单个页面（应在新进程中调用，保证冷启动口径）"""
+    from streamlit.testing.v1 import AppTest
+
+    at = AppTest.from_file(str(page_file), default_timeout=600)
+    at.run()
+    cold_start = time.perf_counter() - PROCESS_START
+
+    rerun_times = []
+    for _ in range(reruns):
+        start = time.perf_counter()
+        at.run()
+        rerun_times.append(time.perf_counter() - start)
+
+    rerun_times.sort()
+    return {
+        "page": page_file.name,
+        "cold_start": cold_start,
+        "rerun_median": statistics.median(rerun_times) if rerun_times else None,
+        "rerun_p90": rerun_times[int(len(rerun_times) * 0.9) - 1] if rerun_times else None,
+        "exceptions": [str(e.value) for e in at.exception]
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description="测量Streamlit页面的冷启动与重跑耗时")
+    parser.add_argument("--reruns", type=int, default=10, help="每个页面的重跑次数")
+    parser.add_argument("--page", help="只在当前进程测量指定页面（内部使用）")
+    args = parser.parse_args()
+
+    if args.page:
+        print(json.dumps(measure_page(Path(args.page), args.reruns), ensure_ascii=False))
+        return
+
+    results = []
+    for page_file in get_page_files():
+        proc = subprocess.run(
+            [sys.executable, __file__, "--page", str(page_file), "--reruns", str(args.reruns)],
+            capture_output=True, text=True, cwd=project_root
+        )
+        if proc.returncode != 0:
+            print(f"{page_file.name} 测量失败:\n{proc.stderr}")
+            continue
+        results.append(json.loads(proc.stdout.strip().splitlines()[-1]))
+
+    print(f"\n{'页面':<24}{'冷启动(s)':>12}{'重跑中位数(ms)':>16}{'重跑P90(ms)':>14}")
+    for r in results:
+        median = f"{r['rerun_median'] * 1000:.1f}" if r["rerun_median"] is not None else "-"
+        p90 = f"{r['rerun_p90'] * 1000:.1f}" if r["rerun_p90"] is not None else "-"
+        print(f"{r['page']:<24}{r['cold_start']:>12.2f}{median:>16}{p90:>14}")
+        for exc in r["exceptions"]:
+            print(f"    页面异常: {exc}")
+
+if __name__ == "__main__":
+    main()
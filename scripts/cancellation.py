@@ -0,0 +1,130 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+刷新任务的取消
+
+页面上的刷新任务持有一个 CancelToken，取消（或超时）后：
+- 正在等待的 Metabase 查询立即返回（抛出 Cancelled），后续查询不再发出
+- 各数据库之间、拉取与计算之间检查令牌，未开始的数据库不再处理
+- 进程池中尚未开始的任务被撤销，DuckDB 正在执行的查询被中断
+
+令牌通过 activate() 设为当前上下文的令牌，metabase_client 等底层模块用 current() 取得，
+不需要在每个查询函数上增加参数；没有激活令牌时（批量任务、命令行）行为不变。
+"""
+
+import contextvars
+import threading
+import time
+from contextlib import contextmanager
+
+# 默认配置，可在 database_config.json 的 "refresh" 中覆盖
+DEFAULT_REFRESH_CONFIG = {
+    "timeout_seconds": 1800,  # 页面刷新任务的最长运行时间，超过后自动取消
+    "abandon_after_seconds": 30  # 页面超过该时间没有查看进度（已离开页面）时自动取消
+}
+
+def get_refresh_config(config=None):
+    """合并默认配置与 database_config.json 中的 refresh 配置"""
+    refresh_config = dict(DEFAULT_REFRESH_CONFIG)
+    if config and isinstance(config.get("refresh"), dict):
+        refresh_config.update(config["refresh"])
+    return refresh_config
+
+class Cancelled(BaseException):
+    """
+    任务已被取消或超时
+    与 asyncio.CancelledError 一样继承 BaseException，不会被各处的 except Exception 当作普通错误吞掉
+    """
+
+class CancelToken:
+    """
+    取消令牌
+    timeout 为任务的最长运行时间（秒），超过后视为已取消；为None时不限时
+    """
+
+    def __init__(self, timeout=None):
+        self._event = threading.Event()
+        self._lock = threading.Lock()
+        self._callbacks = []
+        self.deadline = time.monotonic() + timeout if timeout else None
+        self.reason = None
+
+    def cancel(self, reason="任务已取消"):
+        """取消任务并执行已登记的回调（只执行一次）"""
+        with self._lock:
+            if self._event.is_set():
+                return
+            self.reason = reason
+            self._event.set()
+            callbacks, self._callbacks = self._callbacks, []
+        for callback in callbacks:
+            try:
+                callback()
+            except Exception as e:
+                print(f"取消回调执行失败: {str(e)}")
+
+    @property
+    def cancelled(self):
+        if not self._event.is_set() and self.deadline is not None and time.monotonic() >= self.deadline:
+            self.cancel("任务超时")
+        return self._event.is_set()
+
+    def check(self):
+        """已取消时抛出 Cancelled"""
+        if self.cancelled:
+            raise Cancelled(self.reason)
+
+    def remaining(self):
+        """距超时的剩余秒数，不限时为None"""
+        if self.deadline is None:
+            return None
+        return max(self.deadline - time.monotonic(), 0)
+
+    def wait(self, event, interval=0.2):
+        """
+        等待 event 完成，期间被取消时抛出 Cancelled
+        返回时 event 已完成
+        """
+        while not event.wait(interval):
+            self.check()
+        self.check()
+
+    def on_cancel(self, callback):
+        """
+        登记取消时的回调（已取消时立即执行），返回撤销登记的函数
+        """
+        with self._lock:
+            if not self._event.is_set():
+                self._callbacks.append(callback)
+                return lambda: self._remove(callback)
+        callback()
+        return lambda: None
+
+    def _remove(self, callback):
+        with self._lock:
+            if callback in self._callbacks:
+                self._callbacks.remove(callback)
+
+_current = contextvars.ContextVar("cancel_token", default=None)
+
+def current():
+    """当前上下文的取消令牌，没有时返回None"""
+    return _current.get()
+
+@contextmanager
+def activate(token):
+    """在 with 块内把 token 设为当前令牌（token 为None时不改变当前令牌）"""
+    if token is None:
+        yield current()
+        return
+    reset = _current.set(token)
+    try:
+        yield token
+    finally:
+        _current.reset(reset)
+
+def check():
+    """当前令牌已取消时抛出 Cancelled（没有令牌时不做任何事）"""
+    token = current()
+    if token is not None:
+        token.check()
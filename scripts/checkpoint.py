@@ -0,0 +1,201 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+刷新任务的检查点
+
+每次运行分配一个 run_id，运行过程中每个 (数据库, 查询) 的拉取结果和每个数据库的
+处理结果都保存为一个单元；运行中断或部分数据库失败时，下次运行会续用未完成的
+run_id，只重新执行失败或缺失的单元。
+
+目录结构：
+    data/runs/<任务名>/<run_id>/manifest.json
+    data/runs/<任务名>/<run_id>/<单元文件>
+"""
+
+import json
+import os
+import shutil
+import threading
+import time
+from datetime import datetime
+from pathlib import Path
+
+import columnar
+
+# 项目根目录
+project_root = Path(__file__).parent.parent
+
+# 默认配置，可在 database_config.json 的 "checkpoint" 中覆盖
+DEFAULT_CHECKPOINT_CONFIG = {
+    "dir": "data/runs",
+    "max_age_hours": 12,  # 超过该时间的未完成运行不再续用，避免拼接过旧的数据
+    "keep_runs": 3  # 每个任务保留的最近运行数
+}
+
+def get_checkpoint_config(config=None):
+    """合并默认配置与 database_config.json 中的 checkpoint 配置"""
+    checkpoint_config = dict(DEFAULT_CHECKPOINT_CONFIG)
+    if config and isinstance(config.get("checkpoint"), dict):
+        checkpoint_config.update(config["checkpoint"])
+    return checkpoint_config
+
+def _write_atomic(path, data):
+    """先写临时文件再替换，避免中途失败留下损坏的单元"""
+    temp_path = path.with_name(path.name + ".tmp")
+    with open(temp_path, "wb") as f:
+        f.write(data)
+    os.replace(temp_path, path)
+
+class RunCheckpoint:
+    """一次运行的检查点"""
+
+    def __init__(self, run_dir, manifest):
+        self.run_dir = run_dir
+        self.manifest = manifest
+        # 批量任务中多个线程共用一次运行，清单写入需串行
+        self._lock = threading.RLock()
+
+    @property
+    def run_id(self):
+        return self.manifest["run_id"]
+
+    @property
+    def resumed(self):
+        return self.manifest.get("resumed", False)
+
+    def _save_manifest(self):
+        with self._lock:
+            self.manifest["updated_at"] = datetime.now().isoformat(timespec="seconds")
+            _write_atomic(
+                self.run_dir / "manifest.json",
+                json.dumps(self.manifest, ensure_ascii=False, indent=2).encode("utf-8")
+            )
+
+    def _unit_path(self, key, suffix):
+        return self.run_dir / (key.replace("/", "__") + suffix)
+
+    def has(self, key):
+        """单元是否已成功完成"""
+        unit = self.manifest["units"].get(key)
+        return unit is not None and unit["status"] == "done" and (self.run_dir / unit["file"]).exists()
+
+    def _save(self, key, suffix, data):
+        path = self._unit_path(key, suffix)
+        _write_atomic(path, data)
+        with self._lock:
+            self.manifest["units"][key] = {"status": "done", "file": path.name}
+            self._save_manifest()
+
+    def save_text(self, key, text):
+        self._save(key, ".csv", text.encode("utf-8"))
+
+    def load_text(self, key):
+        return (self.run_dir / self.manifest["units"][key]["file"]).read_text(encoding="utf-8")
+
+    def save_bytes(self, key, data):
+        self._save(key, ".arrow", data)
+
+    def load_bytes(self, key):
+        return (self.run_dir / self.manifest["units"][key]["file"]).read_bytes()
+
+    def save_frame(self, key, df):
+        self.save_bytes(key, columnar.to_ipc_bytes(df))
+
+    def load_frame(self, key):
+        return columnar.from_ipc_bytes(self.load_bytes(key))
+
+    def mark_failed(self, key, error):
+        """记录失败的单元，下次运行时重新执行"""
+        with self._lock:
+            self.manifest["units"][key] = {"status": "failed", "error": str(error)}
+            self._save_manifest()
+
+    def fetch_text(self, key, fetch):
+        """
+        带检查点的拉取：已完成的单元直接读取，否则调用 fetch() 并保存结果
+        fetch() 返回 None 时视为失败，不保存
+        """
+        if self.has(key):
+            print(f"复用检查点: {key}")
+            return self.load_text(key)
+        try:
+            text = fetch()
+        except Exception as e:
+            self.mark_failed(key, e)
+            raise
+        if text is None:
+            self.mark_failed(key, "未获取到数据")
+            return None
+        self.save_text(key, text)
+        return text
+
+    def fetch_frame(self, key, fetch):
+        """带检查点的拉取（结果为DataFrame）"""
+        if self.has(key):
+            print(f"复用检查点: {key}")
+            return self.load_frame(key)
+        try:
+            df = fetch()
+        except Exception as e:
+            self.mark_failed(key, e)
+            raise
+        self.save_frame(key, df)
+        return df
+
+    def failed_units(self):
+        return [key for key, unit in self.manifest["units"].items() if unit["status"] == "failed"]
+
+    def complete(self, output=None):
+        """所有单元完成后标记运行结束，之后的运行不会再续用它"""
+        self.manifest["status"] = "completed"
+        self.manifest["output"] = str(output) if output else None
+        self._save_manifest()
+
+def start_run(job, config=None, resume=True):
+    """
+    开始一次运行：
+    - resume=True 时续用该任务最近一次未完成且未过期的运行
+    - 否则创建新的 run_id
+    """
+    checkpoint_config = get_checkpoint_config(config)
+    job_dir = Path(checkpoint_config["dir"])
+    if not job_dir.is_absolute():
+        job_dir = project_root / job_dir
+    job_dir = job_dir / job
+    job_dir.mkdir(parents=True, exist_ok=True)
+
+    if resume:
+        max_age = checkpoint_config["max_age_hours"] * 3600
+        for run_dir in sorted(job_dir.iterdir(), reverse=True):
+            manifest_file = run_dir / "manifest.json"
+            if not manifest_file.exists():
+                continue
+            manifest = json.loads(manifest_file.read_text(encoding="utf-8"))
+            if manifest.get("status") == "completed":
+                break
+            if time.time() - manifest_file.stat().st_mtime > max_age:
+                break
+            manifest["resumed"] = True
+            run = RunCheckpoint(run_dir, manifest)
+            print(f"续用未完成的运行 {run.run_id}，已完成 {sum(run.has(k) for k in manifest['units'])} 个单元")
+            return run
+
+    run_id = datetime.now().strftime("%Y%m%d_%H%M%S")
+    run_dir = job_dir / run_id
+    run_dir.mkdir(parents=True, exist_ok=True)
+    run = RunCheckpoint(run_dir, {
+        "job": job,
+        "run_id": run_id,
+        "status": "running",
+        "created_at": datetime.now().isoformat(timespec="seconds"),
+        "units": {}
+    })
+    run._save_manifest()
+    _cleanup_runs(job_dir, checkpoint_config["keep_runs"])
+    return run
+
+def _cleanup_runs(job_dir, keep_runs):
+    """只保留最近的若干次运行"""
+    run_dirs = sorted((d for d in job_dir.iterdir() if d.is_dir()), reverse=True)
+    for run_dir in run_dirs[keep_runs:]:
+        shutil.rmtree(run_dir, ignore_errors=True)
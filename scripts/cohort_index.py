@@ -0,0 +1,91 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+按注册日期区间汇总的前缀和索引
+
+充值结果每行是 (代理, 注册日期) 的汇总。索引把所有行按 (代理, 注册日期) 排序，
+对可加的指标列计算累积和；任意日期区间内每个代理的合计只需两次二分查找：
+    合计 = 累积和[区间右端] - 累积和[区间左端]
+人均类指标（ARPU/ARPPU、充值率）由区间合计再计算。每个结果版本构建一次。
+"""
+
+import numpy as np
+import pandas as pd
+
+# 可加的指标列（按区间求和）
+SUM_COLUMNS = [
+    '注册人数',
+    '累积充值_3天', '累积充值_7天', '累积充值_15天', '累积充值_30天', '累积充值_total',
+    '付费用户数_3天', '付费用户数_7天', '付费用户数_15天', '付费用户数_30天',
+    '充值用户累积'
+]
+
+# 人均充值 = 累积充值 / 注册人数，付费人均充值 = 累积充值 / 付费用户数
+PERIODS = ['3天', '7天', '15天', '30天']
+
+class CohortIndex:
+    """每个代理按注册日期的前缀和"""
+
+    def __init__(self, frame):
+        dates = pd.to_datetime(frame['注册日期']).values.astype('datetime64[D]').astype(np.int64)
+        agent_codes, agents = pd.factorize(frame['agent_id'], sort=True)
+        self.agents = agents
+        self.min_date = pd.Timestamp(dates.min(), unit='D') if len(dates) else None
+        self.max_date = pd.Timestamp(dates.max(), unit='D') if len(dates) else None
+
+        # 代理名称（取每个代理的第一条记录）
+        names = frame['agent_username'] if 'agent_username' in frame.columns else pd.Series('', index=frame.index)
+        self.agent_names = pd.Series(names.values, index=agent_codes).groupby(level=0).first().reindex(
+            range(len(agents))).values
+
+        # 排序键：代理编号 * 跨度 + 日期（日期偏移到非负）
+        self._day_offset = int(dates.min()) if len(dates) else 0
+        self._span = int(dates.max()) - self._day_offset + 2 if len(dates) else 1
+        keys = agent_codes.astype(np.int64) * self._span + (dates - self._day_offset)
+        order = np.argsort(keys, kind='stable')
+        self._keys = keys[order]
+
+        # 每列的前缀和，首位补0：cum[i] = 前 i 行之和
+        columns = [col for col in SUM_COLUMNS if col in frame.columns]
+        values = frame[columns].to_numpy(dtype=float)[order]
+        self._columns = columns
+        self._cumsum = np.vstack([np.zeros((1, len(columns))), np.nancumsum(values, axis=0)])
+
+    def _bounds(self, start_date, end_date):
+        """每个代理在 [start_date, end_date] 内的行范围"""
+        start = int(np.datetime64(pd.Timestamp(start_date).date(), 'D').astype(np.int64)) - self._day_offset
+        end = int(np.datetime64(pd.Timestamp(end_date).date(), 'D').astype(np.int64)) - self._day_offset
+        # 超出数据范围的端点截断，保证不会落到相邻代理的键上
+        start = min(max(start, 0), self._span - 1)
+        end = min(max(end, -1), self._span - 2)
+        base = np.arange(len(self.agents), dtype=np.int64) * self._span
+        lo = np.searchsorted(self._keys, base + start, side='left')
+        hi = np.searchsorted(self._keys, base + end, side='right')
+        return lo, hi
+
+    def range_totals(self, start_date, end_date):
+        """
+        日期区间内每个代理的合计及人均指标（只包含区间内有注册的代理）
+        """
+        lo, hi = self._bounds(start_date, end_date)
+        totals = self._cumsum[hi] - self._cumsum[lo]
+        result = pd.DataFrame(totals, columns=self._columns)
+        result.insert(0, 'agent_username', self.agent_names)
+        result.insert(0, 'agent_id', self.agents)
+        result = result[hi > lo].reset_index(drop=True)
+        for col in self._columns:
+            if not col.startswith('累积充值'):
+                result[col] = result[col].round().astype(np.int64)
+
+        users = result['注册人数'].replace(0, np.nan)
+        for period in PERIODS:
+            result[f'{period}ARPU'] = (result[f'累积充值_{period}'] / users).round(3).fillna(0)
+        result['总充值ARPU'] = (result['累积充值_total'] / users).round(3).fillna(0)
+        for period in PERIODS:
+            paying = result[f'付费用户数_{period}'].replace(0, np.nan)
+            result[f'{period}ARPPU'] = (result[f'累积充值_{period}'] / paying).round(3).fillna(0)
+        paying = result['付费用户数_30天'].replace(0, np.nan)
+        result['总充值ARPPU'] = (result['累积充值_total'] / paying).round(3).fillna(0)
+        if '充值用户累积' in result.columns:
+            result['充值率累积'] = (result['充值用户累积'] / users * 100).round(2).fillna(0)
+        return result
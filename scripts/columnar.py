@@ -0,0 +1,71 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+列式缓冲区工具
+
+进程间传递DataFrame时使用 Arrow IPC 字节流代替 pickle：
+序列化只是拷贝列缓冲区，反序列化可直接引用接收到的内存。
+
+发布的结果文件另存一份未压缩的 Arrow IPC 文件（与CSV同名，扩展名为 .arrow），
+页面以内存映射方式读取：数值列（无空值时）和文本列直接引用映射的文件内容，
+多个服务进程共享操作系统页缓存中的同一份数据，加载耗时与文件大小无关。
+"""
+
+from pathlib import Path
+
+import pandas as pd
+import pyarrow as pa
+
+def to_ipc_bytes(df):
+    """DataFrame -> Arrow IPC 字节流"""
+    table = pa.Table.from_pandas(df, preserve_index=False)
+    sink = pa.BufferOutputStream()
+    with pa.ipc.new_stream(sink, table.schema) as writer:
+        writer.write_table(table)
+    return sink.getvalue().to_pybytes()
+
+def from_ipc_bytes(data):
+    """Arrow IPC 字节流 -> DataFrame"""
+    if not data:
+        return pd.DataFrame()
+    table = pa.ipc.open_stream(pa.py_buffer(data)).read_all()
+    return table.to_pandas()
+
+def mapped_path(path):
+    """结果文件对应的 Arrow IPC 文件（同名，扩展名为 .arrow）"""
+    return Path(path).with_suffix(".arrow")
+
+def _mapped_dtype(arrow_type):
+    """文本列保持为 Arrow 字符串（不转换为 Python 对象），其余列使用默认类型"""
+    if pa.types.is_string(arrow_type) or pa.types.is_large_string(arrow_type):
+        return pd.StringDtype("pyarrow")
+    return None
+
+def write_frame(df, mapped_file):
+    """DataFrame 写出为可内存映射读取的 Arrow IPC 文件（先写临时文件再替换）"""
+    mapped_file = Path(mapped_file)
+    temp_file = mapped_file.with_name(mapped_file.name + ".tmp")
+    try:
+        table = pa.Table.from_pandas(df, preserve_index=False)
+        with pa.OSFile(str(temp_file), "wb") as sink:
+            with pa.ipc.new_file(sink, table.schema) as writer:
+                writer.write_table(table)
+        temp_file.replace(mapped_file)
+    except BaseException:
+        temp_file.unlink(missing_ok=True)
+        raise
+
+def write_mapped(csv_path, mapped_file):
+    """
+    按CSV的解析结果写出 Arrow IPC 文件（先写临时文件再替换），列类型与页面读取CSV时一致
+    写出失败时只输出提示，页面仍读取CSV
+    """
+    try:
+        write_frame(pd.read_csv(csv_path), mapped_file)
+    except Exception as e:
+        print(f"列式结果文件写出失败，页面将读取CSV: {str(e)}")
+
+def read_mapped(path):
+    """内存映射读取 Arrow IPC 文件，返回的DataFrame引用映射的内存（只读，不要原地修改）"""
+    table = pa.ipc.open_file(pa.memory_map(str(path))).read_all()
+    return table.to_pandas(split_blocks=True, types_mapper=_mapped_dtype)
@@ -0,0 +1,144 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+维度表缓存
+
+admin_user（代理账号）很小且很少变化，每个数据库只在变化时才重新拉取，
+缓存保存在本地（Arrow 文件 + 指纹），进程内也保留一份。
+判断是否变化用一条探测查询：行数、最大ID、各行 CRC32 之和组成的指纹。
+
+事实查询不再在库端 LEFT JOIN admin_user，拉取回来后通过 attach_agents 在本地按代理ID
+映射出 game_user_id / username（username 为 Categorical，每个代理名只存一份）。
+"""
+
+import json
+import threading
+import time
+from io import StringIO
+from pathlib import Path
+
+import pandas as pd
+
+import columnar
+import metabase_client
+
+# 项目根目录
+project_root = Path(__file__).parent.parent
+
+# 默认配置，可在 database_config.json 的 "dimensions" 中覆盖
+DEFAULT_DIMENSION_CONFIG = {
+    "dir": "data/dimensions",
+    "probe_interval_seconds": 300  # 进程内距上次探测不超过该时间时直接使用缓存
+}
+
+ADMIN_USER_QUERY = """
+SELECT admin_user_id, game_user_id, username
+FROM admin_user
+"""
+
+# 变化探测：任一代理的新增、删除或 game_user_id/username 修改都会改变指纹
+ADMIN_USER_PROBE = """
+SELECT
+    COUNT(*) AS row_count,
+    MAX(admin_user_id) AS max_id,
+    SUM(CRC32(CONCAT_WS('|', admin_user_id, IFNULL(game_user_id, ''), IFNULL(username, '')))) AS checksum
+FROM admin_user
+"""
+
+_lock = threading.Lock()
+# 数据库ID -> (指纹, DataFrame, 上次探测时间)
+_admin_users = {}
+# 数据库ID -> 锁（同一数据库同时只有一个线程探测/拉取，其余等待后直接使用结果）
+_db_locks = {}
+
+def get_dimension_config(config=None):
+    """合并默认配置与 database_config.json 中的 dimensions 配置"""
+    dimension_config = dict(DEFAULT_DIMENSION_CONFIG)
+    if config and isinstance(config.get("dimensions"), dict):
+        dimension_config.update(config["dimensions"])
+    return dimension_config
+
+def _cache_dir(config=None):
+    cache_dir = Path(get_dimension_config(config)["dir"])
+    if not cache_dir.is_absolute():
+        cache_dir = project_root / cache_dir
+    cache_dir.mkdir(parents=True, exist_ok=True)
+    return cache_dir
+
+def _probe(metabase, db_id):
+    """admin_user 的指纹"""
+    csv_data = metabase_client.query_csv(metabase, db_id, ADMIN_USER_PROBE)
+    if not csv_data:
+        raise Exception(f"数据库 {db_id} 的 admin_user 探测失败")
+    row = pd.read_csv(StringIO(csv_data), dtype=str, keep_default_na=False).iloc[0]
+    return "|".join(row[col] for col in ["row_count", "max_id", "checksum"])
+
+def _normalize(admin_user):
+    """统一为 agent_id(Int64) / game_user_id(Int64) / username(Categorical)"""
+    agents = pd.DataFrame({
+        "agent_id": pd.to_numeric(admin_user["admin_user_id"], errors="coerce").astype("Int64"),
+        "game_user_id": pd.to_numeric(admin_user["game_user_id"], errors="coerce").astype("Int64"),
+        "username": admin_user["username"].astype("category")
+    })
+    return agents.dropna(subset=["agent_id"]).drop_duplicates("agent_id").reset_index(drop=True)
+
+def get_admin_users(metabase, db_id, config=None):
+    """
+    获取某个数据库的代理维度表
+    指纹与本地缓存一致时直接使用缓存，否则重新拉取并更新缓存
+    """
+    dimension_config = get_dimension_config(config)
+    with _lock:
+        db_lock = _db_locks.setdefault(db_id, threading.Lock())
+    with db_lock:
+        return _load_admin_users(metabase, db_id, config, dimension_config)
+
+def _load_admin_users(metabase, db_id, config, dimension_config):
+    with _lock:
+        cached = _admin_users.get(db_id)
+    if cached is not None and time.time() - cached[2] < dimension_config["probe_interval_seconds"]:
+        return cached[1]
+
+    fingerprint = _probe(metabase, db_id)
+    if cached is not None and cached[0] == fingerprint:
+        with _lock:
+            _admin_users[db_id] = (fingerprint, cached[1], time.time())
+        return cached[1]
+
+    data_file = _cache_dir(config) / f"admin_user_{db_id}.arrow"
+    meta_file = data_file.with_suffix(".json")
+    agents = None
+    if data_file.exists() and meta_file.exists():
+        meta = json.loads(meta_file.read_text(encoding="utf-8"))
+        if meta.get("fingerprint") == fingerprint:
+            agents = _normalize(columnar.from_ipc_bytes(data_file.read_bytes()))
+
+    if agents is None:
+        print(f"数据库 {db_id} 的 admin_user 有变化，重新拉取")
+        csv_data = metabase_client.query_csv(metabase, db_id, ADMIN_USER_QUERY)
+        if not csv_data:
+            raise Exception(f"数据库 {db_id} 未获取到 admin_user")
+        raw = pd.read_csv(StringIO(csv_data))
+        data_file.write_bytes(columnar.to_ipc_bytes(raw))
+        meta_file.write_text(json.dumps({"fingerprint": fingerprint, "rows": len(raw)}), encoding="utf-8")
+        agents = _normalize(raw)
+
+    with _lock:
+        _admin_users[db_id] = (fingerprint, agents, time.time())
+    return agents
+
+def attach_agents(frame, agents, id_col="agent_id", columns=("game_user_id", "username")):
+    """
+    按代理ID在本地映射代理信息（等价于 LEFT JOIN admin_user ON id_col = admin_user_id）
+    未匹配到的行为空值；username 保持 Categorical
+    """
+    ids = pd.to_numeric(frame[id_col], errors="coerce")
+    positions = pd.Index(agents["agent_id"].astype("float64")).get_indexer(ids)
+    frame = frame.copy()
+    for col in columns:
+        frame[col] = agents[col].array.take(positions, allow_fill=True)
+    return frame
+
+def agent_game_user_ids(agents):
+    """所有代理的 game_user_id（用于排除代理本人）"""
+    return sorted(int(x) for x in agents["game_user_id"].dropna().unique())
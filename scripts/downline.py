@@ -0,0 +1,265 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+邀请关系的多级下线统计
+
+邀请关系 (inviter_user_id, user_id) 构成稀疏邻接矩阵 A（行为邀请者、列为被邀请者）。
+各用户的指标组成矩阵 V（每列一个指标：人数为全1、付费用户为0/1、充值金额为金额），
+第 k 级下线的汇总即 A^k V，逐级做稀疏矩阵乘法 V_k = A V_{k-1} 得到，不需要逐个遍历邀请树。
+每个用户只有一个邀请者时，A^k 的第 i 行恰好对应 i 的第 k 级下线（每个下线只计一次）。
+
+使用 scipy.sparse 的 CSR 矩阵；未安装 scipy 时用 numpy.bincount 按边做同样的乘法。
+
+同一份 CSR 邻接表和按代理分组的用户列表也是邀请关系页面的子图索引：
+按根用户或按代理查看时只提取该子图，再对子图计算布局。
+
+邀请关系由增量维护的邀请森林（invite_forest）发布时，同一时间戳另存合并后的森林
+invite_forest_<ts>.arrow，图直接由森林的邀请者行号和层级构建（InviteGraph.from_forest），
+不需要解析、去重和编码邀请关系表，并带有每个用户的全部下线数（子树大小）。
+"""
+
+import json
+import sys
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+try:
+    from scipy import sparse
+except ImportError:  # 未安装时按边计算，结果相同
+    sparse = None
+
+sys.path.append(str(Path(__file__).parent))
+import agent_partitions
+
+# 默认配置，可在 database_config.json 的 "downline" 中覆盖
+DEFAULT_DOWNLINE_CONFIG = {
+    "levels": 3  # 统计到第几级下线
+}
+
+def get_downline_config(config=None):
+    """合并默认配置与 database_config.json 中的 downline 配置"""
+    downline_config = dict(DEFAULT_DOWNLINE_CONFIG)
+    if config and isinstance(config.get("downline"), dict):
+        downline_config.update(config["downline"])
+    return downline_config
+
+def forest_path(invite_file):
+    """邀请关系文件对应的邀请森林文件（同一时间戳的 invite_forest_<ts>.arrow）"""
+    invite_file = Path(invite_file)
+    return invite_file.with_name(invite_file.name.replace("invite_tree_", "invite_forest_", 1)).with_suffix(".arrow")
+
+def source_path(stats_file):
+    """邀请者排行文件旁记录计算来源的文件（计算时使用的代理明细版本）"""
+    return Path(stats_file).with_suffix(".json")
+
+def write_stats(stats, stats_file, store_version):
+    """保存邀请者排行，并记录充值金额取自哪个版本的代理明细（没有明细时为None）"""
+    stats.to_csv(stats_file, index=False, encoding="utf-8")
+    source_path(stats_file).write_text(
+        json.dumps({"agent_store_version": store_version}, ensure_ascii=False), encoding="utf-8"
+    )
+
+def read_source(path):
+    """读取排行文件的计算来源，返回代理明细版本"""
+    return json.loads(Path(path).read_text(encoding="utf-8")).get("agent_store_version")
+
+def level_columns(levels, with_amounts=True):
+    """各级下线的列名"""
+    columns = []
+    for level in range(1, levels + 1):
+        columns.append(f"{level}级下线数")
+        if with_amounts:
+            columns += [f"{level}级付费用户数", f"{level}级充值金额"]
+    return columns
+
+def user_amounts(config=None):
+    """
+    各用户的实际充值金额合计（Series，索引为用户ID），取自代理商分析写出的充值明细
+    还没有明细时返回None（只统计下线人数）；结果随代理明细版本（agent_partitions.get_version）变化
+    """
+    charges = agent_partitions.read_columns("charges", ["user_id", "real_amount"], config)
+    if charges is None:
+        return None
+    return charges.dropna(subset=["user_id"]).groupby("user_id")["real_amount"].sum()
+
+class InviteGraph:
+    """
+    邀请关系的稀疏邻接矩阵（用户ID编码为 0..n-1 的行列号）
+    按邀请者排列的 CSR 邻接表（indptr / children）同时用于按根用户或按代理提取子图，
+    提取耗时与子图大小成正比，不需要遍历整张邀请关系表
+    """
+
+    def __init__(self, edges):
+        frame = pd.DataFrame({
+            "inviter": pd.to_numeric(edges["inviter_user_id"], errors="coerce"),
+            "user": pd.to_numeric(edges["user_id"], errors="coerce")
+        })
+        if "depth" in edges.columns:
+            frame["depth"] = pd.to_numeric(edges["depth"], errors="coerce")
+        frame = frame.dropna(subset=["inviter", "user"]).drop_duplicates(subset=["inviter", "user"])
+        inviters = frame["inviter"].to_numpy(dtype="int64")
+        users = frame["user"].to_numpy(dtype="int64")
+        codes, ids = pd.factorize(np.concatenate([inviters, users]))
+        depths = None
+        if "depth" in frame.columns:
+            depths = np.full(len(ids), np.nan)
+            depths[codes[len(frame):]] = frame["depth"].to_numpy(dtype=np.float64)
+        self._build(ids, codes[:len(frame)], codes[len(frame):], depths)
+        # 子树大小（含自身）只有由邀请森林构建时才有
+        self.sizes = None
+
+    @classmethod
+    def from_forest(cls, forest):
+        """
+        由邀请森林构建（invite_forest.InviteForest.to_frame() 的表：user_id, parent, depth, subtree_size）
+        每个用户只有一个邀请者且已编码为行号，不需要对邀请关系表去重和编码
+        """
+        graph = cls.__new__(cls)
+        parents = forest["parent"].to_numpy(dtype=np.int64)
+        users = np.flatnonzero(parents >= 0)
+        graph._build(
+            forest["user_id"].to_numpy(dtype=np.int64), parents[users], users,
+            forest["depth"].to_numpy(dtype=np.float64)
+        )
+        graph.sizes = forest["subtree_size"].to_numpy(dtype=np.int64)
+        return graph
+
+    def _build(self, ids, inviters, users, depths):
+        """ids 为行号对应的用户ID，inviters / users 为每条邀请关系两端的行号，depths 为每个用户的层级"""
+        self.ids = pd.Index(ids)
+        # 用户ID的哈希表在首次查找时才建立，这里提前建立，提取子图时按ID定位只需常数时间
+        self.ids.get_indexer(self.ids[:1])
+        self.inviters = inviters
+        self.users = users
+        self.size = len(self.ids)
+
+        # CSR 邻接表：children[indptr[i]:indptr[i + 1]] 为 i 的直接下线
+        order = np.argsort(self.inviters, kind="stable")
+        self.children = self.users[order]
+        self.indptr = np.zeros(self.size + 1, dtype=np.int64)
+        np.cumsum(np.bincount(self.inviters, minlength=self.size), out=self.indptr[1:])
+        # 每个用户的邀请者（行号，没有邀请者为 -1）和在邀请关系表中的层级
+        self.parents = np.full(self.size, -1, dtype=np.int64)
+        self.parents[self.users] = self.inviters
+        self.depths = depths
+
+        self.matrix = None
+        if sparse is not None:
+            self.matrix = sparse.csr_matrix(
+                (np.ones(len(self.children), dtype=np.float64), self.children, self.indptr),
+                shape=(self.size, self.size)
+            )
+
+    def propagate(self, values):
+        """A V：每个用户的直接下线的 V 之和（V 为 n×m 矩阵）"""
+        if self.matrix is not None:
+            return self.matrix @ values
+        return np.column_stack([
+            np.bincount(self.inviters, weights=values[self.users, col], minlength=self.size)
+            for col in range(values.shape[1])
+        ])
+
+    def positions(self, user_ids):
+        """用户ID -> 行号（不在图中的为 -1）"""
+        return self.ids.get_indexer(pd.Index(user_ids))
+
+    def _children_of(self, nodes):
+        """一组用户的全部直接下线：返回 (邀请者行号, 下线行号)"""
+        starts = self.indptr[nodes]
+        counts = self.indptr[nodes + 1] - starts
+        offsets = np.repeat(starts - np.cumsum(counts) + counts, counts) + np.arange(counts.sum())
+        return np.repeat(nodes, counts), self.children[offsets]
+
+    def _edge_ids(self, inviters, users):
+        return list(zip(self.ids[inviters], self.ids[users]))
+
+    def subtree_edges(self, root_user_id, max_depth):
+        """以某个用户为根、max_depth 级以内的邀请关系 [(邀请者ID, 用户ID)]；用户不在邀请关系中时返回None"""
+        root = self.ids.get_indexer([root_user_id])[0]
+        if root < 0:
+            return None
+        frontier = np.array([root])
+        inviter_parts, user_parts = [], []
+        for _ in range(max_depth):
+            inviters, users = self._children_of(frontier)
+            if len(users) == 0:
+                break
+            inviter_parts.append(inviters)
+            user_parts.append(users)
+            frontier = np.unique(users)
+        if not user_parts:
+            return []
+        return self._edge_ids(np.concatenate(inviter_parts), np.concatenate(user_parts))
+
+    def member_edges(self, nodes, max_depth):
+        """
+        一组用户（如某个代理的用户，行号数组）与各自邀请者之间的邀请关系 [(邀请者ID, 用户ID)]
+        只保留邀请关系表中层级不超过 max_depth 的关系
+        """
+        nodes = nodes[self.parents[nodes] >= 0]
+        if self.depths is not None:
+            nodes = nodes[self.depths[nodes] <= max_depth]
+        return self._edge_ids(self.parents[nodes], nodes)
+
+def agent_nodes(graph, config=None):
+    """
+    代理 -> 该代理在邀请关系中的用户（行号数组，按用户数降序），取自代理商分析写出的用户明细
+    还没有明细时为空
+    """
+    users = agent_partitions.read_columns("users", ["agent_id", "user_id"], config)
+    if users is None:
+        return {}
+    positions = graph.positions(users["user_id"])
+    found = positions >= 0
+    frame = pd.DataFrame({
+        "agent_id": users["agent_id"].to_numpy()[found],
+        "node": positions[found]
+    }).drop_duplicates()
+    groups = {agent_id: group.to_numpy() for agent_id, group in frame.groupby("agent_id")["node"]}
+    return dict(sorted(groups.items(), key=lambda item: -len(item[1])))
+
+def downline_stats(edges, user_amounts=None, levels=3):
+    """
+    每个邀请者的直接邀请人数和第 1..levels 级下线的人数、付费用户数、充值金额
+    edges 为邀请关系表或已构建的 InviteGraph
+    user_amounts 为 用户ID -> 实际充值金额（Series），为None时只统计人数
+    返回 DataFrame[邀请者ID, 邀请人数, 1级下线数, 1级付费用户数, 1级充值金额, ...]，按邀请人数降序
+    由邀请森林构建的图在邀请人数后另有 全部下线数（各级下线合计，取自子树大小）
+    """
+    graph = edges if isinstance(edges, InviteGraph) else InviteGraph(edges)
+    with_amounts = user_amounts is not None
+    columns = level_columns(levels, with_amounts)
+    if graph.size == 0:
+        return pd.DataFrame(columns=["邀请者ID", "邀请人数"] + columns)
+
+    # 每个用户的指标：人数、是否付费、充值金额
+    values = np.ones((graph.size, 3 if with_amounts else 1))
+    if with_amounts:
+        amounts = np.zeros(graph.size)
+        positions = graph.positions(pd.to_numeric(user_amounts.index, errors="coerce"))
+        found = positions >= 0
+        np.add.at(amounts, positions[found], user_amounts.to_numpy(dtype=np.float64)[found])
+        values[:, 1] = amounts > 0
+        values[:, 2] = amounts
+
+    result = {}
+    for level in range(1, levels + 1):
+        values = graph.propagate(values)
+        result[f"{level}级下线数"] = values[:, 0]
+        if with_amounts:
+            result[f"{level}级付费用户数"] = values[:, 1]
+            result[f"{level}级充值金额"] = values[:, 2].round(2)
+
+    stats = pd.DataFrame(result)[columns]
+    # 计数列为整数
+    for col in columns:
+        if not col.endswith("充值金额"):
+            stats[col] = stats[col].astype("int64")
+    if graph.sizes is not None:
+        stats.insert(0, "全部下线数", graph.sizes - 1)
+    stats.insert(0, "邀请人数", np.bincount(graph.inviters, minlength=graph.size))
+    stats.insert(0, "邀请者ID", graph.ids.to_numpy())
+    stats = stats[stats["邀请人数"] > 0]
+    return stats.sort_values("邀请人数", ascending=False, kind="stable").reset_index(drop=True)
@@ -0,0 +1,69 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+趋势图降采样
+
+使用 LTTB（Largest-Triangle-Three-Buckets）算法把长时间序列压缩到固定点数，
+保留峰谷等形状特征，图表渲染开销与历史长度无关。
+"""
+
+import numpy as np
+import pandas as pd
+
+# 每条曲线默认保留的点数
+DEFAULT_POINT_BUDGET = 500
+
+def lttb_indices(x, y, threshold):
+    """
+    LTTB 降采样，返回保留点的下标（升序，包含首尾两点）
+    x 需升序；点数不超过 threshold 时返回全部下标
+    """
+    x = np.asarray(x, dtype=float)
+    y = np.asarray(y, dtype=float)
+    n = len(x)
+    if threshold >= n or threshold < 3:
+        return np.arange(n)
+
+    # 空值按0处理，避免三角形面积为NaN
+    y = np.nan_to_num(y, nan=0.0, posinf=0.0, neginf=0.0)
+
+    indices = np.empty(threshold, dtype=np.int64)
+    indices[0] = 0
+    indices[-1] = n - 1
+    # 中间 n-2 个点平均分成 threshold-2 个桶
+    edges = np.linspace(1, n - 1, threshold - 1).astype(np.int64)
+
+    selected = 0
+    for i in range(threshold - 2):
+        start, end = edges[i], edges[i + 1]
+        # 下一个桶的平均点（最后一个桶用末点）
+        if i + 2 < len(edges):
+            next_start, next_end = edges[i + 1], edges[i + 2]
+            avg_x = x[next_start:next_end].mean()
+            avg_y = y[next_start:next_end].mean()
+        else:
+            avg_x, avg_y = x[n - 1], y[n - 1]
+
+        # 当前桶中与上一个选中点、下一个桶平均点围成三角形面积最大的点
+        areas = np.abs(
+            (x[selected] - avg_x) * (y[start:end] - y[selected])
+            - (x[selected] - x[start:end]) * (avg_y - y[selected])
+        )
+        selected = start + int(np.argmax(areas))
+        indices[i + 1] = selected
+    return indices
+
+def downsample_frame(frame, x_col, y_cols, threshold=DEFAULT_POINT_BUDGET):
+    """
+    对多条曲线分别做 LTTB，取保留点的并集
+    frame 需按 x_col 升序
+    """
+    if len(frame) <= threshold:
+        return frame
+    x = frame[x_col]
+    if pd.api.types.is_datetime64_any_dtype(x):
+        x = x.astype("int64")
+    keep = np.unique(np.concatenate([
+        lttb_indices(x, frame[col], threshold) for col in y_cols
+    ]))
+    return frame.iloc[keep]
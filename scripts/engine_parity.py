@@ -0,0 +1,169 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+校验各计算引擎与 pandas 参考实现的结果一致，并比较耗时
+
+随机生成与 Metabase 返回格式相同的输入（含官方账号、维度表中找不到的代理、空值、
+非 0/1 的 pay_type、负金额、注册前的充值、多个数据库的重复用户ID等情况），
+分别用 pandas 和其他引擎计算代理商指标和滚动充值，按分组键逐列比对。
+
+用法：
+    python scripts/engine_parity.py                          # 校验全部引擎
+    python scripts/engine_parity.py --users 1000000 --engine polars
+存在不一致时退出码为1
+"""
+
+import argparse
+import contextlib
+import io
+import sys
+import time
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+sys.path.append(str(Path(__file__).parent))
+import agent_analysis
+import accumulate_recharge
+import agent_state
+import engines
+
+def generate_agent_inputs(rng, users, agents):
+    """代理商分析的四个输入（与 process_database_csv 一样由CSV文本读取）"""
+    user_id = np.arange(1, users + 1) + 10 ** 6
+    agent_id = rng.integers(1, agents + 1, users).astype(float)
+    agent_id[rng.random(users) < 0.05] = np.nan  # 官方账号
+    # 代理维度：编号大于 agents * 0.9 的代理在维度表中找不到
+    known = agent_id <= agents * 0.9
+    game_user_id = np.where(known, agent_id + 5 * 10 ** 5, np.nan)
+    username = np.where(known, pd.Series(agent_id).map(lambda x: f"代理{x:.0f}" if x == x else ""), None)
+    inviter = np.where(rng.random(users) < 0.3, game_user_id, rng.choice(user_id, users))
+    inviter[rng.random(users) < 0.3] = np.nan
+    create_time = pd.Timestamp("2024-10-01") + pd.to_timedelta(rng.integers(0, 120, users), "D")
+    update_time = create_time + pd.to_timedelta(rng.integers(0, 30, users), "D")
+    base = pd.DataFrame({
+        "agent_id": agent_id, "game_user_id": game_user_id, "username": username, "user_id": user_id,
+        "inviter_user_id": inviter,
+        "create_time": create_time.strftime("%Y-%m-%d"),
+        "update_time": np.where(rng.random(users) < 0.02, None, update_time.strftime("%Y-%m-%d"))
+    })
+
+    charges = users * 2
+    charge_users = rng.choice(user_id, charges)
+    charge = pd.DataFrame({
+        "user_id": charge_users,
+        "agent_id": pd.Series(agent_id, index=user_id).reindex(charge_users).to_numpy(),
+        "amount": np.where(rng.random(charges) < 0.01, np.nan, rng.integers(-20, 500, charges).astype(float)),
+        "status": True,
+        "pay_type": rng.choice([0, 1, 2, np.nan], charges, p=[0.6, 0.3, 0.05, 0.05]),
+        "created_at": "2024-11-02 10:00:00"
+    })
+
+    game = pd.DataFrame({"user_id": rng.choice(user_id, users // 2, replace=False)})
+    game["game_count"] = rng.integers(1, 12, len(game))
+
+    # 每个代理邀请人数最多的用户（并列时多条）
+    invite = pd.DataFrame({
+        "agent_id": rng.choice(np.append(np.arange(1, agents + 1, dtype=float), np.nan), agents * 2),
+        "inviter_user_id": rng.choice(user_id, agents * 2),
+        "invite_count": rng.integers(1, 6, agents * 2)
+    })
+
+    def reread(frame):
+        return pd.read_csv(io.StringIO(frame.to_csv(index=False)))
+    return reread(base), reread(charge), reread(game), reread(invite)
+
+def generate_recharge_inputs(rng, users, agents, databases=2):
+    """滚动充值的两个输入（各数据库合并后，与 run_analysis 一致带 db_id）"""
+    user_frames, recharge_frames = [], []
+    for db_id in range(1, databases + 1):
+        # 各数据库使用相同的用户ID区间
+        user_id = np.arange(1, users + 1)
+        agent_id = rng.integers(1, agents + 1, users).astype(str).astype(object)
+        agent_id[rng.random(users) < 0.05] = "官方"
+        registered = pd.Timestamp("2024-11-01") + pd.to_timedelta(rng.integers(0, 100, users), "D")
+        user_frames.append(pd.DataFrame({
+            "user_id": user_id.astype(str),
+            "agent_id": agent_id,
+            "agent_username": np.where(agent_id == "官方", "未知代理", "代理" + agent_id),
+            "注册日期": registered.strftime("%Y-%m-%d"),
+            "db_id": db_id
+        }))
+        charges = users * 2
+        charge_users = rng.choice(user_id, charges) + rng.choice([0, users], charges, p=[0.95, 0.05])  # 少量未注册用户
+        # 注册前后若干天的充值（含注册前，距注册天数为负）
+        charged = pd.Timestamp("2024-11-01") + pd.to_timedelta(rng.integers(-5, 140, charges), "D")
+        pay_type = rng.choice([0, 1], charges)
+        amount = rng.integers(1, 500, charges).astype(float)
+        recharge_frames.append(pd.DataFrame({
+            "user_id": charge_users.astype(str),
+            "充值日期": charged.strftime("%Y-%m-%d"),
+            "pay_type": pay_type,
+            "amount": amount,
+            "调整后金额": np.where(pay_type == 0, amount * 5, amount / 50),
+            "status": 1,
+            "agent_username": "未知代理",
+            "db_id": db_id
+        }))
+    return pd.concat(user_frames, ignore_index=True), pd.concat(recharge_frames, ignore_index=True)
+
+def timed(compute, *frames):
+    """在输入的副本上计算（参考实现会修改输入），不输出调试信息，返回 (结果, 耗时秒)"""
+    frames = [frame.copy() for frame in frames]
+    start = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()):
+        result = compute(*frames)
+    return result, time.perf_counter() - start
+
+def check(title, reference, candidate, keys, engine):
+    """输出比对结果，返回是否一致"""
+    (expected, reference_seconds), (result, seconds) = reference, candidate
+    problems = engines.compare_frames(result, expected, keys)
+    if expected.empty:
+        problems.append("参考实现的结果为空")
+    status = "一致" if not problems else "不一致"
+    print(f"{title}: {engine} {status}，{len(result)} 行，"
+          f"pandas {reference_seconds:.2f}s / {engine} {seconds:.2f}s")
+    for problem in problems:
+        print(f"  - {problem}")
+    return not problems
+
+def main():
+    parser = argparse.ArgumentParser(description="校验计算引擎与 pandas 参考实现的一致性")
+    parser.add_argument("--engine", choices=sorted(engines.ENGINES), help="只校验指定引擎（默认全部）")
+    parser.add_argument("--users", type=int, default=200000, help="每个数据库的用户数")
+    parser.add_argument("--agents", type=int, default=500, help="代理数")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    names = [args.engine] if args.engine else sorted(engines.ENGINES)
+    if engines.pl is None:
+        print("未安装 polars，无法校验")
+        return 1
+
+    rng = np.random.default_rng(args.seed)
+    agent_inputs = generate_agent_inputs(rng, args.users, args.agents)
+    recharge_inputs = generate_recharge_inputs(rng, args.users, args.agents)
+
+    agent_reference = timed(agent_analysis.process_data, *agent_inputs)
+    recharge_reference = timed(accumulate_recharge.calculate_rolling_recharge, *recharge_inputs)
+
+    ok = True
+    for name in names:
+        # 直接调用引擎（不经过出错时回退到参考实现的逻辑），派生指标仍由分析脚本计算
+        engine = engines.get_engine(name)
+        ok &= check(
+            "代理商指标", agent_reference,
+            timed(lambda *frames: agent_analysis.finalize_result(engine.agent_metrics(*frames)), *agent_inputs),
+            agent_state.GROUP_KEYS, name
+        )
+        ok &= check(
+            "滚动充值", recharge_reference,
+            timed(lambda *frames: accumulate_recharge.finalize_rolling(engine.rolling_recharge(*frames)), *recharge_inputs),
+            ['agent_id', 'agent_username', '注册日期'], name
+        )
+    return 0 if ok else 1
+
+if __name__ == "__main__":
+    sys.exit(main())
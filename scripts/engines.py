@@ -0,0 +1,249 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+分析核心的计算引擎
+
+代理商指标（agent_analysis.process_data）和滚动充值（accumulate_recharge.calculate_rolling_recharge）
+的聚合部分可以由不同的引擎计算，派生指标（比率、人均）和列顺序仍由各分析脚本统一处理：
+- pandas：参考实现，即各分析脚本中原有的计算（process_data / aggregate_rolling）
+- polars：多线程、惰性执行的列式实现，整条关联/分组链路交给 polars 优化后执行，
+  单个数据库的计算即可用满全部核心（因此不再需要按数据库分发的进程池）
+
+每个引擎提供两个方法，输入与 pandas 参考实现相同（读取CSV得到的原始 DataFrame），
+输出为 finalize_result / finalize_rolling 之前的聚合结果（pandas DataFrame）：
+- agent_metrics(base_df, charge_df, game_df, invite_df)
+- rolling_recharge(df_user, df_recharge)
+
+引擎在 database_config.json 的 "engine" 中选择；只在不使用本地分析库（DuckDB）时生效。
+polars 为可选依赖，未安装时回退到 pandas；与参考实现的一致性用 scripts/engine_parity.py 校验。
+"""
+
+import pandas as pd
+from pandas.api.types import is_numeric_dtype
+
+try:
+    import polars as pl
+except ImportError:  # 未安装时回退到 pandas 参考实现
+    pl = None
+
+# 默认配置，可在 database_config.json 的 "engine" 中覆盖
+DEFAULT_ENGINE_CONFIG = {
+    "name": "pandas"  # pandas（参考实现）或 polars
+}
+
+# 参考实现的引擎名
+REFERENCE = "pandas"
+
+def get_engine_config(config=None):
+    """合并默认配置与 database_config.json 中的 engine 配置"""
+    engine_config = dict(DEFAULT_ENGINE_CONFIG)
+    if config and isinstance(config.get("engine"), dict):
+        engine_config.update(config["engine"])
+    return engine_config
+
+def resolve_engine(config=None):
+    """配置选择的引擎名；未知引擎或依赖未安装时回退到 pandas"""
+    name = get_engine_config(config)["name"] or REFERENCE
+    if name != REFERENCE and name not in ENGINES:
+        print(f"未知的计算引擎 {name}，使用 pandas 计算")
+        return REFERENCE
+    if name == "polars" and pl is None:
+        print("未安装 polars，使用 pandas 计算，如需多线程引擎请执行 pip install polars")
+        return REFERENCE
+    return name
+
+def get_engine(name):
+    """引擎名 -> 引擎实例；pandas 参考实现返回None（由分析脚本自身计算）"""
+    if name == REFERENCE:
+        return None
+    return ENGINES[name]()
+
+def _lazy(df, columns, numeric=()):
+    """
+    pandas -> polars LazyFrame（只取 columns）
+    numeric 中的列按 pd.to_numeric(errors='coerce') 转换（已是数值列时不复制），与参考实现的类型一致
+    """
+    data = {}
+    for col in columns:
+        series = df[col]
+        if col in numeric and not is_numeric_dtype(series):
+            series = pd.to_numeric(series, errors='coerce')
+        data[col] = series
+    return pl.from_pandas(pd.DataFrame(data, copy=False), nan_to_null=True).lazy()
+
+def _agent_id(df):
+    """
+    agent_id 统一为字符串、空值为 'NULL'（与参考实现的 fillna('NULL').astype(str) 一致，
+    数值ID转字符串的格式相同，如 12 -> '12'、12.0 -> '12.0'）
+    """
+    return df.with_columns(pl.col('agent_id').cast(pl.Utf8).fill_null('NULL'))
+
+def _to_datetime(df, col):
+    """文本日期解析为 datetime（无法解析的值为空）"""
+    if df.collect_schema()[col] == pl.Utf8:
+        return pl.col(col).str.to_datetime(strict=False)
+    return pl.col(col).cast(pl.Datetime)
+
+def _nunique(col):
+    """去重计数（不计空值，与 pandas nunique 一致）"""
+    return pl.col(col).drop_nulls().n_unique().cast(pl.Int64)
+
+class PolarsEngine:
+    """polars 引擎：各步骤组成一个惰性查询，最后一次 collect"""
+
+    name = "polars"
+
+    def agent_metrics(self, base_df, charge_df, game_df, invite_df):
+        """代理商指标的聚合部分，口径与 agent_analysis.process_data 一致"""
+        base_df = base_df.dropna(how='all')
+        if base_df.empty:
+            return pd.DataFrame()
+
+        # 官方账号的代理名称；参考实现中用户名保持原类型，只填充空值
+        username = base_df['username'].fillna('官方') if base_df['username'].isna().any() else base_df['username']
+        base = _agent_id(_lazy(
+            base_df.assign(username=username),
+            ['agent_id', 'game_user_id', 'username', 'user_id', 'inviter_user_id', 'create_time', 'update_time'],
+            numeric=('game_user_id', 'user_id', 'inviter_user_id')
+        )).with_columns(pl.col('game_user_id').fill_null(0))
+
+        result = base.group_by(['agent_id', 'game_user_id', 'username']).agg(_nunique('user_id').alias('总用户数'))
+
+        # 直属用户数
+        direct_users = base.filter(
+            (pl.col('inviter_user_id') == pl.col('game_user_id')) | pl.col('inviter_user_id').is_null()
+        ).group_by('agent_id').agg(_nunique('user_id').alias('直属用户数'))
+        result = result.join(direct_users, on='agent_id', how='left')
+
+        # 最大邀请人数
+        if not invite_df.empty:
+            invites = _agent_id(_lazy(invite_df, ['agent_id', 'invite_count'], numeric=('invite_count',)))
+            max_invites = invites.group_by('agent_id').agg(pl.col('invite_count').max().alias('最大邀请人数'))
+            result = result.join(max_invites, on='agent_id', how='left')
+        else:
+            result = result.with_columns(pl.lit(0).alias('最大邀请人数'))
+
+        # 充值：按 (代理, 用户) 汇总实际充值金额，只统计实际充值大于0的用户
+        if not charge_df.empty:
+            charges = _agent_id(_lazy(charge_df, ['agent_id', 'user_id', 'amount', 'pay_type'], numeric=('amount', 'pay_type')))
+            real_amount = (
+                pl.when(pl.col('pay_type') == 0).then(pl.col('amount') * 5)
+                .when(pl.col('pay_type') == 1).then(pl.col('amount') / 50)
+                .otherwise(0)
+            )
+            per_user = (
+                charges.filter(pl.col('user_id').is_not_null())
+                .group_by(['agent_id', 'user_id']).agg(real_amount.sum().alias('real_amount'))
+                .filter(pl.col('real_amount') > 0)
+            )
+            charge_by_agent = per_user.group_by('agent_id').agg(
+                pl.col('real_amount').sum().alias('总充值金额'),
+                _nunique('user_id').alias('付费用户数')
+            )
+            result = result.join(charge_by_agent, on='agent_id', how='left')
+        else:
+            result = result.with_columns(pl.lit(0).alias('总充值金额'), pl.lit(0).alias('付费用户数'))
+
+        # 游戏玩家数：游戏次数大于5的用户
+        if not game_df.empty:
+            games = _lazy(game_df, ['user_id', 'game_count'], numeric=('user_id', 'game_count'))
+            players = games.filter(pl.col('game_count') > 5).select('user_id').unique()
+            game_stats = base.join(players, on='user_id', how='semi').group_by('agent_id').agg(
+                _nunique('user_id').alias('游戏玩家数')
+            )
+            result = result.join(game_stats, on='agent_id', how='left')
+        else:
+            result = result.with_columns(pl.lit(0).alias('游戏玩家数'))
+
+        # 活跃日期：注册和更新日期合在一起的首次、最后日期和不同日期数
+        dates = pl.concat([
+            base.select('agent_id', _to_datetime(base, col).dt.date().alias('d'))
+            for col in ('create_time', 'update_time')
+        ]).drop_nulls('d')
+        date_stats = dates.group_by('agent_id').agg(
+            pl.col('d').min().alias('首次活跃日期'),
+            pl.col('d').max().alias('最后活跃日期'),
+            pl.col('d').n_unique().alias('活跃天数')
+        )
+        result = result.join(date_stats, on='agent_id', how='left')
+
+        result = result.collect().to_pandas()
+        # 与参考实现一致：日期列为 datetime.date
+        for col in ['首次活跃日期', '最后活跃日期']:
+            result[col] = pd.to_datetime(result[col]).dt.date
+        return result
+
+    def rolling_recharge(self, df_user, df_recharge):
+        """按（代理, 注册日期）的滚动充值聚合，口径与 accumulate_recharge.aggregate_rolling 一致"""
+        keys = ['agent_id', 'agent_username', '注册日期']
+        # 多个数据库的用户ID可能重复，存在db_id时一并作为关联键
+        join_keys = ['db_id', 'user_id'] if 'db_id' in df_user.columns and 'db_id' in df_recharge.columns else ['user_id']
+
+        users = _lazy(df_user, list(dict.fromkeys(join_keys + keys)))
+        users = users.with_columns(_to_datetime(users, '注册日期'))
+        recharge = _lazy(df_recharge, join_keys + ['充值日期', '调整后金额'], numeric=('调整后金额',))
+        recharge = recharge.with_columns(_to_datetime(recharge, '充值日期'))
+
+        # 每天每个代理的新注册人数（分组键为空的行不计，与 pandas groupby 一致）
+        users = users.drop_nulls(keys)
+        daily_users = users.group_by(keys).agg(_nunique('user_id').alias('注册人数'))
+
+        # 充值关联注册信息（空的关联键也相互匹配，与 pandas merge 一致），按天取整计算距注册天数
+        merged = recharge.join(users, on=join_keys, how='inner', nulls_equal=True).with_columns(
+            ((pl.col('充值日期') - pl.col('注册日期')).dt.total_milliseconds() // 86_400_000).alias('自注册起天数')
+        )
+        amount = pl.col('调整后金额')
+        window_sums = [
+            pl.when(pl.col('自注册起天数') <= days).then(amount).otherwise(0).sum().alias(f'累积充值_{days}天')
+            for days in (3, 7, 15, 30)
+        ]
+        # 付费用户数_N天 与参考实现一致，均为累积到查询时刻的充值用户数
+        payers = [_nunique('user_id').alias(f'付费用户数_{days}天') for days in (3, 7, 15, 30)]
+        rolling = merged.group_by(keys).agg(
+            *window_sums,
+            amount.sum().alias('累积充值_total'),
+            *payers,
+            _nunique('user_id').alias('充值用户累积')
+        )
+
+        # 没有充值的批次在 pandas 中补0（与参考实现一致，存在这类批次时计数列为浮点）
+        df_final = daily_users.join(rolling, on=keys, how='left').sort(keys).collect().to_pandas().fillna(0)
+        df_final['注册日期'] = df_final['注册日期'].astype('datetime64[ns]')
+        return df_final
+
+# 可选引擎：{引擎名: 引擎类}
+ENGINES = {
+    "polars": PolarsEngine
+}
+
+def compare_frames(result, expected, keys, atol=1e-4):
+    """
+    比对两个引擎的结果（按 keys 对齐，与行顺序和整数/浮点类型无关）
+    数值列允许 atol 的误差（浮点求和顺序不同，四舍五入后可能差最后一位）
+    返回不一致的描述列表，一致时为空
+    """
+    problems = []
+    if list(result.columns) != list(expected.columns):
+        return [f"列不一致: {list(result.columns)} != {list(expected.columns)}"]
+    if len(result) != len(expected):
+        problems.append(f"行数不一致: {len(result)} != {len(expected)}")
+    left = result.set_index(keys)
+    right = expected.set_index(keys)
+    missing = right.index.difference(left.index)
+    extra = left.index.difference(right.index)
+    if len(missing):
+        problems.append(f"缺少 {len(missing)} 行，例如 {list(missing[:3])}")
+    if len(extra):
+        problems.append(f"多出 {len(extra)} 行，例如 {list(extra[:3])}")
+    common = left.index.intersection(right.index)
+    left, right = left.loc[common], right.loc[common]
+    for col in left.columns:
+        a, b = left[col], right[col]
+        if is_numeric_dtype(a) and is_numeric_dtype(b):
+            same = (a.astype(float) - b.astype(float)).abs().le(atol) | (a.isna() & b.isna())
+        else:
+            same = (a.astype(str) == b.astype(str)) | (a.isna() & b.isna())
+        if not same.all():
+            bad = same[~same].index
+            problems.append(f"列 {col} 有 {len(bad)} 行不一致，例如 {bad[0]}: {a.loc[bad[0]]!r} != {b.loc[bad[0]]!r}")
+    return problems
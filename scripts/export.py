@@ -0,0 +1,134 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+结果表格的导出
+
+导出文件只在用户点击生成时才写出，按 (结果版本, 筛选条件, 格式) 缓存在磁盘上，
+同样的导出再次请求时直接复用。写出时按块处理，不在内存中拼出整个文件。
+支持 CSV、Parquet（列式）和 Excel 三种格式。
+"""
+
+import hashlib
+import os
+import tempfile
+import time
+from pathlib import Path
+
+import pandas as pd
+
+# 项目根目录
+project_root = Path(__file__).parent.parent
+
+# 默认配置，可在 database_config.json 的 "export" 中覆盖
+DEFAULT_EXPORT_CONFIG = {
+    "dir": "data/exports",
+    "chunk_rows": 50000,  # 每次写出的行数
+    "keep_files": 50,  # 最多保留的导出文件数
+    "min_age_seconds": 600  # 最近该时长内生成或请求过的文件可能正被其他会话下载，清理时保留
+}
+
+# 格式 -> (扩展名, MIME类型, 显示名)
+FORMATS = {
+    "csv": (".csv", "text/csv", "CSV"),
+    "parquet": (".parquet", "application/vnd.apache.parquet", "Parquet"),
+    "xlsx": (".xlsx", "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet", "Excel")
+}
+
+def get_export_config(config=None):
+    """合并默认配置与 database_config.json 中的 export 配置"""
+    export_config = dict(DEFAULT_EXPORT_CONFIG)
+    if config and isinstance(config.get("export"), dict):
+        export_config.update(config["export"])
+    return export_config
+
+def get_export_dir(config=None):
+    export_dir = Path(get_export_config(config)["dir"])
+    if not export_dir.is_absolute():
+        export_dir = project_root / export_dir
+    export_dir.mkdir(parents=True, exist_ok=True)
+    return export_dir
+
+def export_path(version, filter_key, fmt, config=None):
+    """导出文件的缓存路径"""
+    digest = hashlib.sha1(f"{version}\x00{filter_key}".encode("utf-8")).hexdigest()[:16]
+    return get_export_dir(config) / f"{digest}{FORMATS[fmt][0]}"
+
+def _chunks(frame, chunk_rows):
+    for start in range(0, len(frame), chunk_rows):
+        yield frame.iloc[start:start + chunk_rows]
+
+def _write_csv(frame, path, chunk_rows):
+    with open(path, "w", encoding="utf-8", newline="") as f:
+        if len(frame) == 0:
+            frame.to_csv(f, index=False)
+        for i, chunk in enumerate(_chunks(frame, chunk_rows)):
+            chunk.to_csv(f, index=False, header=(i == 0))
+
+def _write_parquet(frame, path, chunk_rows):
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    schema = pa.Schema.from_pandas(frame, preserve_index=False)
+    with pq.ParquetWriter(path, schema) as writer:
+        for chunk in _chunks(frame, chunk_rows):
+            writer.write_table(pa.Table.from_pandas(chunk, schema=schema, preserve_index=False))
+
+def _write_xlsx(frame, path, chunk_rows):
+    with pd.ExcelWriter(path, engine="openpyxl") as writer:
+        frame.head(0).to_excel(writer, index=False)
+        for i, chunk in enumerate(_chunks(frame, chunk_rows)):
+            chunk.to_excel(writer, index=False, header=False, startrow=1 + i * chunk_rows)
+
+_WRITERS = {"csv": _write_csv, "parquet": _write_parquet, "xlsx": _write_xlsx}
+
+def cached_export(version, filter_key, fmt, config=None):
+    """
+    已生成的导出文件，不存在时返回None
+    返回前更新修改时间，标记为最近使用，清理时不会删除正要提供下载的文件
+    """
+    path = export_path(version, filter_key, fmt, config)
+    try:
+        os.utime(path)
+    except FileNotFoundError:
+        return None
+    return path
+
+def build_export(frame, version, filter_key, fmt, config=None):
+    """
+    生成导出文件并返回路径，已存在时直接复用
+    先写本次请求独有的临时文件再替换，并发生成同一导出时互不覆盖，也不会读到写了一半的文件
+    """
+    path = cached_export(version, filter_key, fmt, config)
+    if path is not None:
+        return path
+
+    export_config = get_export_config(config)
+    path = export_path(version, filter_key, fmt, config)
+    with tempfile.NamedTemporaryFile(dir=path.parent, prefix=f"{path.stem}.", suffix=f".tmp{path.suffix}", delete=False) as f:
+        temp_path = Path(f.name)
+    try:
+        _WRITERS[fmt](frame, temp_path, export_config["chunk_rows"])
+        os.replace(temp_path, path)
+    finally:
+        if temp_path.exists():
+            temp_path.unlink()
+    _cleanup_exports(path.parent, export_config["keep_files"], export_config["min_age_seconds"])
+    return path
+
+def _cleanup_exports(export_dir, keep_files, min_age_seconds):
+    """
+    只保留最近生成或请求过的若干个导出文件
+    最近 min_age_seconds 内使用过的文件（其他会话可能正在下载）和临时文件不删除
+    """
+    files = []
+    for f in export_dir.iterdir():
+        try:
+            if f.is_file() and ".tmp" not in f.name:
+                files.append((f.stat().st_mtime, f))
+        except FileNotFoundError:
+            continue
+    files.sort(key=lambda item: item[0], reverse=True)
+    cutoff = time.time() - min_age_seconds
+    for mtime, f in files[keep_files:]:
+        if mtime < cutoff:
+            f.unlink(missing_ok=True)
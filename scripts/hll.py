@@ -0,0 +1,233 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+可合并的去重计数草图（HyperLogLog）
+
+分析结果里的用户数（总用户数、付费用户数、游戏玩家数、充值用户累积）是按用户ID精确去重的，
+不同数据库、不同注册日期、不同代理的结果只能相加，不能去重合并。
+分析脚本在结果文件旁边另存一份草图文件（<结果文件名>.hll.arrow），
+每个 (数据库, 代理[, 注册日期], 指标) 一个草图；任意汇总（全部数据库、一周的注册批次、一组代理）
+只需合并对应的草图，不需要重新扫描原始数据。
+
+- 精度 p 由配置的相对误差决定（标准误差约 1.04 / sqrt(2^p)）
+- 草图序列化时非零寄存器较少则用稀疏格式（索引 + 值），否则用稠密格式
+- 精度不同的草图合并时折叠到较低的精度
+"""
+
+import math
+import os
+import struct
+
+import numpy as np
+import pandas as pd
+
+import columnar
+
+# 默认配置，可在 database_config.json 的 "sketches" 中覆盖
+DEFAULT_SKETCH_CONFIG = {
+    "relative_error": 0.01,  # 相对标准误差，决定精度 p（0.01 -> p=14，每个稠密草图16KB）
+    "dedupe_across_databases": False  # 不同数据库中相同的用户ID是否视为同一用户
+}
+
+# 序列化格式：魔数、格式（0 稠密 / 1 稀疏）、精度
+_MAGIC = b"H"
+_DENSE = 0
+_SPARSE = 1
+
+MIN_PRECISION = 4
+MAX_PRECISION = 18
+
+def get_sketch_config(config=None):
+    """合并默认配置与 database_config.json 中的 sketches 配置"""
+    sketch_config = dict(DEFAULT_SKETCH_CONFIG)
+    if config and isinstance(config.get("sketches"), dict):
+        sketch_config.update(config["sketches"])
+    return sketch_config
+
+def precision_for_error(relative_error):
+    """满足相对误差所需的精度 p"""
+    p = math.ceil(math.log2((1.04 / relative_error) ** 2))
+    return min(max(p, MIN_PRECISION), MAX_PRECISION)
+
+def relative_error(p):
+    return 1.04 / math.sqrt(1 << p)
+
+def hash_users(db_id, user_ids, config=None):
+    """
+    用户ID -> 64位哈希
+    默认把数据库ID一起哈希（不同数据库的相同ID视为不同用户），
+    dedupe_across_databases=true 时只哈希用户ID；user_ids 不能含空值
+    """
+    ids = pd.to_numeric(pd.Series(user_ids), errors="coerce").round().astype("int64")
+    if get_sketch_config(config)["dedupe_across_databases"]:
+        db_id = 0
+    keys = pd.DataFrame({"db_id": np.full(len(ids), db_id, dtype="int64"), "user_id": ids.to_numpy()})
+    return pd.util.hash_pandas_object(keys, index=False).to_numpy()
+
+def _bit_length(values):
+    """uint64 数组每个元素的二进制位数（0 的位数为 0），分高低32位计算避免浮点误差"""
+    high = (values >> np.uint64(32)).astype(np.float64)
+    low = (values & np.uint64(0xFFFFFFFF)).astype(np.float64)
+    return np.where(high > 0, 32 + np.frexp(high)[1], np.frexp(low)[1]).astype(np.int64)
+
+def _index_rank(hashes, p):
+    """哈希 -> (寄存器索引, 前导零个数 + 1)"""
+    hashes = np.asarray(hashes, dtype=np.uint64)
+    index = (hashes >> np.uint64(64 - p)).astype(np.int64)
+    rest = hashes & np.uint64((1 << (64 - p)) - 1)
+    rank = (64 - p) - _bit_length(rest) + 1
+    return index, rank.astype(np.uint8)
+
+def _fold(p, index, rank, target_p):
+    """把精度 p 的寄存器折叠到较低的精度 target_p"""
+    d = p - target_p
+    if d <= 0:
+        return index, rank
+    dropped = (index & ((1 << d) - 1)).astype(np.uint64)
+    new_rank = np.where(dropped > 0, d - _bit_length(dropped) + 1, d + rank.astype(np.int64))
+    return index >> d, new_rank.astype(np.uint8)
+
+class Sketch:
+    """一个 HyperLogLog 草图（2^p 个寄存器）"""
+
+    def __init__(self, p, registers=None):
+        self.p = p
+        self.registers = registers if registers is not None else np.zeros(1 << p, dtype=np.uint8)
+
+    @classmethod
+    def from_hashes(cls, hashes, p):
+        sketch = cls(p)
+        index, rank = _index_rank(hashes, p)
+        np.maximum.at(sketch.registers, index, rank)
+        return sketch
+
+    @classmethod
+    def from_entries(cls, p, index, rank):
+        sketch = cls(p)
+        np.maximum.at(sketch.registers, index, rank)
+        return sketch
+
+    @classmethod
+    def from_bytes(cls, data):
+        p, index, rank = decode(data)
+        return cls.from_entries(p, index, rank)
+
+    def to_bytes(self):
+        index = np.flatnonzero(self.registers)
+        return encode(self.p, index, self.registers[index])
+
+    def merge(self, other):
+        """合并两个草图（精度不同时折叠到较低的精度）"""
+        p = min(self.p, other.p)
+        merged = Sketch(p)
+        for sketch in (self, other):
+            index = np.flatnonzero(sketch.registers)
+            index, rank = _fold(sketch.p, index, sketch.registers[index], p)
+            np.maximum.at(merged.registers, index, rank)
+        return merged
+
+    @property
+    def error(self):
+        """相对标准误差"""
+        return relative_error(self.p)
+
+    def count(self):
+        """基数估计（小基数时使用线性计数）"""
+        m = 1 << self.p
+        alpha = {16: 0.673, 32: 0.697, 64: 0.709}.get(m, 0.7213 / (1 + 1.079 / m))
+        estimate = alpha * m * m / np.sum(np.ldexp(1.0, -self.registers.astype(np.int64)))
+        zeros = int(np.count_nonzero(self.registers == 0))
+        if estimate <= 2.5 * m and zeros > 0:
+            estimate = m * math.log(m / zeros)
+        return float(estimate)
+
+def encode(p, index, rank):
+    """寄存器（非零项）-> 字节串；非零项较少时用稀疏格式"""
+    index = np.asarray(index, dtype=np.uint32)
+    rank = np.asarray(rank, dtype=np.uint8)
+    if len(index) * 5 < (1 << p):
+        return _MAGIC + struct.pack("<BBI", _SPARSE, p, len(index)) + index.tobytes() + rank.tobytes()
+    registers = np.zeros(1 << p, dtype=np.uint8)
+    registers[index] = rank
+    return _MAGIC + struct.pack("<BB", _DENSE, p) + registers.tobytes()
+
+def decode(data):
+    """字节串 -> (精度, 非零寄存器索引, 值)"""
+    if data[:1] != _MAGIC:
+        raise ValueError("不是有效的草图数据")
+    fmt, p = struct.unpack_from("<BB", data, 1)
+    if fmt == _SPARSE:
+        (count,) = struct.unpack_from("<I", data, 3)
+        index = np.frombuffer(data, dtype=np.uint32, count=count, offset=7).astype(np.int64)
+        rank = np.frombuffer(data, dtype=np.uint8, count=count, offset=7 + 4 * count)
+        return p, index, rank
+    registers = np.frombuffer(data, dtype=np.uint8, count=1 << p, offset=3)
+    index = np.flatnonzero(registers)
+    return p, index, registers[index]
+
+def merge_all(sketches):
+    """合并一组序列化的草图，返回 Sketch（为空时返回None）"""
+    decoded = [decode(data) for data in sketches]
+    if not decoded:
+        return None
+    p = min(item[0] for item in decoded)
+    folded = [_fold(item_p, index, rank, p) for item_p, index, rank in decoded]
+    return Sketch.from_entries(
+        p,
+        np.concatenate([index for index, _ in folded]),
+        np.concatenate([rank for _, rank in folded])
+    )
+
+def group_sketches(keys, hashes, p):
+    """
+    按分组键为每组构建草图
+    keys: 与 hashes 等长的 DataFrame（分组列）
+    返回分组列 + sketch（序列化后的字节串）
+    """
+    key_cols = list(keys.columns)
+    if len(keys) == 0:
+        return pd.DataFrame(columns=key_cols + ["sketch"])
+    index, rank = _index_rank(hashes, p)
+    frame = keys.reset_index(drop=True).assign(_index=index, _rank=rank)
+    # 先在每组内按寄存器取最大值，再逐组编码
+    registers = frame.groupby(key_cols + ["_index"], sort=True, dropna=False)["_rank"].max().reset_index()
+    rows = []
+    for key, group in registers.groupby(key_cols, sort=False, dropna=False):
+        key = key if isinstance(key, tuple) else (key,)
+        rows.append(key + (encode(p, group["_index"].to_numpy(), group["_rank"].to_numpy()),))
+    return pd.DataFrame(rows, columns=key_cols + ["sketch"])
+
+def rollup(sketches, by=None):
+    """
+    按 by 列（为空时全部合并）合并草图，每个指标给出去重人数估计
+    sketches: 草图表（含 metric、sketch 列）；返回 by + 各指标列
+    """
+    by = list(by or [])
+    rows = []
+    groups = sketches.groupby(by + ["metric"], sort=True, dropna=False) if len(sketches) else []
+    for key, group in groups:
+        key = key if isinstance(key, tuple) else (key,)
+        merged = merge_all(group["sketch"])
+        rows.append(key + (round(merged.count()),))
+    result = pd.DataFrame(rows, columns=by + ["metric", "estimate"])
+    if not by:
+        return result.set_index("metric")["estimate"].to_frame().T.reset_index(drop=True)
+    return result.pivot(index=by, columns="metric", values="estimate").reset_index().rename_axis(columns=None)
+
+def sketch_path(result_path):
+    """结果文件对应的草图文件"""
+    result_path = str(result_path)
+    if result_path.endswith(".csv"):
+        result_path = result_path[:-len(".csv")]
+    return result_path + ".hll.arrow"
+
+def write_sketches(path, sketches):
+    """写出草图表（先写临时文件再替换）"""
+    tmp_path = str(path) + ".tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(columnar.to_ipc_bytes(sketches.reset_index(drop=True)))
+    os.replace(tmp_path, path)
+
+def read_sketches(path):
+    with open(path, "rb") as f:
+        return columnar.from_ipc_bytes(f.read())
@@ -0,0 +1,405 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+邀请森林的增量维护
+
+邀请关系基本只增不改：新注册的用户带着 inviter_user_id 加入，已有的邀请关系几乎不会变化。
+按数据库保存邀请森林的状态（每个用户的邀请者、层级、所在树的根、子树大小），
+每次只拉取上次水位线（已处理的最大用户ID）之后注册的用户：
+新用户作为叶子挂到邀请者下，沿祖先链给每个祖先的子树大小加1，每个新用户耗时 O(层级)。
+祖先链由邀请者数组逐级上溯得到（ancestors），同样是 O(层级)。
+
+以下情况改为全量重建（拉取全部用户，按层级整批计算）：
+- 没有状态、状态损坏，或连续增量运行 full_every_runs 次
+- 已有用户的邀请者发生变化，或先作为邀请者出现的用户补上了自己的邀请者（需要移动整棵子树）
+按计划全量重建或 verify=true 时，同时比对增量结果与全量结果并输出不一致的用户。
+
+邀请关系分析由邀请森林发布（invite_tree），不再整体拉取邀请关系：
+各数据库的森林合并后写出 invite_tree_<ts>.csv（邀请者ID, 用户ID, 层级）和同一时间戳的
+invite_forest_<ts>.arrow，邀请者排行和页面的子图索引直接由森林构建（downline.InviteGraph.from_forest）。
+
+目录结构：
+    data/invite_forest/db_<数据库ID>.arrow      各用户的邀请者、层级、根、子树大小
+    data/invite_forest/db_<数据库ID>.json       元信息（水位线、距上次全量的运行次数）
+"""
+
+import json
+import os
+import sys
+from datetime import datetime
+from io import StringIO
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+sys.path.append(str(Path(__file__).parent))
+import columnar
+import metabase_client
+import cancellation
+
+# 项目根目录
+project_root = Path(__file__).parent.parent
+
+# 默认配置，可在 database_config.json 的 "invite_forest" 中覆盖
+DEFAULT_FOREST_CONFIG = {
+    "enabled": True,
+    "dir": "data/invite_forest",
+    "full_every_runs": 30,  # 连续增量运行该次数后做一次全量重建（并核对增量结果）
+    "verify": False  # 每次同时全量重建并比对
+}
+
+def get_forest_config(config=None):
+    """合并默认配置与 database_config.json 中的 invite_forest 配置"""
+    forest_config = dict(DEFAULT_FOREST_CONFIG)
+    if config and isinstance(config.get("invite_forest"), dict):
+        forest_config.update(config["invite_forest"])
+    return forest_config
+
+def is_enabled(config=None):
+    return bool(get_forest_config(config)["enabled"])
+
+def get_state_dir(config=None):
+    state_dir = Path(get_forest_config(config)["dir"])
+    if not state_dir.is_absolute():
+        state_dir = project_root / state_dir
+    return state_dir
+
+def get_invites(metabase, db_id, watermark=None):
+    """用户及其邀请者；watermark 不为None时只取用户ID大于水位线的新用户"""
+    after = f"AND t.user_id > {int(watermark)}" if watermark is not None else ""
+    query = f"""
+    SELECT
+        t.user_id,
+        t.inviter_user_id
+    FROM tg_user t
+    WHERE t.enable_flag = 1 {after}
+    ORDER BY t.user_id
+    """
+    return metabase_client.query_csv(metabase, db_id, query)
+
+def _invite_pairs(user_ids, inviter_ids):
+    """
+    (用户ID, 邀请者ID) 整理为整数数组，按用户ID升序
+    每个用户只保留第一条，邀请者为空或是自己时视为没有邀请者（-1）
+    """
+    frame = pd.DataFrame({
+        "user": pd.to_numeric(pd.Series(user_ids), errors="coerce").to_numpy(),
+        "inviter": pd.to_numeric(pd.Series(inviter_ids), errors="coerce").to_numpy()
+    }).dropna(subset=["user"]).drop_duplicates("user").sort_values("user", kind="stable")
+    users = frame["user"].to_numpy(dtype=np.int64)
+    inviters = frame["inviter"].fillna(-1).to_numpy(dtype=np.int64)
+    inviters[inviters == users] = -1
+    return users, inviters
+
+class InviteForest:
+    """
+    邀请森林：各数组按行号对齐，user_ids[i] 为第 i 行的用户ID
+    parents / roots 为行号（没有邀请者为 -1），sizes 为子树大小（含自身）
+    只作为邀请者出现过的用户也是一行（没有邀请者）
+    """
+
+    def __init__(self, user_ids, parents, depths, roots, sizes):
+        self.user_ids = np.asarray(user_ids, dtype=np.int64)
+        self.parents = np.asarray(parents, dtype=np.int64)
+        self.depths = np.asarray(depths, dtype=np.int64)
+        self.roots = np.asarray(roots, dtype=np.int64)
+        self.sizes = np.asarray(sizes, dtype=np.int64)
+        self._index = pd.Index(self.user_ids)
+
+    def __len__(self):
+        return len(self.user_ids)
+
+    @classmethod
+    def build(cls, user_ids, inviter_ids):
+        """由全部用户的邀请关系全量构建（按层级整批计算层级、根和子树大小）"""
+        users, inviters = _invite_pairs(user_ids, inviter_ids)
+        has_inviter = inviters >= 0
+        codes, ids = pd.factorize(np.concatenate([users, inviters[has_inviter]]))
+        parents = np.full(len(ids), -1, dtype=np.int64)
+        parents[codes[:len(users)][has_inviter]] = codes[len(users):]
+        return cls._from_parents(np.asarray(ids, dtype=np.int64), parents)
+
+    @classmethod
+    def _from_parents(cls, ids, parents):
+        size = len(ids)
+        child_nodes = np.flatnonzero(parents >= 0)
+        children = child_nodes[np.argsort(parents[child_nodes], kind="stable")]
+        indptr = np.zeros(size + 1, dtype=np.int64)
+        np.cumsum(np.bincount(parents[child_nodes], minlength=size), out=indptr[1:])
+
+        depths = np.full(size, -1, dtype=np.int64)
+        roots = np.full(size, -1, dtype=np.int64)
+        levels = []
+
+        def walk(frontier):
+            depths[frontier] = 0
+            roots[frontier] = frontier
+            while len(frontier):
+                levels.append(frontier)
+                starts = indptr[frontier]
+                counts = indptr[frontier + 1] - starts
+                offsets = np.repeat(starts - np.cumsum(counts) + counts, counts) + np.arange(counts.sum())
+                frontier = children[offsets]
+                # 断开的邀请关系仍在邻接表中，跳过已经到达的用户
+                frontier = frontier[depths[frontier] < 0]
+                depths[frontier] = depths[parents[frontier]] + 1
+                roots[frontier] = roots[parents[frontier]]
+
+        walk(np.flatnonzero(parents < 0))
+        # 从根出发到达不了的用户在环上（或挂在环下），从环上断开一条邀请关系
+        cut = 0
+        while (depths < 0).any():
+            node = np.flatnonzero(depths < 0)[:1]
+            parents[node] = -1
+            cut += 1
+            walk(node)
+        if cut:
+            print(f"邀请关系中有环，已断开 {cut} 条邀请关系")
+
+        # 子树大小：从最深的一层开始，逐层加到邀请者上
+        sizes = np.ones(size, dtype=np.int64)
+        for level in reversed(levels):
+            level = level[parents[level] >= 0]
+            np.add.at(sizes, parents[level], sizes[level])
+        return cls(ids, parents, depths, roots, sizes)
+
+    def position(self, user_id):
+        """用户ID -> 行号（不在森林中为 -1）"""
+        return int(self._index.get_indexer([user_id])[0])
+
+    def ancestors(self, user_id):
+        """用户的祖先链（邀请者、邀请者的邀请者……直到根），耗时 O(层级)"""
+        chain = []
+        node = self.position(user_id)
+        if node < 0:
+            return chain
+        node = self.parents[node]
+        while node >= 0:
+            chain.append(int(self.user_ids[node]))
+            node = self.parents[node]
+        return chain
+
+    def add_users(self, user_ids, inviter_ids):
+        """
+        增量加入新注册的用户（按用户ID升序），每个新用户沿祖先链更新子树大小，耗时 O(层级)
+        遇到无法增量处理的变化时返回False（本对象不变，需要全量重建）
+        """
+        users, inviters = _invite_pairs(user_ids, inviter_ids)
+        if len(users) == 0:
+            return True
+        user_positions = self._index.get_indexer(users)
+        inviter_positions = self._index.get_indexer(inviters)
+
+        # 每个新用户最多新增两行（自身和首次出现的邀请者）
+        size = len(self)
+        extra = 2 * len(users)
+        ids = np.concatenate([self.user_ids, np.zeros(extra, dtype=np.int64)])
+        parents = np.concatenate([self.parents, np.full(extra, -1, dtype=np.int64)])
+        depths = np.concatenate([self.depths, np.zeros(extra, dtype=np.int64)])
+        roots = np.concatenate([self.roots, np.zeros(extra, dtype=np.int64)])
+        sizes = np.concatenate([self.sizes, np.ones(extra, dtype=np.int64)])
+        added = {}
+
+        def append(user_id):
+            nonlocal size
+            ids[size] = user_id
+            roots[size] = size
+            added[user_id] = size
+            size += 1
+            return size - 1
+
+        for user_id, inviter_id, user_pos, inviter_pos in zip(users, inviters, user_positions, inviter_positions):
+            if inviter_id < 0:
+                parent = -1
+            else:
+                parent = inviter_pos if inviter_pos >= 0 else added.get(inviter_id)
+                if parent is None:
+                    parent = append(inviter_id)
+            node = user_pos if user_pos >= 0 else added.get(user_id, -1)
+            if node >= 0:
+                # 已有的用户：邀请者不变则跳过，否则需要移动整棵子树
+                if parents[node] != parent:
+                    return False
+                continue
+            node = append(user_id)
+            if parent >= 0:
+                parents[node] = parent
+                depths[node] = depths[parent] + 1
+                roots[node] = roots[parent]
+                ancestor = parent
+                while ancestor >= 0:
+                    sizes[ancestor] += 1
+                    ancestor = parents[ancestor]
+
+        self.__init__(ids[:size], parents[:size], depths[:size], roots[:size], sizes[:size])
+        return True
+
+    def to_frame(self):
+        return pd.DataFrame({
+            "user_id": self.user_ids,
+            "parent": self.parents,
+            "depth": self.depths,
+            "root": self.roots,
+            "subtree_size": self.sizes
+        })
+
+    def to_edges(self):
+        """邀请关系表（邀请者ID, 用户ID, 层级），与原邀请关系查询的结果格式一致"""
+        users = np.flatnonzero(self.parents >= 0)
+        return pd.DataFrame({
+            "inviter_user_id": self.user_ids[self.parents[users]],
+            "user_id": self.user_ids[users],
+            "depth": self.depths[users]
+        })
+
+    @classmethod
+    def from_frame(cls, frame):
+        return cls(frame["user_id"], frame["parent"], frame["depth"], frame["root"], frame["subtree_size"])
+
+    def by_user(self):
+        """按用户ID排列的 邀请者ID、层级、根用户ID、子树大小（与行号无关，用于比对）"""
+        parent_ids = np.where(self.parents >= 0, self.user_ids[self.parents], -1)
+        return pd.DataFrame({
+            "inviter_user_id": parent_ids,
+            "depth": self.depths,
+            "root_user_id": self.user_ids[self.roots],
+            "subtree_size": self.sizes
+        }, index=pd.Index(self.user_ids, name="user_id")).sort_index()
+
+def diff_forests(forest, expected):
+    """比对两个邀请森林，返回不一致的用户ID列表"""
+    left, right = forest.by_user(), expected.by_user()
+    mismatched = left.index.symmetric_difference(right.index)
+    common = left.index.intersection(right.index)
+    differs = (left.loc[common] != right.loc[common]).any(axis=1)
+    return sorted(mismatched.union(common[differs.to_numpy()]).tolist())
+
+def merge_forests(forests):
+    """
+    多个数据库的邀请森林合并为一个（后面的森林行号顺延）
+    同一用户ID出现在多个数据库中时按合并后的邀请关系重新构建（与原邀请关系查询一样视为同一用户）
+    """
+    forests = [forest for forest in forests if len(forest)]
+    if len(forests) == 1:
+        return forests[0]
+    user_ids = np.concatenate([forest.user_ids for forest in forests]) if forests else np.zeros(0, dtype=np.int64)
+    if not pd.Index(user_ids).is_unique:
+        inviter_ids = np.concatenate([
+            np.where(forest.parents >= 0, forest.user_ids[forest.parents], -1) for forest in forests
+        ])
+        return InviteForest.build(user_ids, inviter_ids)
+    offsets = np.cumsum([0] + [len(forest) for forest in forests[:-1]])
+    return InviteForest(
+        user_ids,
+        np.concatenate([
+            np.where(forest.parents >= 0, forest.parents + offset, -1) for forest, offset in zip(forests, offsets)
+        ]),
+        np.concatenate([forest.depths for forest in forests]),
+        np.concatenate([forest.roots + offset for forest, offset in zip(forests, offsets)]),
+        np.concatenate([forest.sizes for forest in forests])
+    )
+
+def load_merged(config):
+    """所有目标数据库的邀请森林合并为一个，没有任何数据库的邀请森林时返回None"""
+    forests = []
+    for db_id in config["target_databases"]:
+        state = load_forest(db_id, config)
+        if state is not None:
+            forests.append(state[0])
+    if not forests:
+        return None
+    return merge_forests(forests)
+
+def _state_files(db_id, config):
+    state_dir = get_state_dir(config)
+    return state_dir / f"db_{db_id}.arrow", state_dir / f"db_{db_id}.json"
+
+def load_forest(db_id, config=None):
+    """读取保存的邀请森林和元信息，不存在或损坏时返回None"""
+    forest_file, meta_file = _state_files(db_id, config)
+    if not (forest_file.exists() and meta_file.exists()):
+        return None
+    try:
+        forest = InviteForest.from_frame(columnar.from_ipc_bytes(forest_file.read_bytes()))
+        meta = json.loads(meta_file.read_text(encoding="utf-8"))
+    except Exception as e:
+        print(f"数据库 {db_id} 的邀请森林无法读取，改为全量重建: {str(e)}")
+        return None
+    return forest, meta
+
+def _write_atomic(path, data):
+    tmp_path = path.with_name(path.name + ".tmp")
+    tmp_path.write_bytes(data)
+    os.replace(tmp_path, path)
+
+def save_forest(db_id, forest, watermark, runs_since_full, config=None):
+    forest_file, meta_file = _state_files(db_id, config)
+    forest_file.parent.mkdir(parents=True, exist_ok=True)
+    _write_atomic(forest_file, columnar.to_ipc_bytes(forest.to_frame()))
+    meta = {
+        "updated_at": datetime.now().isoformat(timespec="seconds"),
+        "users": len(forest),
+        "watermark": watermark,
+        "runs_since_full": runs_since_full
+    }
+    _write_atomic(meta_file, json.dumps(meta, ensure_ascii=False).encode("utf-8"))
+
+def _read_invites(csv_data):
+    if not csv_data:
+        return pd.DataFrame(columns=["user_id", "inviter_user_id"])
+    return pd.read_csv(StringIO(csv_data))
+
+def _max_user_id(invites, default=None):
+    user_ids = pd.to_numeric(invites["user_id"], errors="coerce").dropna()
+    return int(user_ids.max()) if len(user_ids) else default
+
+def update_forest(metabase, db_id, config=None, fetch=get_invites):
+    """
+    更新单个数据库的邀请森林：只拉取水位线之后的新用户增量加入，需要时全量重建
+    fetch(metabase, db_id, watermark) 返回CSV文本（user_id, inviter_user_id）
+    """
+    forest_config = get_forest_config(config)
+    state = load_forest(db_id, config)
+    forest, watermark, runs_since_full = None, None, 0
+    full = state is None
+
+    if state is not None:
+        forest, meta = state
+        watermark = meta.get("watermark")
+        runs_since_full = meta.get("runs_since_full", 0) + 1
+        full = runs_since_full >= forest_config["full_every_runs"]
+        invites = _read_invites(fetch(metabase, db_id, watermark))
+        if not forest.add_users(invites["user_id"], invites["inviter_user_id"]):
+            print(f"数据库 {db_id} 有已存在用户的邀请关系发生变化，全量重建邀请森林")
+            forest, full = None, True
+        else:
+            watermark = _max_user_id(invites, watermark)
+            print(f"数据库 {db_id} 邀请森林增量加入 {len(invites)} 个新用户，共 {len(forest)} 个用户")
+
+    if full or forest_config["verify"]:
+        cancellation.check()
+        invites = _read_invites(fetch(metabase, db_id, None))
+        rebuilt = InviteForest.build(invites["user_id"], invites["inviter_user_id"])
+        if forest is not None:
+            mismatched = diff_forests(forest, rebuilt)
+            if mismatched:
+                print(f"数据库 {db_id} 增量维护的邀请森林与全量重建不一致，使用全量结果: {mismatched[:20]}")
+                full = True
+            else:
+                print(f"数据库 {db_id} 增量维护的邀请森林与全量重建一致")
+        if full:
+            forest, watermark, runs_since_full = rebuilt, _max_user_id(invites), 0
+            print(f"数据库 {db_id} 邀请森林已全量重建，共 {len(forest)} 个用户")
+
+    save_forest(db_id, forest, watermark, runs_since_full, config)
+    return forest
+
+def update_forests(config, fetch=get_invites):
+    """更新所有目标数据库的邀请森林（单个数据库失败不影响其他数据库）"""
+    for db_id in config["target_databases"]:
+        cancellation.check()
+        try:
+            update_forest(config["metabase"], db_id, config, fetch)
+        except Exception as e:
+            print(f"数据库 {db_id} 邀请森林更新失败: {str(e)}")
@@ -13,16 +13,102 @@ project_root = Path(__file__).parent.parent.parent
 script_dir = project_root / "01_Script"
 sys.path.append(str(project_root))
 sys.path.append(str(script_dir))
-from fetch_metabase import main as fetch_main
+sys.path.append(str(Path(__file__).parent))
+from fetch_metabase import main as fetch_main, load_config
+import cancellation
+import columnar
+import downline
+import agent_partitions
+import invite_forest
 
-def main():
+def latest_invite_file(config):
+    """最新的邀请关系CSV，没有时返回None"""
+    output_dir = Path(__file__).parent.parent / config["output_dir"]
+    files = list(output_dir.glob("invite_tree_*.csv"))
+    if not files:
+        print("未找到邀请关系数据文件")
+        return None
+    return max(files, key=lambda x: x.stat().st_mtime)
+
+def write_invite_tree(config, fetch=invite_forest.get_invites):
+    """
+    由各数据库增量维护的邀请森林发布邀请关系（只拉取上次之后注册的用户，不再整体拉取邀请关系）
+    写出 invite_tree_<ts>.csv（邀请者ID, 用户ID, 层级）及其列式副本，和同一时间戳的合并森林 invite_forest_<ts>.arrow
+    返回 (邀请关系文件, 合并后的邀请森林)，没有任何数据库的邀请森林时返回 (None, None)
+    """
+    invite_forest.update_forests(config, fetch)
+    cancellation.check()
+    forest = invite_forest.load_merged(config)
+    if forest is None:
+        print("没有可用的邀请森林")
+        return None, None
+
+    output_dir = Path(__file__).parent.parent / config["output_dir"]
+    output_dir.mkdir(parents=True, exist_ok=True)
+    latest_file = output_dir / f"invite_tree_{datetime.now().strftime('%Y%m%d_%H%M%S')}.csv"
+    # 森林和列式副本先于CSV写出：页面按CSV发现新结果时，同一时间戳的其他文件已经完整
+    columnar.write_frame(forest.to_frame(), downline.forest_path(latest_file))
+    edges = forest.to_edges()
+    columnar.write_frame(edges, columnar.mapped_path(latest_file))
+    temp_file = latest_file.with_name(latest_file.name + ".tmp")
+    edges.to_csv(temp_file, index=False, encoding="utf-8")
+    os.replace(temp_file, latest_file)
+    print(f"邀请关系已保存到: {latest_file}（{len(edges)} 条）")
+    return latest_file, forest
+
+def write_inviter_stats(config, latest_file, forest=None):
     """
-    主函数: 执行充值分析流程
+    计算邀请者排行（直接邀请人数和各级下线的人数、付费用户数、充值金额），
+    结果保存为同一时间戳的 invite_inviters_<ts>.csv，页面直接读取
+    forest 为合并后的邀请森林（由森林构建图，另有全部下线数），为None时读取邀请关系CSV
+    旁边的 invite_inviters_<ts>.json 记录充值金额取自的代理明细版本，明细更新后页面改为重新计算
     """
-    # 设置参数并调用fetch_metabase.py的main函数
-    sql_file = str(project_root / "02_Query" / "recharge_analysis.sql")
-    sys.argv = [sys.argv[0], sql_file, "1"]  # 从第1行开始查找SQL
-    fetch_main()
+    if forest is not None:
+        graph = downline.InviteGraph.from_forest(forest.to_frame())
+    else:
+        graph = downline.InviteGraph(pd.read_csv(latest_file, usecols=["inviter_user_id", "user_id"]))
+    cancellation.check()
+    # 先取版本再读明细：读取期间明细被替换时记录的是旧版本，页面会重新计算
+    store_version = agent_partitions.get_version(config)
+    amounts = downline.user_amounts(config)
+    if amounts is None:
+        print("未找到充值明细（需先运行代理商分析），邀请者排行只统计下线人数")
+    inviter_stats = downline.downline_stats(graph, amounts, downline.get_downline_config(config)["levels"])
+
+    stats_file = latest_file.with_name(latest_file.name.replace("invite_tree_", "invite_inviters_", 1))
+    downline.write_stats(inviter_stats, stats_file, store_version)
+    print(f"邀请者排行已保存到: {stats_file}")
+
+def main(token=None, fetchers=None):
+    """
+    主函数: 执行邀请关系分析流程
+    token 为取消令牌；fetchers 可替换数据拉取函数（{"invites": fetch(metabase, db_id, watermark)}）
+    启用邀请森林时由各数据库的森林发布邀请关系，各数据库的查询可随时取消；
+    未启用或没有可用的邀请森林时由 fetch_metabase 整体拉取，取消在拉取结束后、计算邀请者排行前生效
+    """
+    with cancellation.activate(token):
+        config = load_config()
+        latest_file, forest = None, None
+        if invite_forest.is_enabled(config):
+            fetch = (fetchers or {}).get("invites", invite_forest.get_invites)
+            latest_file, forest = write_invite_tree(config, fetch)
+        if latest_file is None:
+            # 未启用邀请森林，或没有任何数据库的邀请森林可用（如首次更新失败）
+            # 设置参数并调用fetch_metabase.py的main函数
+            sql_file = str(project_root / "02_Query" / "recharge_analysis.sql")
+            sys.argv = [sys.argv[0], sql_file, "1"]  # 从第1行开始查找SQL
+            fetch_main()
+            cancellation.check()
+            latest_file, forest = latest_invite_file(config), None
+            if latest_file is not None:
+                # 邀请关系CSV由 fetch_metabase 写出，这里补写列式副本供页面内存映射读取
+                columnar.write_mapped(latest_file, columnar.mapped_path(latest_file))
+        if latest_file is None:
+            return
+        cancellation.check()
+
+        # 稀疏矩阵逐级计算各级下线
+        write_inviter_stats(config, latest_file, forest)
 
 if __name__ == '__main__':
     main()
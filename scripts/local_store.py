@@ -0,0 +1,160 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+本地嵌入式分析库
+
+各数据库拉取到的原始表统一落地到一个本地 DuckDB 文件中（列式存储、无需服务），
+分析脚本直接在库内执行关联和分组聚合；超出内存上限时由 DuckDB 溢写到磁盘，
+不会像在 pandas 里那样直接 OOM。
+"""
+
+from pathlib import Path
+
+try:
+    import duckdb
+except ImportError:  # 未安装时各脚本回退到纯pandas计算
+    duckdb = None
+
+# 项目根目录
+project_root = Path(__file__).parent.parent
+
+# 默认配置，可在 database_config.json 的 "local_store" 中覆盖
+DEFAULT_STORE_CONFIG = {
+    "enabled": True,
+    "path": "data/local_store/analytics.duckdb",
+    "memory_limit": "2GB",
+    "threads": None
+}
+
+# 原始表结构：落地时按此强制转换类型，避免不同数据库CSV推断出的类型不一致
+RAW_TABLES = {
+    # agent_analysis
+    "raw_tg_user": {
+        "agent_id": "VARCHAR",
+        "game_user_id": "BIGINT",
+        "username": "VARCHAR",
+        "user_id": "BIGINT",
+        "inviter_user_id": "BIGINT",
+        "create_time": "DATE",
+        "update_time": "DATE"
+    },
+    "raw_game_charges": {
+        "user_id": "BIGINT",
+        "agent_id": "VARCHAR",
+        "amount": "DOUBLE",
+        "status": "VARCHAR",
+        "pay_type": "INTEGER",
+        "created_at": "TIMESTAMP"
+    },
+    "raw_game_count": {
+        "user_id": "BIGINT",
+        "game_count": "BIGINT"
+    },
+    "raw_invite_stats": {
+        "agent_id": "VARCHAR",
+        "inviter_user_id": "BIGINT",
+        "invite_count": "BIGINT"
+    },
+    # accumulate_recharge
+    "raw_user_registration": {
+        "user_id": "VARCHAR",
+        "agent_id": "VARCHAR",
+        "agent_username": "VARCHAR",
+        "注册日期": "DATE"
+    },
+    "raw_recharge": {
+        "user_id": "VARCHAR",
+        "充值日期": "DATE",
+        "pay_type": "INTEGER",
+        "amount": "DOUBLE",
+        "调整后金额": "DOUBLE",
+        "status": "INTEGER",
+        "agent_username": "VARCHAR"
+    }
+}
+
+def get_store_config(config=None):
+    """合并默认配置与 database_config.json 中的 local_store 配置"""
+    store_config = dict(DEFAULT_STORE_CONFIG)
+    if config and isinstance(config.get("local_store"), dict):
+        store_config.update(config["local_store"])
+    return store_config
+
+def is_enabled(config=None):
+    """本地分析库是否可用（已安装 duckdb 且未在配置中关闭）"""
+    return duckdb is not None and bool(get_store_config(config)["enabled"])
+
+def get_store_path(config=None):
+    """获取本地分析库文件路径"""
+    path = Path(get_store_config(config)["path"])
+    if not path.is_absolute():
+        path = project_root / path
+    return path
+
+def connect(config=None):
+    """
+    打开本地分析库连接
+    - memory_limit: 内存上限，超出后 join/group by 会溢写到 temp_directory
+    - threads: 并行线程数，默认使用全部核心
+    """
+    if duckdb is None:
+        raise ImportError("未安装 duckdb，无法使用本地分析库，请执行 pip install duckdb")
+
+    store_config = get_store_config(config)
+    store_path = get_store_path(config)
+    store_path.parent.mkdir(parents=True, exist_ok=True)
+    spill_dir = store_path.parent / "spill"
+    spill_dir.mkdir(parents=True, exist_ok=True)
+
+    con = duckdb.connect(str(store_path))
+    con.execute(f"SET memory_limit = '{store_config['memory_limit']}'")
+    con.execute(f"SET temp_directory = '{spill_dir.as_posix()}'")
+    # 不要求保持插入顺序，允许大表聚合走溢写路径
+    con.execute("SET preserve_insertion_order = false")
+    if store_config.get("threads"):
+        con.execute(f"SET threads = {int(store_config['threads'])}")
+    return con
+
+def table_exists(con, table):
+    """检查表是否存在"""
+    return con.execute(
+        "SELECT COUNT(*) FROM information_schema.tables WHERE table_name = ?",
+        [table]
+    ).fetchone()[0] > 0
+
+def land_table(con, table, df, db_id):
+    """
+    将某个数据库的一张原始表写入本地库
+    同一 db_id 的旧数据会被整体替换，其他数据库的数据不受影响
+    """
+    schema = RAW_TABLES[table]
+    columns_sql = ", ".join(f'"{col}" {col_type}' for col, col_type in schema.items())
+    con.execute(f'CREATE TABLE IF NOT EXISTS "{table}" (db_id INTEGER, {columns_sql})')
+
+    # 缺失的列以NULL补齐，多余的列忽略
+    select_sql = ", ".join(
+        f'TRY_CAST("{col}" AS {col_type}) AS "{col}"' if df is not None and col in df.columns
+        else f'CAST(NULL AS {col_type}) AS "{col}"'
+        for col, col_type in schema.items()
+    )
+
+    con.execute("BEGIN TRANSACTION")
+    try:
+        con.execute(f'DELETE FROM "{table}" WHERE db_id = ?', [db_id])
+        if df is not None and not df.empty:
+            con.register("_landing", df)
+            try:
+                con.execute(
+                    f'INSERT INTO "{table}" SELECT ? AS db_id, {select_sql} FROM _landing',
+                    [db_id]
+                )
+            finally:
+                con.unregister("_landing")
+        con.execute("COMMIT")
+    except Exception:
+        con.execute("ROLLBACK")
+        raise
+
+def query_df(con, sql, params=None):
+    """执行查询并返回DataFrame"""
+    return con.execute(sql, params or []).df()
@@ -0,0 +1,120 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Metabase 查询客户端
+
+同一进程内相同的查询（同一数据库、规范化后相同的SQL、相同参数）同时发起多次时，
+只有第一次（leader）真正请求 Metabase，其余调用（follower）等待并共用它的结果。
+例如两个会话同时刷新同一页面、批量任务与页面刷新重叠时，重复的查询不会再发出。
+结果不做缓存：leader 完成后，之后的同样查询会重新请求。
+
+当前上下文有取消令牌（见 cancellation）时，查询在后台线程中执行，调用方一边等待一边检查令牌，
+取消后立即返回（抛出 Cancelled），不再等待 Metabase 响应。已发出的请求由后台线程收尾，
+结果直接丢弃；它仍登记为进行中，期间再次发起的相同查询会等待它而不是重新请求。
+"""
+
+import json
+import re
+import sys
+import threading
+from collections import Counter
+from pathlib import Path
+
+# 添加项目根目录到系统路径
+project_root = Path(__file__).parent.parent.parent
+script_dir = project_root / "01_Script"
+sys.path.append(str(project_root))
+sys.path.append(str(script_dir))
+from fetch_metabase import get_data_as_csv
+import cancellation
+
+_lock = threading.Lock()
+# 查询键 -> 进行中的调用
+_inflight = {}
+
+# 统计：实际发出的查询数、被合并（节省）的重复查询数、因取消而放弃等待的查询数
+stats = Counter()
+
+class _Call:
+    """一次进行中的查询"""
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+        self.followers = 0
+
+def normalize_sql(sql):
+    """规范化SQL：合并空白、去掉末尾分号，用于判断是否为同一查询"""
+    sql = re.sub(r"\s+", " ", sql).strip()
+    return sql.rstrip(";").strip()
+
+def query_key(db_id, sql, params=None):
+    return (db_id, normalize_sql(sql), json.dumps(params, sort_keys=True, default=str))
+
+def query_csv(metabase, db_id, sql, params=None):
+    """
+    查询并返回CSV文本；相同查询进行中时等待其结果
+    params 为查询参数（参与判断是否为同一查询）
+    当前任务已取消时抛出 cancellation.Cancelled
+    """
+    token = cancellation.current()
+    if token is not None:
+        token.check()
+    key = query_key(db_id, sql, params)
+    with _lock:
+        call = _inflight.get(key)
+        leader = call is None
+        if leader:
+            call = _Call()
+            _inflight[key] = call
+            stats["queries"] += 1
+        else:
+            call.followers += 1
+            stats["coalesced"] += 1
+
+    if leader:
+        if token is None:
+            _run(call, key, metabase, db_id, sql)
+        else:
+            threading.Thread(target=_run, args=(call, key, metabase, db_id, sql), daemon=True).start()
+    else:
+        print(f"数据库 {db_id} 的相同查询正在进行，等待其结果")
+
+    if token is None:
+        call.done.wait()
+    else:
+        try:
+            token.wait(call.done)
+        except cancellation.Cancelled:
+            with _lock:
+                stats["cancelled"] += 1
+            print(f"数据库 {db_id} 的查询已取消")
+            raise
+    if call.error is not None:
+        raise call.error
+    return call.result
+
+def _run(call, key, metabase, db_id, sql):
+    """实际请求 Metabase，结果或异常记录在 call 上"""
+    try:
+        call.result = get_data_as_csv(
+            metabase["base_url"],
+            metabase["session_id"],
+            metabase["device_id"],
+            db_id,
+            sql
+        )
+    except Exception as e:
+        call.error = e
+    finally:
+        with _lock:
+            del _inflight[key]
+        call.done.set()
+
+def summary():
+    """查询统计的简要说明"""
+    summary = f"Metabase 查询 {stats['queries']} 次，合并重复查询 {stats['coalesced']} 次"
+    if stats["cancelled"]:
+        summary += f"，取消 {stats['cancelled']} 次"
+    return summary
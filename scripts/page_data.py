@@ -0,0 +1,257 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+各页面读取的分析结果和按结果版本缓存的派生数据
+
+页面和启动预热（config.start_warmup）都通过这里加载结果、构建索引和布局，
+两者使用同一份 result_cache 和同一组缓存键：预热构建过的数据，页面首次访问时直接命中。
+
+WARMUP_TASKS 为启动预热的步骤，每一步加载一个页面的最新结果并构建该页面默认视图需要的派生数据。
+"""
+
+import sys
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+# 首页启动预热时可能先于各分析脚本加载，这里自行加入脚本目录
+sys.path.append(str(Path(__file__).parent))
+import result_cache
+import columnar
+import search_index
+import table_view
+import cohort_index
+import hll
+import agent_partitions
+import snapshots
+import downline
+
+# 项目根目录
+project_root = Path(__file__).parent.parent
+# 页面读取的结果目录
+RESULT_DIR = project_root / "data" / "merged_data"
+
+# 代理商分析 / 充值分析页面的搜索列和排序选项
+AGENT_SEARCH_COLUMNS = ["username", "agent_id"]
+AGENT_SORT_OPTIONS = ["总用户数", "总充值金额", "付费用户数", "游戏玩家数", "活跃天数"]
+RECHARGE_SEARCH_COLUMNS = ["agent_username", "agent_id"]
+RECHARGE_SORT_OPTIONS = ["注册人数", "累积充值_total", "付费用户数_30天", "30天ARPU", "30天ARPPU"]
+
+# 邀请关系网络图的默认显示深度
+DEFAULT_INVITE_DEPTH = 3
+
+# 默认配置，可在 database_config.json 的 "warmup" 中覆盖
+DEFAULT_WARMUP_CONFIG = {
+    "enabled": True  # 首页启动时是否在后台预热各页面的结果和缓存
+}
+
+def get_warmup_config(config=None):
+    """合并默认配置与 database_config.json 中的 warmup 配置"""
+    warmup_config = dict(DEFAULT_WARMUP_CONFIG)
+    if config and isinstance(config.get("warmup"), dict):
+        warmup_config.update(config["warmup"])
+    return warmup_config
+
+def latest_result(pattern):
+    """
+    目录下最新的结果文件，同一版本只解析一次
+    有同名的 Arrow IPC 文件时内存映射读取（各服务进程共享页缓存），否则解析CSV
+    返回 (DataFrame, 文件名, 版本号)，没有结果文件时返回None
+    """
+    RESULT_DIR.mkdir(parents=True, exist_ok=True)
+    latest_file = result_cache.latest_file(RESULT_DIR, pattern)
+    if latest_file is None:
+        return None
+    mapped_file = columnar.mapped_path(latest_file)
+    if mapped_file.exists():
+        df, version = result_cache.load_result(mapped_file, loader=columnar.read_mapped)
+    else:
+        df, version = result_cache.load_result(latest_file)
+    return df, latest_file.name, version
+
+def load_sketches(filename):
+    """加载与结果文件同一时间戳的去重草图，旧版本结果没有草图时返回None"""
+    sketch_file = Path(hll.sketch_path(RESULT_DIR / filename))
+    if not sketch_file.exists():
+        return None
+    sketches, _ = result_cache.load_result(sketch_file, loader=hll.read_sketches)
+    return sketches
+
+def search(df, version, columns):
+    """按结果版本缓存的搜索索引"""
+    return result_cache.get_artifact(version, "search_index", lambda: search_index.SearchIndex(df, columns))
+
+def sort_index(df, version, columns):
+    """按结果版本缓存的排序置换"""
+    return result_cache.get_artifact(version, "sort_index", lambda: table_view.SortIndex(df, columns))
+
+def agent_names(df, version):
+    """代理ID（统一格式）-> 代理名称"""
+    return result_cache.get_artifact(
+        version,
+        "agent_names",
+        lambda: df.groupby(df["agent_id"].map(agent_partitions.normalize_agent_id))["username"].first().to_dict()
+    )
+
+def agent_options(df, version):
+    """代理选项：代理ID -> 显示名称（同一代理在多个数据库中时合并，按总用户数降序）"""
+    def build():
+        agents = df.groupby(df["agent_id"].map(agent_partitions.normalize_agent_id), sort=False).agg(
+            username=("username", "first"),
+            总用户数=("总用户数", "sum")
+        ).sort_values("总用户数", ascending=False)
+        return {agent_id: f"{row.username} ({agent_id})" for agent_id, row in agents.iterrows()}
+    return result_cache.get_artifact(version, "agent_options", build)
+
+def daily_trend(filename, df, version):
+    """
+    与结果文件同一时间戳的每日趋势
+    旧版本的结果没有趋势文件时，由结果表汇总一次并按版本缓存
+    """
+    trend_file = RESULT_DIR / filename.replace("agent_recharge_analysis_", "agent_recharge_trend_")
+    if trend_file.exists():
+        daily_stats, _ = result_cache.load_result(
+            trend_file,
+            loader=lambda path: pd.read_csv(path, parse_dates=["注册日期"])
+        )
+        return daily_stats
+    # 充值分析脚本较重，只在需要汇总时才导入
+    import accumulate_recharge
+    return result_cache.get_artifact(version, "daily_trend", lambda: accumulate_recharge.build_daily_trend(df))
+
+def cohorts(df, version):
+    """按结果版本缓存的注册批次前缀和索引"""
+    return result_cache.get_artifact(version, "cohort_index", lambda: cohort_index.CohortIndex(df))
+
+def invite_index(df, version, config=None):
+    """
+    邀请关系的子图索引（按结果版本和代理明细版本缓存：按代理分组的用户取自代理明细，
+    代理商分析更新明细后重新分组）
+    有同一时间戳的邀请森林（invite_forest_<ts>.arrow）时直接由森林构建，否则由邀请关系表构建
+    返回 (downline.InviteGraph, {代理ID: 用户行号数组})
+    """
+    def build():
+        forest_file = downline.forest_path(RESULT_DIR / version.split(":", 1)[0])
+        if forest_file.exists():
+            forest, _ = result_cache.load_result(forest_file, loader=columnar.read_mapped)
+            graph = downline.InviteGraph.from_forest(forest)
+        else:
+            graph = downline.InviteGraph(df)
+        return graph, downline.agent_nodes(graph, config)
+    store_version = agent_partitions.get_version(config)
+    return result_cache.get_artifact(version, f"invite_index:{store_version}", build)
+
+def inviter_stats(filename, df, version, config=None):
+    """
+    邀请者排行（直接邀请人数和各级下线的人数、付费用户数、充值金额）
+    优先读取与邀请关系同一批次的排行文件；没有排行文件、排行文件没有各级下线列（旧版本），
+    或计算排行之后代理明细已更新（充值金额已过时）时，由邀请关系计算并按结果版本和代理明细版本缓存
+    """
+    store_version = agent_partitions.get_version(config)
+    stats_file = RESULT_DIR / filename.replace("invite_tree_", "invite_inviters_", 1)
+    source_file = downline.source_path(stats_file)
+    if stats_file.exists() and source_file.exists():
+        source, _ = result_cache.load_result(source_file, loader=downline.read_source)
+        stats, _ = result_cache.load_result(stats_file)
+        if source == store_version and "1级下线数" in stats.columns:
+            return stats
+    levels = downline.get_downline_config(config)["levels"]
+    return result_cache.get_artifact(
+        version,
+        f"downline_stats:{levels}:{store_version}",
+        lambda: downline.downline_stats(invite_index(df, version, config)[0], downline.user_amounts(config), levels)
+    )
+
+def invite_layout(df, version, max_depth, agent_id=None, root_user_id=None, config=None):
+    """
+    邀请关系网络图的图结构和节点布局（按结果版本、代理明细版本、显示深度和查看范围缓存）
+    agent_id：只看该代理的用户及其邀请者；root_user_id：只看以该用户为根、max_depth 级以内的下线
+    子图由索引按需提取（耗时与子图大小成正比），再计算布局
+    返回 (networkx.DiGraph, {节点: (x, y)})；根用户不在邀请关系中时返回None
+    """
+    def build():
+        # networkx较重，只在需要布局时才导入
+        import networkx as nx
+
+        graph, agents = invite_index(df, version, config)
+        if root_user_id is not None:
+            edges = graph.subtree_edges(root_user_id, max_depth)
+            if edges is None:
+                return None
+        elif agent_id is not None:
+            edges = graph.member_edges(agents.get(agent_id, np.empty(0, dtype=np.int64)), max_depth)
+        else:
+            edges = graph.member_edges(np.arange(graph.size), max_depth)
+        G = nx.DiGraph()
+        if root_user_id is not None:
+            G.add_node(root_user_id)
+        G.add_edges_from(edges)
+        return G, nx.spring_layout(G)
+    if root_user_id is not None:
+        scope = f"root={root_user_id}"
+    elif agent_id is not None:
+        scope = f"agent={agent_id}"
+    else:
+        scope = "all"
+    store_version = agent_partitions.get_version(config)
+    return result_cache.get_artifact(version, f"invite_layout:{max_depth}:{scope}:{store_version}", build)
+
+def snapshot_changes(filename, version, config=None):
+    """
+    与前一天最后一个历史快照相比有变化的代理（按结果版本缓存）
+    返回 (基准版本, 当前版本, DataFrame)；当前结果没有快照或没有更早日期的快照时返回None
+    """
+    current = snapshots.version_of(filename)
+    if current is None or current not in snapshots.list_versions(config):
+        return None
+    baseline = snapshots.previous_day_version(current, config)
+    if baseline is None:
+        return None
+    changes = result_cache.get_artifact(
+        version,
+        f"snapshot_diff:{baseline}",
+        lambda: snapshots.diff(baseline, current, config)
+    )
+    return baseline, current, changes
+
+def _warm_agent_analysis(config):
+    result = latest_result("agent_analysis_*.csv")
+    if result is None:
+        return "暂无结果"
+    df, filename, version = result
+    search(df, version, AGENT_SEARCH_COLUMNS)
+    sort_index(df, version, AGENT_SORT_OPTIONS)
+    agent_names(df, version)
+    agent_options(df, version)
+    load_sketches(filename)
+    return f"{len(df)} 行"
+
+def _warm_recharge(config):
+    result = latest_result("agent_recharge_analysis_*.csv")
+    if result is None:
+        return "暂无结果"
+    df, filename, version = result
+    daily_trend(filename, df, version)
+    cohorts(df, version)
+    search(df, version, RECHARGE_SEARCH_COLUMNS)
+    sort_index(df, version, RECHARGE_SORT_OPTIONS)
+    load_sketches(filename)
+    return f"{len(df)} 行"
+
+def _warm_invite_tree(config):
+    result = latest_result("invite_tree_*.csv")
+    if result is None:
+        return "暂无结果"
+    df, filename, version = result
+    invite_index(df, version, config)
+    inviter_stats(filename, df, version, config)
+    G, _ = invite_layout(df, version, DEFAULT_INVITE_DEPTH, config=config)
+    return f"{G.number_of_nodes()} 个节点"
+
+# 启动预热的步骤：[(说明, fn(config) -> 结果说明)]，各步骤互不依赖，出错时不影响后续步骤
+WARMUP_TASKS = [
+    ("代理商分析结果与索引", _warm_agent_analysis),
+    ("充值分析结果与索引", _warm_recharge),
+    ("邀请关系默认布局与排行", _warm_invite_tree)
+]
@@ -0,0 +1,149 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+页面渲染耗时统计
+
+每次页面重跑时按区段（加载数据、筛选、排序、绘图、表格等）计时，
+并记录本次重跑期间结果缓存的命中/未命中、Metabase 查询次数，以及发送到浏览器的数据量。
+
+各区段的耗时保存在进程内的滚动窗口中（所有会话共用，每个区段保留最近 history_size 次），
+用于查看实际使用中哪些区段让重跑变慢；页面侧边栏勾选"显示渲染耗时"后展示。
+发送数据量的测量需要额外序列化一次，只在展示面板时才计算。
+"""
+
+import sys
+import threading
+import time
+from collections import Counter, deque
+from contextlib import contextmanager
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+# 首页等页面不会先加载其他分析脚本，这里自行加入脚本目录
+sys.path.append(str(Path(__file__).parent))
+import columnar
+
+# 默认配置，可在 database_config.json 的 "render_timing" 中覆盖
+DEFAULT_TIMING_CONFIG = {
+    "enabled": True,  # 是否记录各区段耗时（关闭后面板仍可显示本次重跑的耗时）
+    "history_size": 1000  # 每个 (页面, 区段) 保留的最近耗时数
+}
+
+# 整页耗时在历史中的区段名
+TOTAL_SECTION = "整页"
+
+_lock = threading.Lock()
+# (页面, 区段) -> 最近的耗时（秒）
+_history = {}
+
+def get_timing_config(config=None):
+    """合并默认配置与 database_config.json 中的 render_timing 配置"""
+    timing_config = dict(DEFAULT_TIMING_CONFIG)
+    if config and isinstance(config.get("render_timing"), dict):
+        timing_config.update(config["render_timing"])
+    return timing_config
+
+def _cache_counts():
+    """结果缓存和 Metabase 查询的当前计数（模块未加载时为空，说明本进程还没有用到）"""
+    counts = Counter()
+    result_cache = sys.modules.get("result_cache")
+    if result_cache is not None:
+        for kind, label in (("hits", "缓存命中"), ("misses", "缓存未命中")):
+            for name, value in result_cache.stats[kind].items():
+                counts[(label, name)] = value
+    metabase_client = sys.modules.get("metabase_client")
+    if metabase_client is not None:
+        for name, value in metabase_client.stats.items():
+            counts[("Metabase", name)] = value
+    return counts
+
+def payload_size(obj):
+    """
+    对象发送到浏览器的大致字节数
+    DataFrame 按 Arrow IPC（Streamlit 传输表格的格式），图表按 JSON，其余按字符串长度
+    """
+    if isinstance(obj, pd.DataFrame):
+        try:
+            return len(columnar.to_ipc_bytes(obj))
+        except Exception:
+            return int(obj.memory_usage(deep=True).sum())
+    if hasattr(obj, "to_json"):
+        return len(obj.to_json())
+    return len(str(obj))
+
+class RenderTimer:
+    """一次页面重跑的计时"""
+
+    def __init__(self, page, measure_payload=False, config=None):
+        self.page = page
+        self.measure_payload = measure_payload
+        self.config = get_timing_config(config)
+        self.sections = []
+        self.payloads = []
+        self.total = None
+        self._counts = _cache_counts()
+        self._start = time.perf_counter()
+
+    @contextmanager
+    def section(self, name):
+        """区段计时（同名区段多次执行时分别记录）"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.sections.append((name, time.perf_counter() - start))
+
+    def payload(self, name, obj):
+        """记录发送到浏览器的数据量（只在 measure_payload 时计算）"""
+        if self.measure_payload:
+            self.payloads.append((name, payload_size(obj)))
+
+    def finish(self):
+        """结束计时并记入历史"""
+        self.total = time.perf_counter() - self._start
+        if self.config["enabled"]:
+            record(self.page, self.sections + [(TOTAL_SECTION, self.total)], self.config["history_size"])
+
+    def section_frame(self):
+        """本次重跑各区段耗时（毫秒）"""
+        rows = [(name, round(seconds * 1000, 1)) for name, seconds in self.sections]
+        if self.total is not None:
+            rows.append((TOTAL_SECTION, round(self.total * 1000, 1)))
+        return pd.DataFrame(rows, columns=["区段", "耗时(ms)"])
+
+    def cache_frame(self):
+        """本次重跑期间的缓存命中/未命中和 Metabase 查询次数"""
+        delta = _cache_counts()
+        delta.subtract(self._counts)
+        rows = [(kind, name, value) for (kind, name), value in sorted(delta.items()) if value]
+        return pd.DataFrame(rows, columns=["类别", "名称", "次数"])
+
+    def payload_frame(self):
+        """本次重跑发送到浏览器的数据量（KB）"""
+        return pd.DataFrame({
+            "内容": [name for name, _ in self.payloads],
+            "KB": [round(size / 1024, 1) for _, size in self.payloads]
+        })
+
+def record(page, sections, history_size):
+    """把各区段耗时记入 (页面, 区段) 的滚动窗口"""
+    with _lock:
+        for name, seconds in sections:
+            key = (page, name)
+            window = _history.get(key)
+            if window is None or window.maxlen != history_size:
+                window = _history[key] = deque(window or (), maxlen=history_size)
+            window.append(seconds)
+
+def percentiles(page=None):
+    """各区段耗时的分位数（毫秒），page 为None时包含全部页面；按 P90 降序"""
+    with _lock:
+        items = [(key, np.array(window)) for key, window in _history.items() if page is None or key[0] == page]
+    rows = [
+        (key[0], key[1], len(values), *np.round(np.percentile(values * 1000, [50, 90, 99]), 1), round(values.max() * 1000, 1))
+        for key, values in items if len(values)
+    ]
+    frame = pd.DataFrame(rows, columns=["页面", "区段", "次数", "P50(ms)", "P90(ms)", "P99(ms)", "最大(ms)"])
+    return frame.sort_values("P90(ms)", ascending=False).reset_index(drop=True)
@@ -0,0 +1,103 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+分析结果的进程内缓存
+
+结果文件以 (文件名, 修改时间, 大小) 作为版本号，每个版本只解析一次，
+基于该版本构建的索引等派生数据（搜索索引、排序置换等）也按版本缓存。
+模块通过 config.load_script_module 加载后在进程内只有一份，所有会话共享。
+
+每次刷新都会写出新时间戳的结果文件，缓存按去掉时间戳的文件名（同一类结果）保存，
+每类只保留最后加载的一个版本，旧版本的结果和派生数据随之释放，内存不随刷新次数增长。
+同一版本下按查询构建的派生数据（如按根用户的网络图布局）每类最多保留 MAX_ARTIFACTS_PER_KIND 个，
+超出时淘汰最久未使用的。
+"""
+
+import re
+import threading
+from collections import Counter, OrderedDict
+
+import pandas as pd
+
+# 同一结果版本、同一类派生数据最多缓存的个数
+MAX_ARTIFACTS_PER_KIND = 32
+
+# 结果文件名中的时间戳（如 agent_analysis_20250101_120000.csv）
+_TIMESTAMP = re.compile(r"_\d{8}_\d{6}")
+
+_lock = threading.RLock()
+# 结果类别（去掉时间戳的路径）-> (版本号, DataFrame)
+_results = {}
+# (版本号, 派生数据名) -> 派生数据，按最近使用排序
+_artifacts = OrderedDict()
+
+# 命中/未命中统计，按缓存项类别计数
+stats = {"hits": Counter(), "misses": Counter()}
+
+def get_version(path):
+    """结果文件的版本号"""
+    file_stat = path.stat()
+    return f"{path.name}:{file_stat.st_mtime_ns}:{file_stat.st_size}"
+
+def latest_file(output_dir, pattern):
+    """目录下按修改时间最新的结果文件，没有时返回None"""
+    files = list(output_dir.glob(pattern))
+    if not files:
+        return None
+    return max(files, key=lambda x: x.stat().st_mtime)
+
+def result_slot(path):
+    """结果类别：去掉文件名中的时间戳，同一类结果的各个版本共用一个缓存位置"""
+    return path.with_name(_TIMESTAMP.sub("", path.name, count=1))
+
+def _live_versions():
+    return {version for version, _ in _results.values()}
+
+def load_result(path, loader=pd.read_csv):
+    """
+    加载结果文件，同一版本只解析一次
+    返回 (DataFrame, 版本号)；返回的DataFrame在会话间共享，调用方不要原地修改
+    """
+    version = get_version(path)
+    slot = result_slot(path)
+    with _lock:
+        cached = _results.get(slot)
+        if cached is not None and cached[0] == version:
+            stats["hits"]["result"] += 1
+            return cached[1], version
+
+    stats["misses"]["result"] += 1
+    df = loader(path)
+    with _lock:
+        previous = _results.get(slot)
+        _results[slot] = (version, df)
+        # 同一类结果的旧版本及其派生数据不再需要
+        if previous is not None and previous[0] != version:
+            for key in [key for key in _artifacts if key[0] == previous[0]]:
+                del _artifacts[key]
+    return df, version
+
+def get_artifact(version, name, builder):
+    """
+    获取某个结果版本的派生数据，不存在时调用 builder() 构建并缓存
+    版本已被更新的结果替换时（会话仍持有旧结果）只构建不缓存
+    """
+    key = (version, name)
+    kind = name.split(":")[0]
+    with _lock:
+        if key in _artifacts:
+            stats["hits"][kind] += 1
+            _artifacts.move_to_end(key)
+            return _artifacts[key]
+
+    stats["misses"][kind] += 1
+    value = builder()
+    with _lock:
+        if version not in _live_versions():
+            return value
+        value = _artifacts.setdefault(key, value)
+        _artifacts.move_to_end(key)
+        same_kind = [other for other in _artifacts if other[0] == version and other[1].split(":")[0] == kind]
+        for other in same_kind[:-MAX_ARTIFACTS_PER_KIND]:
+            del _artifacts[other]
+        return value
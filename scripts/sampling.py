@@ -0,0 +1,127 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+快速预览（分层抽样估计）
+
+完整刷新在大库上需要几分钟，预览模式只拉取一部分用户的数据：
+- 先查询每个代理的用户数，按代理分层：用户数不超过 target_users_per_agent 的代理全量保留，
+  更大的代理按 1/2、1/4 … 的比例抽样，使每个代理约保留 target_users_per_agent 个用户
+- 用户是否入样由 CRC32(user_id) 决定，同一用户每次预览的结果一致，查询在库端过滤
+- 计数和金额按抽样比例放大（Horvitz-Thompson 估计），并给出置信区间半宽（<列名>_误差）
+
+预览结果写到 preview_<结果名>_<时间戳>.csv，不会被页面当作完整结果读取。
+"""
+
+import math
+from io import StringIO
+
+import numpy as np
+import pandas as pd
+
+import metabase_client
+
+# 默认配置，可在 database_config.json 的 "preview" 中覆盖
+DEFAULT_PREVIEW_CONFIG = {
+    "target_users_per_agent": 2000,  # 每个代理约保留的用户数
+    "max_tier": 6,  # 最小抽样比例为 1/2^max_tier
+    "confidence": 0.95
+}
+
+# CRC32(user_id) 取模的桶数，抽样比例 1/2^k 对应保留前 BUCKETS >> k 个桶
+BUCKETS = 1024
+
+AGENT_SIZE_QUERY = """
+SELECT agent_id, COUNT(*) AS user_count
+FROM tg_user
+WHERE enable_flag = 1
+GROUP BY agent_id
+"""
+
+def get_preview_config(config=None):
+    """合并默认配置与 database_config.json 中的 preview 配置"""
+    preview_config = dict(DEFAULT_PREVIEW_CONFIG)
+    if config and isinstance(config.get("preview"), dict):
+        preview_config.update(config["preview"])
+    return preview_config
+
+def z_value(confidence):
+    """双侧置信水平对应的正态分位数"""
+    from statistics import NormalDist
+    return NormalDist().inv_cdf(0.5 + confidence / 2)
+
+def agent_keys(agent_ids):
+    """代理ID统一为整数字符串，空值为 'NULL'（用于对齐抽样比例）"""
+    ids = pd.to_numeric(pd.Series(agent_ids), errors="coerce")
+    return ids.map(lambda x: "NULL" if pd.isna(x) else str(int(x)))
+
+def sampling_plan(metabase, db_id, config=None):
+    """
+    查询每个代理的用户数并确定抽样比例
+    返回 agent_id, user_count, tier（抽样比例为 1/2^tier）, rate
+    """
+    preview_config = get_preview_config(config)
+    csv_data = metabase_client.query_csv(metabase, db_id, AGENT_SIZE_QUERY)
+    if not csv_data:
+        raise Exception(f"数据库 {db_id} 的代理用户数查询失败")
+    sizes = pd.read_csv(StringIO(csv_data))
+    plan = pd.DataFrame({
+        "agent_id": agent_keys(sizes["agent_id"]).to_numpy(),
+        "user_count": sizes["user_count"].to_numpy()
+    })
+    ratio = plan["user_count"] / preview_config["target_users_per_agent"]
+    plan["tier"] = np.floor(np.log2(ratio.clip(lower=1))).astype(int).clip(upper=preview_config["max_tier"])
+    plan["rate"] = np.ldexp(1.0, -plan["tier"].to_numpy())
+    return plan
+
+def sample_condition(plan, alias="t"):
+    """
+    抽样条件（附加在 WHERE 后，作用于 tg_user 别名 alias）
+    所有代理都全量保留时返回空字符串
+    """
+    sampled = plan[plan["tier"] > 0]
+    if sampled.empty:
+        return ""
+    branches = []
+    for tier, group in sampled.groupby("tier"):
+        ids = [agent_id for agent_id in group["agent_id"] if agent_id != "NULL"]
+        conditions = []
+        if ids:
+            conditions.append(f"{alias}.agent_id IN ({', '.join(ids)})")
+        if (group["agent_id"] == "NULL").any():
+            conditions.append(f"{alias}.agent_id IS NULL")
+        branches.append(f"WHEN {' OR '.join(conditions)} THEN {BUCKETS >> tier}")
+    return (
+        f"AND CRC32({alias}.user_id) % {BUCKETS} < "
+        f"CASE {' '.join(branches)} ELSE {BUCKETS} END"
+    )
+
+def rates_for(agent_ids, plan):
+    """每行对应代理的抽样比例（查询后新出现的代理按全量处理）"""
+    rates = plan.set_index("agent_id")["rate"]
+    return agent_keys(agent_ids).map(rates).fillna(1.0).to_numpy()
+
+def scale_counts(frame, columns, rates, z):
+    """
+    计数列按抽样比例放大，并加上置信区间半宽列（<列名>_误差）
+    每个用户以概率 rate 独立入样时，计数 n 的估计方差为 n(1-rate)/rate^2
+    """
+    frame = frame.copy()
+    for col in columns:
+        count = frame[col].astype(float)
+        frame[f"{col}_误差"] = (z * np.sqrt(count * (1 - rates)) / rates).round(1)
+        frame[col] = (count / rates).round().astype(int)
+    return frame
+
+def scale_sums(frame, column, square_sums, rates, z):
+    """
+    金额合计按抽样比例放大；square_sums 为样本中每个用户金额平方之和（与 frame 行对齐）
+    估计方差为 sum(y^2)(1-rate)/rate^2
+    """
+    frame = frame.copy()
+    frame[f"{column}_误差"] = (z * np.sqrt(np.asarray(square_sums, dtype=float) * (1 - rates)) / rates).round(2)
+    frame[column] = frame[column].astype(float) / rates
+    return frame
+
+def combine_errors(errors):
+    """相互独立的估计（不同数据库、不同代理）合计后的置信区间半宽"""
+    return math.sqrt(float(np.sum(np.square(np.asarray(errors, dtype=float)))))
@@ -0,0 +1,109 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+代理商搜索索引
+
+对代理商名称和ID建立 n-gram（单字 + 二元组）倒排索引，每个结果版本构建一次。
+查询时先用二元组倒排表求交得到候选，再逐个校验子串，返回匹配的行号。
+匹配口径与 df[col].str.contains(query, case=False, na=False) 一致：
+普通文本按不区分大小写的子串匹配（中文、英文相同），含正则元字符时按正则匹配。
+"""
+
+import re
+
+import numpy as np
+import pandas as pd
+
+# 含这些字符的查询按正则表达式处理（与 str.contains 的默认行为一致）
+_REGEX_CHARS = set(".^$*+?{}[]\\|()")
+
+def _to_text(series):
+    """转换为用于搜索的文本：空值为空串，整数值的浮点ID去掉 .0"""
+    if pd.api.types.is_float_dtype(series):
+        text = series.map(lambda x: "" if pd.isna(x) else (str(int(x)) if float(x).is_integer() else str(x)))
+    else:
+        text = series.map(lambda x: "" if pd.isna(x) else str(x))
+    return text.astype(object)
+
+def _grams(text):
+    """文本的单字和二元组"""
+    grams = set(text)
+    grams.update(text[i:i + 2] for i in range(len(text) - 1))
+    return grams
+
+class SearchIndex:
+    """代理商名称/ID 的 n-gram 倒排索引"""
+
+    def __init__(self, frame, columns):
+        # 按列组合去重后建立索引，再映射回行号（充值表中同一代理有多行）
+        # 各列文本分别保存（不拼接成一个字符串），查询不会跨列匹配
+        texts = [_to_text(frame[col]) for col in columns if col in frame.columns]
+        codes, uniques = pd.MultiIndex.from_arrays(texts).factorize()
+
+        # 每个去重键各列的原始文本（用于正则匹配）和小写文本（用于子串匹配）
+        self._fields = [list(key) for key in uniques]
+        self._lower_fields = [[field.lower() for field in fields] for fields in self._fields]
+
+        # 倒排表：gram -> 去重键编号数组
+        postings = {}
+        for key_id, fields in enumerate(self._lower_fields):
+            for field in fields:
+                for gram in _grams(field):
+                    postings.setdefault(gram, set()).add(key_id)
+        self._postings = {gram: np.fromiter(sorted(ids), dtype=np.int32) for gram, ids in postings.items()}
+
+        # 每行对应的去重键编号
+        self._codes = codes
+        self.num_rows = len(frame)
+
+    def _rows_for_keys(self, key_ids):
+        """去重键编号 -> 排好序的行号"""
+        if len(key_ids) == 0:
+            return np.empty(0, dtype=np.int64)
+        key_mask = np.zeros(len(self._fields), dtype=bool)
+        key_mask[np.asarray(key_ids)] = True
+        return np.flatnonzero(key_mask[self._codes])
+
+    def _candidates(self, query):
+        """用倒排表求交得到候选键（query已转小写）"""
+        grams = [query] if len(query) == 1 else [query[i:i + 2] for i in range(len(query) - 1)]
+        lists = []
+        for gram in set(grams):
+            posting = self._postings.get(gram)
+            if posting is None:
+                return np.empty(0, dtype=np.int32)
+            lists.append(posting)
+        lists.sort(key=len)
+        candidates = lists[0]
+        for posting in lists[1:]:
+            candidates = np.intersect1d(candidates, posting, assume_unique=True)
+            if len(candidates) == 0:
+                break
+        return candidates
+
+    def search(self, query):
+        """返回匹配行的行号（升序，可直接用于 df.iloc）"""
+        if not query:
+            return np.arange(self.num_rows)
+
+        if any(ch in _REGEX_CHARS for ch in query):
+            try:
+                pattern = re.compile(query, re.IGNORECASE)
+            except re.error:
+                pattern = re.compile(re.escape(query), re.IGNORECASE)
+            matched = [
+                key_id for key_id, fields in enumerate(self._fields)
+                if any(pattern.search(field) for field in fields)
+            ]
+            return self._rows_for_keys(matched)
+
+        query = query.lower()
+        candidates = self._candidates(query)
+        if len(query) <= 2:
+            # 单字和二元组的倒排表本身就是精确结果
+            return self._rows_for_keys(candidates)
+        matched = [
+            key_id for key_id in candidates
+            if any(query in field for field in self._lower_fields[key_id])
+        ]
+        return self._rows_for_keys(matched)
@@ -0,0 +1,284 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+代理商分析结果的历史快照
+
+每次分析完成后把结果按代理切分成块：同一代理的全部行（可能来自多个数据库）为一块，
+块内容的哈希作为块ID（内容寻址）。每个版本只保存 代理 -> 块ID 的清单，
+本版本新出现的块写入本版本的块文件，内容没有变化的代理不再重复保存。
+
+比较两个版本时先比对两份清单中的块ID，只读取块ID不同的代理的块，
+不需要加载两个完整的结果文件。
+
+目录结构：
+    data/snapshots/chunks.parquet               块ID -> 所在块文件
+    data/snapshots/versions/<版本>.parquet       代理 -> 块ID
+    data/snapshots/packs/<版本>_<摘要>.parquet   该版本新增的块（块ID + 结果各列）
+版本为结果文件名中的时间戳，如 agent_analysis_20250101_060000.csv -> 20250101_060000
+
+用法（导入已有的结果文件作为历史版本）：
+    python scripts/snapshots.py import [结果目录，默认 data/merged_data]
+"""
+
+import hashlib
+import re
+import sys
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+from pandas.api.types import is_numeric_dtype
+
+sys.path.append(str(Path(__file__).parent))
+import agent_partitions
+
+# 项目根目录
+project_root = Path(__file__).parent.parent
+
+# 默认配置，可在 database_config.json 的 "snapshots" 中覆盖
+DEFAULT_SNAPSHOT_CONFIG = {
+    "enabled": True,  # 分析完成后是否保存历史快照
+    "dir": "data/snapshots",
+    "keep_versions": 90  # 保留的版本数，更早的版本及只被它们引用的块会被删除
+}
+
+# 比较版本时按代理汇总的指标（各数据库的行相加）
+DIFF_METRICS = ['总用户数', '直属用户数', '付费用户数', '游戏玩家数', '总充值金额']
+
+# 代理在两个版本间的变化
+ADDED, REMOVED, CHANGED = "新增", "移除", "变化"
+
+def get_snapshot_config(config=None):
+    """合并默认配置与 database_config.json 中的 snapshots 配置"""
+    snapshot_config = dict(DEFAULT_SNAPSHOT_CONFIG)
+    if config and isinstance(config.get("snapshots"), dict):
+        snapshot_config.update(config["snapshots"])
+    return snapshot_config
+
+def is_enabled(config=None):
+    return bool(get_snapshot_config(config)["enabled"])
+
+def get_store_dir(config=None):
+    store_dir = Path(get_snapshot_config(config)["dir"])
+    if not store_dir.is_absolute():
+        store_dir = project_root / store_dir
+    return store_dir
+
+def version_of(result_file):
+    """结果文件名中的时间戳，不是分析结果文件时返回None"""
+    match = re.search(r"agent_analysis_(\d{8}_\d{6})\.csv$", Path(result_file).name)
+    return match.group(1) if match else None
+
+def _agent_keys(df):
+    return df['agent_id'].map(agent_partitions.normalize_agent_id)
+
+def _canonical(df):
+    """
+    计算哈希前统一各列的表示：数值列为 float64，其余为字符串
+    同一内容在不同版本中读成 int/float 时哈希相同
+    """
+    return pd.DataFrame({
+        col: df[col].astype('float64') if is_numeric_dtype(df[col]) else df[col].astype(str)
+        for col in df.columns
+    })
+
+def chunk_ids(df):
+    """
+    每个代理的块ID：{代理: 块ID}
+    块ID由列名和该代理各行的哈希（排序后，与行顺序无关）计算
+    """
+    if df.empty:
+        return {}
+    row_hashes = pd.util.hash_pandas_object(_canonical(df), index=False).to_numpy()
+    rows = pd.DataFrame({"agent": _agent_keys(df).to_numpy(), "hash": row_hashes})
+    rows = rows.sort_values(["agent", "hash"], kind="stable")
+    agents = rows["agent"].to_numpy()
+    hashes = rows["hash"].to_numpy()
+    starts = np.flatnonzero(np.r_[True, agents[1:] != agents[:-1]])
+    ends = np.r_[starts[1:], len(agents)]
+    header = "\x00".join(map(str, df.columns)).encode("utf-8")
+    return {
+        agents[start]: hashlib.blake2b(header + hashes[start:end].tobytes(), digest_size=16).hexdigest()
+        for start, end in zip(starts, ends)
+    }
+
+def _write_parquet(df, path):
+    """写到临时文件后替换，读取方不会读到写了一半的文件"""
+    path.parent.mkdir(parents=True, exist_ok=True)
+    temp_path = path.with_name(path.name + ".tmp")
+    pq.write_table(pa.Table.from_pandas(df, preserve_index=False), temp_path)
+    temp_path.replace(path)
+
+def _read_chunk_index(store_dir):
+    """已保存的块：块ID -> 块文件（版本）"""
+    index_file = store_dir / "chunks.parquet"
+    if not index_file.exists():
+        return pd.Series(dtype=object)
+    index = pq.read_table(index_file).to_pandas()
+    return index.set_index("chunk")["pack"]
+
+def list_versions(config=None):
+    """已保存的版本（按时间升序）"""
+    versions_dir = get_store_dir(config) / "versions"
+    if not versions_dir.exists():
+        return []
+    return sorted(path.stem for path in versions_dir.glob("*.parquet"))
+
+def load_manifest(version, config=None):
+    """某个版本的清单：代理 -> 块ID"""
+    manifest = pq.read_table(get_store_dir(config) / "versions" / f"{version}.parquet").to_pandas()
+    return manifest.set_index("agent_id")["chunk"]
+
+def write_snapshot(result_file, config=None, df=None):
+    """
+    保存一个结果文件为历史版本（同一版本重复保存时覆盖清单）
+    返回 (代理数, 新增块数)
+    """
+    result_file = Path(result_file)
+    version = version_of(result_file)
+    if version is None:
+        raise ValueError(f"无法从文件名获取版本: {result_file.name}")
+    if df is None:
+        df = pd.read_csv(result_file)
+
+    store_dir = get_store_dir(config)
+    ids = chunk_ids(df)
+    chunk_index = _read_chunk_index(store_dir)
+    new_chunks = {agent: chunk for agent, chunk in ids.items() if chunk not in chunk_index.index}
+
+    # 先写块，再写块索引和清单，清单引用的块总是已经存在
+    if new_chunks:
+        agents = _agent_keys(df)
+        rows = df[agents.isin(new_chunks)]
+        rows = rows.assign(chunk=agents[rows.index].map(new_chunks))[['chunk'] + list(df.columns)]
+        # 块文件名带上所含块的摘要，同一版本重复保存时不会覆盖已被引用的块文件
+        digest = hashlib.blake2b("".join(sorted(new_chunks.values())).encode("ascii"), digest_size=4).hexdigest()
+        pack = f"{version}_{digest}"
+        _write_parquet(rows, store_dir / "packs" / f"{pack}.parquet")
+        chunk_index = pd.concat([chunk_index, pd.Series(pack, index=list(set(new_chunks.values())), dtype=object)])
+        _write_parquet(
+            pd.DataFrame({"chunk": chunk_index.index, "pack": chunk_index.to_numpy()}),
+            store_dir / "chunks.parquet"
+        )
+    _write_parquet(
+        pd.DataFrame({"agent_id": list(ids), "chunk": list(ids.values())}),
+        store_dir / "versions" / f"{version}.parquet"
+    )
+    print(f"历史快照 {version} 已保存: {len(ids)} 个代理，新增 {len(new_chunks)} 个块")
+
+    prune(config)
+    return len(ids), len(new_chunks)
+
+def prune(config=None):
+    """只保留最近 keep_versions 个版本，删除不再被任何版本引用的块文件"""
+    keep = get_snapshot_config(config)["keep_versions"]
+    versions = list_versions(config)
+    if not keep or len(versions) <= keep:
+        return
+    store_dir = get_store_dir(config)
+    for version in versions[:-keep]:
+        (store_dir / "versions" / f"{version}.parquet").unlink()
+
+    referenced = set()
+    for version in versions[-keep:]:
+        referenced.update(load_manifest(version, config))
+    chunk_index = _read_chunk_index(store_dir)
+    chunk_index = chunk_index[chunk_index.index.isin(referenced)]
+    _write_parquet(
+        pd.DataFrame({"chunk": chunk_index.index, "pack": chunk_index.to_numpy()}),
+        store_dir / "chunks.parquet"
+    )
+    # 仍有块被引用的块文件整体保留
+    used_packs = set(chunk_index)
+    for pack_file in (store_dir / "packs").glob("*.parquet"):
+        if pack_file.stem not in used_packs:
+            pack_file.unlink()
+
+def read_chunks(chunks, config=None):
+    """读取一组块的全部行（按块文件分组，每个块文件只读取需要的块）"""
+    store_dir = get_store_dir(config)
+    chunk_index = _read_chunk_index(store_dir)
+    packs = chunk_index.reindex(list(set(chunks))).dropna()
+    frames = [
+        pq.read_table(store_dir / "packs" / f"{pack}.parquet", filters=[("chunk", "in", list(group.index))]).to_pandas()
+        for pack, group in packs.groupby(packs)
+    ]
+    frames = [frame for frame in frames if not frame.empty]
+    if not frames:
+        return pd.DataFrame()
+    return pd.concat(frames, ignore_index=True)
+
+def load_version(version, config=None):
+    """还原某个版本的完整结果（按代理排列，不保留原文件的行顺序）"""
+    df = read_chunks(load_manifest(version, config), config)
+    return df.drop(columns="chunk", errors="ignore")
+
+def changed_agents(old_version, new_version, config=None):
+    """
+    两个版本间有变化的代理（只比对清单中的块ID，不读取块内容）
+    返回 DataFrame[agent_id, 状态, 旧块, 新块]
+    """
+    old = load_manifest(old_version, config).rename("旧块")
+    new = load_manifest(new_version, config).rename("新块")
+    both = pd.concat([old, new], axis=1)
+    both = both[both["旧块"] != both["新块"]]
+    both.index.name = "agent_id"
+    both.insert(0, "状态", np.where(both["旧块"].isna(), ADDED, np.where(both["新块"].isna(), REMOVED, CHANGED)))
+    return both.reset_index()
+
+def _agent_totals(rows):
+    """块内容按代理汇总：代理名称和各指标之和"""
+    if rows.empty:
+        return pd.DataFrame(columns=['username'] + DIFF_METRICS)
+    rows = rows.assign(agent_id=_agent_keys(rows))
+    metrics = {col: pd.to_numeric(rows[col], errors='coerce') for col in DIFF_METRICS if col in rows.columns}
+    totals = pd.DataFrame(metrics).groupby(rows['agent_id']).sum()
+    totals.insert(0, 'username', rows.groupby('agent_id')['username'].first())
+    return totals
+
+def diff(old_version, new_version, config=None):
+    """
+    两个版本间有变化的代理及其指标变化
+    只读取有变化的代理的块；返回 DataFrame[agent_id, username, 状态, 各指标（新版本的值）, 各指标_变化]，
+    按总充值金额变化的绝对值降序
+    """
+    changes = changed_agents(old_version, new_version, config).set_index("agent_id")
+    old = _agent_totals(read_chunks(changes["旧块"].dropna(), config))
+    new = _agent_totals(read_chunks(changes["新块"].dropna(), config))
+
+    result = pd.DataFrame(index=changes.index)
+    result['username'] = new['username'].reindex(result.index).fillna(old['username'].reindex(result.index))
+    result['状态'] = changes['状态']
+    for col in DIFF_METRICS:
+        new_values = new[col].reindex(result.index) if col in new.columns else pd.Series(np.nan, index=result.index)
+        old_values = old[col].reindex(result.index) if col in old.columns else pd.Series(np.nan, index=result.index)
+        result[col] = new_values.fillna(0)
+        result[f'{col}_变化'] = new_values.fillna(0) - old_values.fillna(0)
+    result = result.reset_index()
+    order = result['总充值金额_变化'].abs().sort_values(ascending=False, kind="stable").index
+    return result.loc[order].reset_index(drop=True)
+
+def previous_day_version(version, config=None):
+    """早于 version 所在日期的最后一个版本（"昨天"的基准），没有时返回None"""
+    earlier = [v for v in list_versions(config) if v[:8] < version[:8]]
+    return earlier[-1] if earlier else None
+
+def import_results(result_dir, config=None):
+    """把目录中已有的分析结果文件按时间顺序导入为历史版本（已导入的版本跳过）"""
+    existing = set(list_versions(config))
+    files = sorted(
+        (path for path in Path(result_dir).glob("agent_analysis_*.csv") if version_of(path)),
+        key=version_of
+    )
+    for path in files:
+        if version_of(path) not in existing:
+            write_snapshot(path, config)
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2 or sys.argv[1] != "import":
+        print(__doc__)
+        sys.exit(1)
+    from fetch_metabase import load_config
+    import_results(sys.argv[2] if len(sys.argv) > 2 else project_root / "data" / "merged_data", load_config())
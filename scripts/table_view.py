@@ -0,0 +1,48 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+结果表格的排序与分页
+
+每个结果版本为所有可选排序列预先计算一次降序置换（argsort），
+页面重跑时只需按置换取出筛选后的行，再截取当前页，不再对整表排序和序列化。
+"""
+
+import numpy as np
+
+# 页面可选的每页行数
+PAGE_SIZES = [50, 100, 200, 500]
+
+class SortIndex:
+    """各排序列的降序置换"""
+
+    def __init__(self, frame, columns):
+        self.num_rows = len(frame)
+        self._perms = {}
+        for col in columns:
+            if col in frame.columns:
+                values = frame[col].reset_index(drop=True)
+                # 与 sort_values(col, ascending=False) 顺序一致，空值排在最后
+                self._perms[col] = values.sort_values(
+                    ascending=False, kind="stable", na_position="last"
+                ).index.to_numpy()
+
+    def order(self, column, positions=None):
+        """
+        按 column 降序排列的行号
+        positions 为筛选后的行号（如搜索结果），为None时返回全部行
+        """
+        perm = self._perms[column]
+        if positions is None:
+            return perm
+        mask = np.zeros(self.num_rows, dtype=bool)
+        mask[positions] = True
+        return perm[mask[perm]]
+
+def page_count(total_rows, page_size):
+    """总页数（至少1页）"""
+    return max(1, -(-total_rows // page_size))
+
+def page_rows(order, page, page_size):
+    """第 page 页（从1开始）的行号"""
+    start = (page - 1) * page_size
+    return order[start:start + page_size]
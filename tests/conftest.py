@@ -0,0 +1,7 @@
+# -*- coding: utf-8 -*-
+"""测试直接导入 scripts/ 下的模块（与页面中 load_script_module 加载的是同一批文件）"""
+
+import sys
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).parent.parent / "scripts"))
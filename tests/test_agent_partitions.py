@@ -0,0 +1,21 @@
+# -*- coding: utf-8 -*-
+"""代理明细中的实际充值金额与 process_data 的口径一致"""
+
+import numpy as np
+import pandas as pd
+
+import agent_partitions
+
+def test_real_amount_matches_process_data_for_null_and_other_pay_types():
+    charges = pd.DataFrame({
+        "user_id": [1, 2, 3, 4],
+        "agent_id": [7, 7, 8, None],
+        "amount": [10.0, 100.0, 30.0, 40.0],
+        "pay_type": [0, 1, None, 2],
+        "created_at": ["2024-11-01 00:00:00"] * 4
+    })
+    table = agent_partitions._build_charges(3, charges.to_csv(index=False))
+    real_amount = table.column("real_amount").to_numpy()
+    assert table.column("real_amount").null_count == 0
+    np.testing.assert_allclose(real_amount, [50.0, 2.0, 0.0, 0.0])
+    assert table.column("agent_id").to_pylist() == ["7", "7", "8", "NULL"]
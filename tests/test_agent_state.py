@@ -0,0 +1,47 @@
+# -*- coding: utf-8 -*-
+"""增量计算只重新计算输入有变化的代理"""
+
+import pandas as pd
+
+import agent_state
+
+def _frames(agent_ids):
+    base = pd.DataFrame({
+        "agent_id": [agent_id for agent_id in agent_ids for _ in range(3)],
+        "user_id": range(3 * len(agent_ids))
+    })
+    empty = pd.DataFrame(columns=["agent_id", "user_id"])
+    return base, empty, pd.DataFrame(columns=["user_id", "game_count"]), empty
+
+def _compute(calls):
+    def compute(frames, agent_ids):
+        calls.append(agent_ids)
+        counts = frames[0].groupby("agent_id").size()
+        return pd.DataFrame({
+            "agent_id": counts.index,
+            "game_user_id": counts.index,
+            "username": counts.index,
+            "总用户数": counts.to_numpy()
+        })
+    return compute
+
+def test_new_agent_does_not_mark_existing_agents_changed(tmp_path):
+    config = {"incremental": {"dir": str(tmp_path)}}
+    calls = []
+    agent_state.process_incremental(1, _frames(["a", "b", "c"]), _compute(calls), config)
+    # 指纹是64位哈希之和，几乎都在 2**53 以上
+    assert (agent_state.load_state(1, config)[1].astype("uint64") > 2 ** 53).any()
+
+    base, charge, game, invite = _frames(["a", "b", "c"])
+    new_rows = pd.DataFrame({"agent_id": ["d"] * 2, "user_id": [100, 101]})
+    result = agent_state.process_incremental(
+        1, (pd.concat([base, new_rows], ignore_index=True), charge, game, invite), _compute(calls), config
+    )
+    assert calls == [None, ["d"]]
+    assert sorted(result["agent_id"]) == ["a", "b", "c", "d"]
+
+def test_changed_agents_compares_in_uint64():
+    previous = pd.Series([2 ** 63 + 1, 2 ** 63 + 3], index=["a", "b"], dtype="uint64")
+    current = pd.Series([2 ** 63 + 1, 2 ** 63 + 5, 7], index=["a", "b", "c"], dtype="uint64")
+    assert agent_state.changed_agents(current, previous) == {"b", "c"}
+    assert agent_state.changed_agents(current.drop("c"), previous.drop("b")) == {"b"}
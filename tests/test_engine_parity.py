@@ -0,0 +1,43 @@
+# -*- coding: utf-8 -*-
+"""各计算引擎与 pandas 参考实现的结果一致（固定种子的小规模输入，完整压测见 scripts/engine_parity.py）"""
+
+import numpy as np
+import pytest
+
+import engines
+
+# 分析脚本依赖工作区中的 01_Script/fetch_metabase.py，不在时跳过
+agent_analysis = pytest.importorskip("agent_analysis", reason="未找到 01_Script/fetch_metabase.py")
+import accumulate_recharge
+import agent_state
+from engine_parity import generate_agent_inputs, generate_recharge_inputs, timed
+
+USERS = 1000
+AGENTS = 40
+
+pytestmark = pytest.mark.skipif(engines.pl is None, reason="未安装 polars")
+
+@pytest.fixture(scope="module")
+def inputs():
+    rng = np.random.default_rng(20241101)
+    return generate_agent_inputs(rng, USERS, AGENTS), generate_recharge_inputs(rng, USERS, AGENTS)
+
+@pytest.mark.parametrize("name", sorted(set(engines.ENGINES) - {engines.REFERENCE}))
+def test_agent_metrics_match_reference(inputs, name):
+    agent_inputs, _ = inputs
+    expected, _ = timed(agent_analysis.process_data, *agent_inputs)
+    engine = engines.get_engine(name)
+    result, _ = timed(lambda *frames: agent_analysis.finalize_result(engine.agent_metrics(*frames)), *agent_inputs)
+    assert not expected.empty
+    assert engines.compare_frames(result, expected, agent_state.GROUP_KEYS) == []
+
+@pytest.mark.parametrize("name", sorted(set(engines.ENGINES) - {engines.REFERENCE}))
+def test_rolling_recharge_matches_reference(inputs, name):
+    _, recharge_inputs = inputs
+    expected, _ = timed(accumulate_recharge.calculate_rolling_recharge, *recharge_inputs)
+    engine = engines.get_engine(name)
+    result, _ = timed(
+        lambda *frames: accumulate_recharge.finalize_rolling(engine.rolling_recharge(*frames)), *recharge_inputs
+    )
+    assert not expected.empty
+    assert engines.compare_frames(result, expected, ["agent_id", "agent_username", "注册日期"]) == []
@@ -0,0 +1,27 @@
+# -*- coding: utf-8 -*-
+"""结果缓存每类结果只保留最新版本，派生数据数量有上限"""
+
+import pandas as pd
+
+import result_cache
+
+def test_new_version_evicts_old_results_and_artifacts(tmp_path, monkeypatch):
+    monkeypatch.setattr(result_cache, "_results", {})
+    monkeypatch.setattr(result_cache, "_artifacts", result_cache.OrderedDict())
+    versions = []
+    for day in range(3):
+        path = tmp_path / f"agent_analysis_2026010{day + 1}_000000.csv"
+        pd.DataFrame({"a": [day]}).to_csv(path, index=False)
+        _, version = result_cache.load_result(path)
+        versions.append(version)
+        result_cache.get_artifact(version, "search_index", lambda: object())
+        for root in range(result_cache.MAX_ARTIFACTS_PER_KIND + 5):
+            result_cache.get_artifact(version, f"invite_layout:3:root={root}", lambda: object())
+
+    assert len(result_cache._results) == 1
+    assert {key[0] for key in result_cache._artifacts} == {versions[-1]}
+    assert len(result_cache._artifacts) == result_cache.MAX_ARTIFACTS_PER_KIND + 1
+
+    # 已被替换的旧版本只构建不缓存
+    assert result_cache.get_artifact(versions[0], "search_index", lambda: 1) == 1
+    assert (versions[0], "search_index") not in result_cache._artifacts
@@ -0,0 +1,39 @@
+# -*- coding: utf-8 -*-
+"""搜索索引与 str.contains 逐列匹配的结果一致"""
+
+import random
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from search_index import SearchIndex
+
+COLUMNS = ["agent_name", "agent_id"]
+
+@pytest.fixture(scope="module")
+def frame():
+    rng = random.Random(7)
+    alphabet = "ab12代理商"
+    names = ["".join(rng.choice(alphabet) for _ in range(rng.randint(1, 6))) for _ in range(400)]
+    names[:2] = ["1", "x12"]
+    agent_ids = [rng.randint(1, 400) for _ in range(400)]
+    agent_ids[:2] = [238, 5]
+    return pd.DataFrame({"agent_name": names, "agent_id": agent_ids})
+
+def expected_rows(frame, query):
+    mask = np.zeros(len(frame), dtype=bool)
+    for col in COLUMNS:
+        mask |= frame[col].astype(str).str.contains(query, case=False, regex=False).to_numpy()
+    return np.flatnonzero(mask)
+
+@pytest.mark.parametrize("query", ["12", "ab1", "1", "a", "代理", "b2a", "238", "商1a", "zz"])
+def test_search_matches_str_contains(frame, query):
+    index = SearchIndex(frame, COLUMNS)
+    np.testing.assert_array_equal(index.search(query), expected_rows(frame, query))
+
+def test_query_does_not_span_columns():
+    frame = pd.DataFrame({"agent_name": ["1"], "agent_id": [238]})
+    index = SearchIndex(frame, COLUMNS)
+    assert len(index.search("12")) == 0
+    assert list(index.search("23")) == [0]